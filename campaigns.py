@@ -0,0 +1,495 @@
+# campaigns.py
+# Segment-targeted campaigns: push a set of offers to every member of a segment
+# in one run instead of one /api/offers/assign call per customer.
+#
+# A campaign pins a segment of one segmentation run, an offer set and its caps
+# (offers per customer, total assignments; offer frequency caps always apply).
+# run() streams the members through a staged pipeline:
+#
+#   select -> eligibility -> score -> cap -> persist -> notify
+#
+# Stages are joined by bounded queues (CSP_CAMPAIGN_QUEUE chunks), so a slow
+# stage throttles the ones before it instead of piling up memory. eligibility,
+# score and cap run CSP_CAMPAIGN_WORKERS threads each, with their own SQLite
+# connection (SQLite and NumPy release the GIL). persist and notify are single
+# writers that take chunks back in member order.
+#
+# persist commits a chunk's assignments together with the campaign checkpoint
+# (last member id handled), so a crashed or stopped run resumes after it with
+# nothing assigned twice. notify writes one NDJSON outbox file per chunk and
+# advances notified_through; on resume the gap up to the checkpoint is sent first.
+# Run: python campaigns.py create --segment 2 --offers 1,3 ; python campaigns.py run 1
+
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import argparse
+import datetime
+import threading
+
+import db_init
+import capping
+import scoring
+import segmentation
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNK = int(os.environ.get("CSP_CAMPAIGN_CHUNK", "500"))
+QUEUE_SIZE = int(os.environ.get("CSP_CAMPAIGN_QUEUE", "8"))
+WORKERS = int(os.environ.get("CSP_CAMPAIGN_WORKERS", "2"))
+OUTBOX_DIR = "outbox"
+STALE_S = 120  # a 'running' campaign without a heartbeat for this long is taken to have crashed
+
+FIELDS = ["id", "name", "segment_id", "run_id", "offer_ids", "max_per_customer", "max_total", "status", "members",
+          "checkpoint", "notified_through", "processed", "assigned", "stats", "error", "created_at", "started_at",
+          "finished_at", "heartbeat_at"]
+
+_DONE = object()
+
+
+class CampaignError(Exception):
+    pass
+
+
+class CampaignBusy(CampaignError):
+    pass
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ---------------------------------------------------------------------
+# PIPELINE
+# ---------------------------------------------------------------------
+
+class Pipeline:
+    """Stages joined by bounded queues.
+
+    stage(name, fn, workers, ordered): fn(conn, item) -> item runs in `workers` threads, each with its own
+    connection from connect(). ordered stages (one worker) take items back in item["seq"] order.
+    Items carry "rows" (customers in the chunk) for the throughput counters.
+    """
+
+    def __init__(self, connect, queue_size=QUEUE_SIZE):
+        self.connect = connect
+        self.queue_size = queue_size
+        self.stages = []
+        self.source = {"name": "select", "fn": None, "workers": 1, "ordered": False, "items": 0, "rows_in": 0,
+                       "rows_out": 0, "busy_s": 0.0, "queue": None}
+        self.stop = threading.Event()
+        self.error = None
+        self.started = None
+        self._lock = threading.Lock()
+
+    def stage(self, name, fn, workers=1, ordered=False):
+        self.stages.append({"name": name, "fn": fn, "workers": 1 if ordered else max(1, workers),
+                            "ordered": ordered, "items": 0, "rows_in": 0, "rows_out": 0, "busy_s": 0.0,
+                            "queue": None})
+
+    def stats(self):
+        elapsed = time.time() - self.started if self.started else 0.0
+        out = []
+        for s in [self.source] + self.stages:
+            out.append({
+                "stage": s["name"],
+                "workers": s["workers"],
+                "chunks": s["items"],
+                "rows_in": s["rows_in"],
+                "rows_out": s["rows_out"],
+                "queued": s["queue"].qsize() if s["queue"] is not None else 0,
+                "busy_s": round(s["busy_s"], 3),
+                "rows_per_s": round(s["rows_in"] / elapsed, 1) if elapsed else 0.0,
+                # share of the stage's thread time spent working rather than waiting on its neighbours
+                "utilisation": round(s["busy_s"] / (elapsed * s["workers"]), 3) if elapsed else 0.0,
+            })
+        return out
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _fail(self, e):
+        with self._lock:
+            if self.error is None:
+                self.error = e
+        self.stop.set()
+
+    def _worker(self, i, remaining):
+        s = self.stages[i]
+        inbox = s["queue"]
+        outbox = self.stages[i + 1]["queue"] if i + 1 < len(self.stages) else None
+        conn = None
+        held, want = {}, 0  # ordered stages: out-of-order items waiting for their turn
+        try:
+            conn = self.connect()
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    inbox.put(_DONE)  # let sibling workers see it too
+                    break
+                if s["ordered"]:
+                    held[item["seq"]] = item
+                    ready = []
+                    while want in held:
+                        ready.append(held.pop(want))
+                        want += 1
+                else:
+                    ready = [item]
+                for it in ready:
+                    t0 = time.perf_counter()
+                    rows_in = it["rows"]
+                    it = s["fn"](conn, it)
+                    with self._lock:
+                        s["busy_s"] += time.perf_counter() - t0
+                        s["items"] += 1
+                        s["rows_in"] += rows_in
+                        s["rows_out"] += it["rows"]
+                    if outbox is not None and not self._put(outbox, it):
+                        return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            if conn is not None:
+                conn.close()
+            with self._lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                try:
+                    inbox.get_nowait()  # the end marker passed around between siblings
+                except queue.Empty:
+                    pass
+            if last and outbox is not None:
+                self._put(outbox, _DONE)  # after a stop nobody is waiting for it
+
+    def run(self, source):
+        """Feed items from the source iterable through every stage; returns when all are drained or stopped."""
+        for s in self.stages:
+            s["queue"] = queue.Queue(maxsize=self.queue_size)
+        remaining = [s["workers"] for s in self.stages]
+        threads = [
+            threading.Thread(target=self._worker, args=(i, remaining), name=f"campaign-{s['name']}-{w}", daemon=True)
+            for i, s in enumerate(self.stages) for w in range(s["workers"])
+        ]
+        self.started = time.time()
+        for t in threads:
+            t.start()
+        src = self.source
+        try:
+            it = iter(source)
+            while not self.stop.is_set():
+                t0 = time.perf_counter()
+                item = next(it, _DONE)
+                src["busy_s"] += time.perf_counter() - t0
+                if item is _DONE:
+                    break
+                src["items"] += 1
+                src["rows_in"] += item["rows"]
+                src["rows_out"] += item["rows"]
+                if not self._put(self.stages[0]["queue"], item):
+                    break
+        except Exception as e:
+            self._fail(e)
+        self._put(self.stages[0]["queue"], _DONE)
+        for t in threads:
+            t.join()
+        if self.error is not None:
+            raise self.error
+
+
+# ---------------------------------------------------------------------
+# CAMPAIGNS
+# ---------------------------------------------------------------------
+
+def _row(r):
+    c = dict(zip(FIELDS, r))
+    c["offer_ids"] = json.loads(c["offer_ids"] or "[]")
+    c["stats"] = json.loads(c["stats"]) if c["stats"] else None
+    return c
+
+
+def get(conn, campaign_id):
+    r = conn.execute(f"SELECT {','.join(FIELDS)} FROM campaigns WHERE id=?", (campaign_id,)).fetchone()
+    return _row(r) if r else None
+
+
+def list_campaigns(conn):
+    return [_row(r) for r in conn.execute(f"SELECT {','.join(FIELDS)} FROM campaigns ORDER BY id DESC")]
+
+
+def create(conn, name, segment_id, offer_ids=None, max_per_customer=1, max_total=None, run_id=None):
+    """New draft campaign over one segment of run_id (default: the active run). offer_ids None = every active offer."""
+    run_id = run_id or segmentation.active_run_id(conn)
+    if run_id is None:
+        raise CampaignError("no segmentation run to target")
+    members = conn.execute(
+        "SELECT COUNT(*) FROM customer_segment_map WHERE run_id=? AND segment_id=?", (run_id, segment_id)
+    ).fetchone()[0]
+    if not members:
+        raise CampaignError(f"segment {segment_id} has no members in run {run_id}")
+    offer_ids = sorted({int(o) for o in offer_ids or []})
+    if offer_ids:
+        marks = ",".join("?" * len(offer_ids))
+        found = {r[0] for r in conn.execute(f"SELECT id FROM offers WHERE active=1 AND id IN ({marks})", offer_ids)}
+        if set(offer_ids) - found:
+            raise CampaignError(f"unknown or inactive offers: {sorted(set(offer_ids) - found)}")
+    if int(max_per_customer) < 1:
+        raise CampaignError("max_per_customer must be at least 1")
+    cur = conn.execute(
+        "INSERT INTO campaigns (name, segment_id, run_id, offer_ids, max_per_customer, max_total, status, members) "
+        "VALUES (?,?,?,?,?,?, 'draft', ?)",
+        (name, segment_id, run_id, json.dumps(offer_ids), int(max_per_customer),
+         int(max_total) if max_total else None, members),
+    )
+    conn.commit()
+    return get(conn, cur.lastrowid)
+
+
+def claim(conn, campaign_id):
+    """Mark the campaign running for this caller; CampaignBusy when it is complete or alive elsewhere."""
+    stale = (datetime.datetime.utcnow() - datetime.timedelta(seconds=STALE_S)).strftime("%Y-%m-%d %H:%M:%S")
+    cur = conn.execute(
+        "UPDATE campaigns SET status='running', error=NULL, heartbeat_at=?, started_at=COALESCE(started_at, ?) "
+        "WHERE id=? AND status != 'complete' AND (status != 'running' OR heartbeat_at IS NULL OR heartbeat_at < ?)",
+        (_now(), _now(), campaign_id, stale),
+    )
+    conn.commit()
+    if cur.rowcount == 0:
+        c = get(conn, campaign_id)
+        if c is None:
+            raise CampaignError(f"campaign {campaign_id} not found")
+        raise CampaignBusy(f"campaign {campaign_id} is {c['status']}")
+
+
+def _catalogue(conn, offer_ids):
+    # the compiled catalogue narrowed to the campaign's offers
+    cat = scoring.compile_offers(conn)
+    if not offer_ids:
+        return cat
+    keep = [j for j, o in enumerate(cat["offers"]) if o["offer_id"] in set(offer_ids)]
+    W = cat["weights"]
+    return {
+        "offers": [cat["offers"][j] for j in keep],
+        "conds": [cat["conds"][j] for j in keep],
+        "features": cat["features"],
+        "weights": W[keep] if np is not None else [W[j] for j in keep],
+        "caps": {o: r for o, r in cat["caps"].items() if o in set(offer_ids)},
+    }
+
+
+def _take(batch, rows):
+    return {k: [v[i] for i in rows] for k, v in batch.items()}
+
+
+def members(conn, campaign, chunk=CHUNK):
+    """Member id chunks after the checkpoint, in id order: {"seq", "ids", "after", "through", "rows"}."""
+    after, seq = campaign["checkpoint"] or 0, 0
+    while True:
+        ids = [r[0] for r in conn.execute(
+            "SELECT customer_id FROM customer_segment_map WHERE run_id=? AND segment_id=? AND customer_id > ? "
+            "ORDER BY customer_id LIMIT ?", (campaign["run_id"], campaign["segment_id"], after, chunk))]
+        if not ids:
+            return
+        yield {"seq": seq, "ids": ids, "after": after, "through": ids[-1], "rows": len(ids)}
+        after, seq = ids[-1], seq + 1
+
+
+def notify(conn, campaign, after, through, outbox_dir=OUTBOX_DIR):
+    """Write the campaign's assignments for members in (after, through] as one NDJSON outbox file."""
+    rows = conn.execute(
+        "SELECT a.id, a.customer_id, c.msisdn, c.name, a.offer_id, o.code, o.title, a.assigned_at "
+        "FROM offer_assignment a JOIN customers c ON c.id = a.customer_id JOIN offers o ON o.id = a.offer_id "
+        "WHERE a.assigned_by = ? AND a.customer_id > ? AND a.customer_id <= ? ORDER BY a.customer_id, a.id",
+        (f"campaign:{campaign['id']}", after, through),
+    ).fetchall()
+    if rows:
+        keys = ["assignment_id", "customer_id", "msisdn", "name", "offer_id", "code", "title", "assigned_at"]
+        path = os.path.join(outbox_dir, f"campaign_{campaign['id']}_{after}_{through}.ndjson")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(dict(zip(keys, r), campaign_id=campaign["id"])) + "\n")
+        os.replace(tmp, path)  # same name on a resend, so readers never see a notification twice
+    with conn:
+        conn.execute("UPDATE campaigns SET notified_through=? WHERE id=?", (through, campaign["id"]))
+    return len(rows)
+
+
+def run(db, campaign_id, workers=WORKERS, chunk=CHUNK, outbox_dir=OUTBOX_DIR, on_start=None, claimed=False):
+    """Execute (or resume) a campaign. Returns the final campaign row.
+
+    on_start(pipeline) is called once the stages are set up, e.g. to expose live stats or stop().
+    claimed: the caller already holds it via claim().
+    """
+    os.makedirs(outbox_dir, exist_ok=True)
+
+    def connect():
+        conn = sqlite3.connect(db, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    conn = connect()
+    db_init.ensure_schema(conn)
+    if not claimed:
+        claim(conn, campaign_id)
+    campaign = get(conn, campaign_id)
+    catalogue = _catalogue(conn, campaign["offer_ids"])
+    per_customer = campaign["max_per_customer"] or 1
+    budget = [None if campaign["max_total"] is None else campaign["max_total"] - campaign["assigned"]]
+    if (campaign["notified_through"] or 0) < (campaign["checkpoint"] or 0):
+        # the previous run stopped between persist and notify
+        notify(conn, campaign, campaign["notified_through"] or 0, campaign["checkpoint"], outbox_dir)
+
+    def eligibility(c, item):
+        batch = scoring.load_batch(c, item["ids"])
+        mask = scoring.eligibility_mask(batch, catalogue)
+        if np is not None:
+            rows = np.flatnonzero(np.asarray(mask).any(axis=1)).tolist()
+            item["mask"] = np.asarray(mask)[rows]
+        else:
+            rows = [i for i, r in enumerate(mask) if any(r)]
+            item["mask"] = [mask[i] for i in rows]
+        item["batch"] = _take(batch, rows)
+        item["rows"] = len(rows)
+        return item
+
+    def score(c, item):
+        item["ranked"] = scoring.rank(item["batch"], catalogue, mask=item.pop("mask"))
+        return item
+
+    def cap(c, item):
+        batch = item.pop("batch")
+        blocked = capping.blocked_pairs(c, catalogue["caps"], batch["id"]) if batch["id"] else set()
+        c.commit()  # blocked_pairs' temp-table writes open a transaction whose read lock would stall persist
+        picks = []
+        for cid, ranked in zip(batch["id"], item.pop("ranked")):
+            chosen = [catalogue["offers"][j]["offer_id"] for j, _ in ranked
+                      if (cid, catalogue["offers"][j]["offer_id"]) not in blocked][:per_customer]
+            picks += [(cid, oid) for oid in chosen]
+        item["picks"] = picks
+        item["rows"] = len({cid for cid, _ in picks})
+        return item
+
+    def persist(c, item):
+        picks = item.pop("picks")
+        if budget[0] is not None:
+            picks = picks[:max(budget[0], 0)]
+            budget[0] -= len(picks)
+        with c:
+            c.executemany(
+                "INSERT INTO offer_assignment (customer_id, offer_id, assigned_by, status) VALUES (?,?,?,'assigned')",
+                [(cid, oid, f"campaign:{campaign_id}") for cid, oid in picks],
+            )
+            c.execute(
+                "UPDATE campaigns SET checkpoint=?, processed=processed+?, assigned=assigned+?, heartbeat_at=?, "
+                "stats=? WHERE id=?",
+                (item["through"], len(item["ids"]), len(picks), _now(), json.dumps(pipe.stats()), campaign_id),
+            )
+        if budget[0] is not None and budget[0] <= 0:
+            pipe.stop.set()  # total cap reached; what is already queued is dropped
+            capped[0] = True
+        item["rows"] = len({cid for cid, _ in picks})
+        return item
+
+    def send(c, item):
+        notify(c, campaign, item["after"], item["through"], outbox_dir)
+        return item
+
+    capped = [budget[0] is not None and budget[0] <= 0]
+    pipe = Pipeline(connect)
+    pipe.stage("eligibility", eligibility, workers)
+    pipe.stage("score", score, workers)
+    pipe.stage("cap", cap, workers)
+    pipe.stage("persist", persist, ordered=True)
+    pipe.stage("notify", send, ordered=True)
+    if on_start:
+        on_start(pipe)
+
+    status, error = "complete", None
+    try:
+        if not capped[0]:
+            pipe.run(members(conn, campaign, chunk))
+        if pipe.stop.is_set() and not capped[0]:
+            status = "paused"
+        done = get(conn, campaign_id)
+        if (done["notified_through"] or 0) < (done["checkpoint"] or 0):
+            # stopped early: chunks already persisted still get their notifications
+            notify(conn, campaign, done["notified_through"] or 0, done["checkpoint"], outbox_dir)
+    except Exception as e:
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    stats = {"stages": pipe.stats(), "elapsed_s": round(time.time() - pipe.started, 3) if pipe.started else 0.0}
+    with conn:
+        conn.execute(
+            "UPDATE campaigns SET status=?, error=?, stats=?, heartbeat_at=NULL, "
+            "finished_at=CASE WHEN ? = 'complete' THEN ? ELSE finished_at END WHERE id=?",
+            (status, error, json.dumps(stats), status, _now(), campaign_id),
+        )
+    out = get(conn, campaign_id)
+    conn.close()
+    return out
+
+
+# ---------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Segment-targeted offer campaigns")
+    p.add_argument("--db", default="csp.db")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    pc = sub.add_parser("create")
+    pc.add_argument("--name", default=None)
+    pc.add_argument("--segment", type=int, required=True)
+    pc.add_argument("--offers", default="", help="comma-separated offer ids (default: all active offers)")
+    pc.add_argument("--per-customer", type=int, default=1)
+    pc.add_argument("--max-total", type=int, default=None)
+    pr = sub.add_parser("run", help="run or resume a campaign")
+    pr.add_argument("id", type=int)
+    pr.add_argument("--workers", type=int, default=WORKERS)
+    pr.add_argument("--chunk", type=int, default=CHUNK)
+    sub.add_parser("list")
+    args = p.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    db_init.ensure_schema(conn)
+    if args.cmd == "create":
+        offers = [int(o) for o in args.offers.split(",") if o.strip()]
+        c = create(conn, args.name or f"segment {args.segment}", args.segment, offers, args.per_customer,
+                   args.max_total)
+        print(json.dumps(c))
+    elif args.cmd == "list":
+        for c in list_campaigns(conn):
+            print(json.dumps({k: c[k] for k in ("id", "name", "status", "members", "processed", "assigned")}))
+    else:
+        conn.close()
+        c = run(args.db, args.id, workers=args.workers, chunk=args.chunk)
+        print(json.dumps({k: c[k] for k in ("id", "status", "processed", "assigned", "error")}))
+        for s in c["stats"]["stages"]:
+            print(f"{s['stage']:12s} {s['rows_in']:>9d} in {s['rows_out']:>9d} out "
+                  f"{s['rows_per_s']:>10.1f} rows/s  busy {s['utilisation']:.0%}")
+        return
+    conn.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
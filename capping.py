@@ -0,0 +1,200 @@
+# capping.py
+# Offer frequency capping: at most cap_count assignments of an offer to one
+# customer within cap_window_days (per offer; offers without their own cap use
+# CSP_OFFER_CAP, which is off unless set).
+# Checks run against the (customer_id, offer_id, assigned_at) index; batches use
+# one anti-join against a temp table of rules. compact() moves assignments older than
+# every cap window into offer_assignment_archive so the hot table stays small.
+# Run: python capping.py --compact [--db csp.db]
+
+import os
+import sys
+import sqlite3
+import datetime
+import argparse
+
+import db_init
+
+# "<count>/<days>", e.g. "1/30" = once per offer per customer every 30 days; "0" (default) leaves
+# offers without cap_count uncapped, so repeat /api/offers/assign calls keep succeeding unless opted in
+_DEFAULT = os.environ.get("CSP_OFFER_CAP", "0")
+if "/" in _DEFAULT:
+    DEFAULT_CAP_COUNT, DEFAULT_CAP_DAYS = (int(x) for x in _DEFAULT.split("/", 1))
+else:
+    DEFAULT_CAP_COUNT, DEFAULT_CAP_DAYS = int(_DEFAULT), 30
+
+CHUNK = 900
+
+INSERT_SQL = "INSERT INTO offer_assignment (customer_id, offer_id, assigned_by, status) VALUES (?,?,?,'assigned')"
+
+
+def rule(cap_count, cap_window_days):
+    """Effective (count, days) for an offer row; None when the offer is uncapped."""
+    count = DEFAULT_CAP_COUNT if cap_count is None else int(cap_count)
+    days = DEFAULT_CAP_DAYS if cap_window_days is None else int(cap_window_days)
+    if count <= 0 or days <= 0:
+        return None
+    return count, days
+
+
+def cutoff(days, now=None):
+    """assigned_at lower bound for a window, in CURRENT_TIMESTAMP format (UTC)."""
+    now = now or datetime.datetime.utcnow()
+    return (now - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def load_rules(conn, offer_ids=None):
+    """{offer_id: (count, days)} for capped offers."""
+    sql = "SELECT id, cap_count, cap_window_days FROM offers"
+    rows = conn.execute(sql).fetchall() if offer_ids is None else [
+        r for i in range(0, len(offer_ids), CHUNK)
+        for r in conn.execute(
+            sql + " WHERE id IN (%s)" % ",".join("?" * len(offer_ids[i:i + CHUNK])), offer_ids[i:i + CHUNK]
+        )
+    ]
+    rules = {}
+    for oid, count, days in rows:
+        r = rule(count, days)
+        if r:
+            rules[oid] = r
+    return rules
+
+
+def is_capped(conn, customer_id, offer_id, rules=None):
+    """True when assigning offer_id to customer_id now would exceed its cap (index range scan)."""
+    rules = load_rules(conn, [offer_id]) if rules is None else rules
+    r = rules.get(offer_id)
+    if not r:
+        return False
+    count, days = r
+    n = conn.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM offer_assignment "
+        "WHERE customer_id=? AND offer_id=? AND assigned_at >= ? LIMIT ?)",
+        (customer_id, offer_id, cutoff(days), count),
+    ).fetchone()[0]
+    return n >= count
+
+
+def blocked_pairs(conn, rules, customer_ids=None):
+    """Set of (customer_id, offer_id) pairs that have hit their cap, for a batch (everyone if None).
+
+    One anti-join from the assignment side: the per-offer rules go into a temp
+    table and only in-window assignments are grouped, so the cost follows the
+    hot assignment rows rather than customers x offers.
+    """
+    if not rules:
+        return set()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS cap_rules (offer_id INTEGER PRIMARY KEY, cap INTEGER, since TEXT)")
+    conn.execute("DELETE FROM cap_rules")
+    conn.executemany("INSERT INTO cap_rules VALUES (?,?,?)",
+                     [(oid, count, cutoff(days)) for oid, (count, days) in rules.items()])
+    sql = """
+        SELECT a.customer_id, a.offer_id
+        FROM offer_assignment a
+        JOIN cap_rules r ON r.offer_id = a.offer_id AND a.assigned_at >= r.since
+        {where}
+        GROUP BY a.customer_id, a.offer_id
+        HAVING COUNT(*) >= MAX(r.cap)
+    """
+    out = set()
+    if customer_ids is None:
+        out.update(tuple(r) for r in conn.execute(sql.format(where="")))
+    else:
+        ids = list(customer_ids)
+        for i in range(0, len(ids), CHUNK):
+            part = ids[i:i + CHUNK]
+            where = "WHERE a.customer_id IN (%s)" % ",".join("?" * len(part))
+            out.update(tuple(r) for r in conn.execute(sql.format(where=where), part))
+    conn.execute("DELETE FROM cap_rules")
+    return out
+
+
+def _begin_immediate(conn):
+    # take the write lock before counting, so a concurrent writer cannot pass the same check
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+
+
+def assign(conn, customer_id, offer_ids, assigned_by, rules=None):
+    """Assign the first of offer_ids still under its cap: (offer_id, assignment_id, capped offer ids).
+
+    offer_id is None when every candidate is capped. The cap checks and the insert run in one
+    BEGIN IMMEDIATE transaction, so concurrent workers cannot both pass a check and overshoot.
+    """
+    rules = load_rules(conn, list(offer_ids)) if rules is None else rules
+    capped = []
+    _begin_immediate(conn)
+    try:
+        for oid in offer_ids:
+            if is_capped(conn, customer_id, oid, rules):
+                capped.append(oid)
+                continue
+            aid = conn.execute(INSERT_SQL, (customer_id, oid, assigned_by)).lastrowid
+            conn.commit()
+            return oid, aid, capped
+        conn.rollback()
+        return None, None, capped
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def assign_many(conn, candidates, assigned_by, rules):
+    """assign() for a batch: candidates is [(customer_id, [offer ids best first])].
+
+    Caps are re-read inside the write transaction, so picks made from an earlier
+    blocked_pairs() never overshoot. Returns the inserted [(customer_id, offer_id)].
+    """
+    _begin_immediate(conn)
+    try:
+        blocked = blocked_pairs(conn, rules, [cid for cid, _ in candidates]) if candidates else set()
+        picks = []
+        for cid, oids in candidates:
+            oid = next((o for o in oids if (cid, o) not in blocked), None)
+            if oid is not None:
+                picks.append((cid, oid))
+        conn.executemany(INSERT_SQL, [(cid, oid, assigned_by) for cid, oid in picks])
+        conn.commit()
+        return picks
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def compact(conn, keep_days=None):
+    """Move assignments older than the longest cap window (or keep_days) to the archive table.
+
+    Returns the number of rows archived.
+    """
+    if keep_days is None:
+        windows = [days for _, days in load_rules(conn).values()]
+        keep_days = max(windows + [DEFAULT_CAP_DAYS])
+    since = cutoff(keep_days)
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO offer_assignment_archive (id, customer_id, offer_id, assigned_at, assigned_by, status) "
+        "SELECT id, customer_id, offer_id, assigned_at, assigned_by, status FROM offer_assignment WHERE assigned_at < ?",
+        (since,),
+    )
+    moved = cur.rowcount
+    cur.execute("DELETE FROM offer_assignment WHERE assigned_at < ?", (since,))
+    conn.commit()
+    return moved
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Offer assignment maintenance")
+    p.add_argument("--db", default="csp.db")
+    p.add_argument("--compact", action="store_true", help="archive assignments outside every cap window")
+    p.add_argument("--keep-days", type=int, default=None)
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    db_init.ensure_schema(conn)
+    if args.compact:
+        print("Archived assignments:", compact(conn, args.keep_days))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
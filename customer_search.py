@@ -0,0 +1,236 @@
+# customer_search.py
+# Customer lookup for agents and the customers page: ranked full-text search over
+# name, city, occupation and hobby (the customers_fts FTS5 index from db_init) and
+# msisdn prefix search (range scan on the UNIQUE msisdn index), paginated.
+#
+# Every word in the query must start a word of the customer ("pri luck" finds Priya
+# in Lucknow); digit groups are the start of an msisdn. Text hits are ranked by which
+# column each word hit (name highest) and whether it was a whole word. FTS5 returns
+# matches in id order and ranking needs the rows, so only the first
+# CSP_SEARCH_CANDIDATES matches are ranked and the rest follow in id order: broad
+# prefixes stay as fast as narrow ones. (FTS5's bm25 is not used: it reads every match
+# of every term to weigh them, 5-15 ms per query on a million customers.)
+# Run: python customer_search.py --db csp.db "priya mum"
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import unicodedata
+
+import db_init
+
+PAGE_SIZE = 20
+MAX_LIMIT = 200
+CANDIDATES = int(os.environ.get("CSP_SEARCH_CANDIDATES", "500"))
+MSISDN_SCAN = 5000  # msisdn prefixes covering at most this many customers are filtered row by row
+WEIGHTS = (10.0, 4.0, 1.0, 1.0)  # relevance weight per db_init.SEARCH_COLUMNS entry
+
+COLUMNS = ["id"] + db_init.CUSTOMER_COLUMNS
+_SELECT = "SELECT " + ", ".join("c." + col for col in COLUMNS)
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def parse(q):
+    """(text terms, msisdn prefix or None) from a free-form query."""
+    words = _TOKEN.findall(q or "")
+    digits = "".join(w for w in words if w.isdigit())
+    return [w for w in words if not w.isdigit()], digits or None
+
+
+def fts_query(terms):
+    # every term quoted (no FTS operators from user input) and matched as a word prefix
+    return " ".join('"%s"*' % t.replace('"', '""') for t in terms)
+
+
+def _fold(text):
+    # what the unicode61 tokenizer (remove_diacritics) does to a word, for matching outside FTS
+    text = text.casefold()
+    if text.isascii():
+        return text
+    return "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+
+
+def score(texts, terms):
+    """Relevance of one customer (SEARCH_COLUMNS values) to folded terms; 0.0 when a term is missing.
+
+    Each term counts its best hit: the column weight, doubled for a whole word, x1.5 at the
+    start of the column (first name, first word of a city).
+    """
+    total = 0.0
+    words = [_TOKEN.findall(_fold(t or "")) for t in texts]
+    for term in terms:
+        best = 0.0
+        for weight, ws in zip(WEIGHTS, words):
+            for i, w in enumerate(ws):
+                if w.startswith(term):
+                    best = max(best, weight * (2.0 if w == term else 1.0) * (1.5 if i == 0 else 1.0))
+        if not best:
+            return 0.0
+        total += best
+    return total
+
+
+def _prefix_range(prefix):
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def has_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name='customers_fts'").fetchone() is not None
+
+
+def _fetch(conn, scored):
+    """Full customer rows for [(id, score)], in that order, score appended."""
+    if not scored:
+        return []
+    found = {r[0]: tuple(r) for r in conn.execute(
+        f"{_SELECT} FROM customers c WHERE c.id IN ({','.join('?' * len(scored))})", [i for i, _ in scored])}
+    return [found[i] + (s,) for i, s in scored if i in found]
+
+
+def _scored(conn, ids, terms):
+    if not ids:
+        return []
+    cols = ", ".join(db_init.SEARCH_COLUMNS)
+    rows = conn.execute(f"SELECT id, {cols} FROM customers WHERE id IN ({','.join('?' * len(ids))})", ids)
+    return [(r[0], round(score(tuple(r)[1:], terms), 2)) for r in rows]
+
+
+def _ranked(conn, terms, limit, offset, lo_hi=None):
+    """A text match: the first CANDIDATES matches (in id order) by relevance, then the rest by id.
+
+    FTS5 streams matches in rowid order, so the candidate LIMIT bounds the work however broad
+    the prefix ("pr"); ranking is done here on those rows.
+    """
+    match = fts_query(terms)
+    sql = "SELECT f.rowid FROM customers_fts f"
+    params = [match]
+    if lo_hi:
+        sql += " JOIN customers c ON c.id = f.rowid"
+    sql += " WHERE customers_fts MATCH ?"
+    if lo_hi:
+        sql += " AND c.msisdn >= ? AND c.msisdn < ?"
+        params.extend(lo_hi)
+    folded = [_fold(t) for t in terms]
+    ids = [r[0] for r in conn.execute(sql + " LIMIT ?", params + [CANDIDATES])]
+    page = sorted(_scored(conn, ids, folded), key=lambda r: (-r[1], r[0]))[offset:offset + limit]
+    if len(page) < limit and len(ids) == CANDIDATES:
+        tail = [r[0] for r in conn.execute(sql + " AND f.rowid > ? ORDER BY f.rowid LIMIT ? OFFSET ?",
+                                           params + [ids[-1], limit - len(page), max(0, offset - CANDIDATES)])]
+        page += sorted(_scored(conn, tail, folded))
+    return _fetch(conn, page)
+
+
+def _msisdn_filtered(conn, lo_hi, terms, limit, offset):
+    """Customers in a narrow msisdn range that also match the words, in msisdn order."""
+    folded = [_fold(t) for t in terms]
+    cols = ", ".join(db_init.SEARCH_COLUMNS)
+    hits = []
+    for r in conn.execute(f"SELECT id, {cols} FROM customers WHERE msisdn >= ? AND msisdn < ? ORDER BY msisdn",
+                          lo_hi):
+        s = score(tuple(r)[1:], folded)
+        if s:
+            hits.append((r[0], round(s, 2)))
+            if len(hits) == offset + limit:
+                break
+    return _fetch(conn, hits[offset:])
+
+
+def search(conn, q, limit=PAGE_SIZE, offset=0, max_limit=MAX_LIMIT):
+    """One page of customers matching q: {"query", "mode", "results", "limit", "offset", "next_offset"}.
+
+    mode is "text" (ranked; rows carry their relevance "score", higher is better), "msisdn"
+    (msisdn order; any words in the query filter) or "all" (empty query, id order).
+    """
+    limit = max(1, min(int(limit), max_limit))
+    offset = max(0, int(offset))
+    terms, msisdn = parse(q)
+    indexed = bool(terms) and has_index(conn)
+    lo_hi = _prefix_range(msisdn) if msisdn else None
+    narrow = msisdn and conn.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM customers WHERE msisdn >= ? AND msisdn < ? LIMIT ?)",
+        lo_hi + (MSISDN_SCAN + 1,)).fetchone()[0] <= MSISDN_SCAN
+
+    if terms and narrow:
+        mode = "msisdn"
+        rows = _msisdn_filtered(conn, lo_hi, terms, limit + 1, offset)
+    elif indexed:
+        mode = "text"
+        rows = _ranked(conn, terms, limit + 1, offset, lo_hi)
+    else:
+        where, params = [], []
+        if msisdn:
+            where.append("c.msisdn >= ? AND c.msisdn < ?")
+            params.extend(lo_hi)
+        for t in terms:
+            # no FTS5 in this SQLite build: unranked prefix matching
+            where.append("(" + " OR ".join(f"c.{col} LIKE ?" for col in db_init.SEARCH_COLUMNS) + ")")
+            params.extend([t + "%"] * len(db_init.SEARCH_COLUMNS))
+        mode = "msisdn" if msisdn else ("text" if terms else "all")
+        sql = (f"{_SELECT}, NULL AS score FROM customers c"
+               + (" WHERE " + " AND ".join(where) if where else "")
+               + (" ORDER BY c.msisdn" if msisdn else " ORDER BY c.id") + " LIMIT ? OFFSET ?")
+        rows = conn.execute(sql, params + [limit + 1, offset]).fetchall()
+    results = [dict(zip(COLUMNS + ["score"], r)) for r in rows[:limit]]
+    return {
+        "query": q or "",
+        "mode": mode,
+        "results": results,
+        "limit": limit,
+        "offset": offset,
+        "next_offset": offset + limit if len(rows) > limit else None,
+    }
+
+
+def sort_key(mode):
+    """Order of results within a mode, for merging pages from several shards."""
+    if mode == "text":
+        return lambda r: (-(r["score"] or 0.0), r["id"])
+    if mode == "msisdn":
+        return lambda r: (r["msisdn"] or "", r["id"])
+    return lambda r: r["id"]
+
+
+def merge(pages, limit, offset):
+    """Combine first pages from each shard (offset 0, limit offset + limit) into one page.
+
+    Shards rank their own candidates, so across shards the order is by score, not exact.
+    """
+    mode = pages[0]["mode"] if pages else "all"
+    rows = sorted((r for p in pages for r in p["results"]), key=sort_key(mode))
+    more = len(rows) > offset + limit or any(p["next_offset"] is not None for p in pages)
+    return {
+        "query": pages[0]["query"] if pages else "",
+        "mode": mode,
+        "results": rows[offset:offset + limit],
+        "limit": limit,
+        "offset": offset,
+        "next_offset": offset + limit if more else None,
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Search customers by name, city, occupation, hobby or msisdn prefix")
+    p.add_argument("query", nargs="?", default="")
+    p.add_argument("--db", default="csp.db")
+    p.add_argument("--limit", type=int, default=PAGE_SIZE)
+    p.add_argument("--offset", type=int, default=0)
+    p.add_argument("--rebuild", action="store_true", help="rebuild the full-text index from customers")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    db_init.ensure_schema(conn)
+    if args.rebuild and has_index(conn):
+        conn.execute("INSERT INTO customers_fts(customers_fts) VALUES ('rebuild')")
+        conn.commit()
+    page = search(conn, args.query, args.limit, args.offset)
+    conn.close()
+    for r in page["results"]:
+        score = "" if r["score"] is None else f"{r['score']:8.3f}"
+        print(f"{r['id']:>8} {r['msisdn'] or '':<14} {r['name'] or '':<20} {r['city'] or '':<14} "
+              f"{r['occupation'] or '':<14} {r['hobby'] or '':<14} {score}")
+    print(f"-- {page['mode']}, offset {page['offset']}, next {page['next_offset']}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
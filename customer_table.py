@@ -0,0 +1,251 @@
+# customer_table.py
+# Compact in-memory customer table for analytics (segmentation, eligibility, scoring).
+#
+# Struct-of-arrays: one typed array per column (NumPy when available, array
+# module otherwise) instead of a dict per customer. Categorical columns are
+# dictionary-encoded: codes index a per-column list of distinct values, code 0
+# meaning NULL. Row access goes through a __slots__ view, so nothing per
+# customer is allocated until asked for.
+#
+# get(conn) builds the table once per (database, customers/profile data version)
+# and hands the same object to every caller until the data changes. With
+# shared_features enabled the columns live in shared memory, one copy per node.
+# Report: python customer_table.py --db csp.db
+
+import os
+import sys
+import bisect
+import sqlite3
+import argparse
+import threading
+from array import array
+
+import db_init
+import shared_features
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CATEGORICAL = ["gender", "region", "city", "device_brand", "preferred_app", "income_bracket",
+               "effective_income", "data_preference", "voice_preference"]
+NUMERIC = ["age", "churn_risk_score"]
+
+# effective_income: the customer_profile value wins, as in scoring
+BUILD_SQL = """
+    SELECT c.id, c.age, c.churn_risk_score, c.gender, c.region, c.city, c.device_brand, c.preferred_app,
+           c.income_bracket,
+           COALESCE((SELECT p.income_bracket FROM customer_profile p WHERE p.customer_id = c.id LIMIT 1),
+                    c.income_bracket),
+           c.data_preference, c.voice_preference
+    FROM customers c
+    ORDER BY c.id
+"""
+
+_lock = threading.Lock()
+_tables = {}  # db path -> CustomerTable
+
+
+def _column(a):
+    # typed array.array -> NumPy view over the same buffer (no copy) when NumPy is present
+    return np.frombuffer(a, dtype=a.typecode) if np is not None else a
+
+
+class CustomerRow:
+    """Read-only view of one customer; attribute access decodes on the fly."""
+
+    __slots__ = ("_t", "_i")
+
+    def __init__(self, table, i):
+        self._t = table
+        self._i = i
+
+    def __getattr__(self, name):
+        return self._t.value(name, self._i)
+
+    def as_dict(self):
+        return {name: self._t.value(name, self._i) for name in ["id"] + NUMERIC + CATEGORICAL}
+
+    def __repr__(self):
+        return f"CustomerRow({self.as_dict()!r})"
+
+
+class CustomerTable:
+    """Columns: ids (sorted int64), age float32 / churn float64 (NaN for NULL), CATEGORICAL as uint16 codes."""
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        dicts = {c: [None] for c in CATEGORICAL}
+        index = {c: {None: 0} for c in CATEGORICAL}
+        # filled as typed arrays straight away so the build never holds per-row Python objects
+        ids, age, churn = array("q"), array("f"), array("d")
+        codes = {c: array("I") for c in CATEGORICAL}
+        nan = float("nan")
+        for r in rows:
+            ids.append(r[0])
+            age.append(nan if r[1] is None else r[1])
+            churn.append(nan if r[2] is None else r[2])
+            for c, v in zip(CATEGORICAL, r[3:]):
+                idx = index[c]
+                code = idx.get(v)
+                if code is None:
+                    code = idx[v] = len(dicts[c])
+                    dicts[c].append(v)
+                codes[c].append(code)
+        self.ids = _column(ids)
+        # churn stays float64: scoring multiplies it by offer weights and must match SQL values exactly
+        self.numeric = {"age": _column(age), "churn_risk_score": _column(churn)}
+        self.codes = {c: _column(array("H", a) if len(dicts[c]) <= 0xFFFF else a) for c, a in codes.items()}
+        self.dictionaries = dicts
+        self._index = index
+
+    def parts(self):
+        """(arrays, meta) for shared_features.publish."""
+        arrays = {"ids": self.ids}
+        arrays.update(self.numeric)
+        arrays.update({"code:" + c: a for c, a in self.codes.items()})
+        return arrays, {"dictionaries": self.dictionaries}
+
+    @classmethod
+    def from_parts(cls, arrays, meta, version=None):
+        """Table over already-built column arrays (e.g. views into a shared-memory segment)."""
+        table = cls.__new__(cls)
+        table.version = version
+        table.ids = arrays["ids"]
+        table.numeric = {c: arrays[c] for c in NUMERIC}
+        table.codes = {c: arrays["code:" + c] for c in CATEGORICAL}
+        table.dictionaries = meta["dictionaries"]
+        table._index = {c: {v: i for i, v in enumerate(d)} for c, d in table.dictionaries.items()}
+        return table
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return CustomerRow(self, i)
+
+    def value(self, name, i):
+        if name == "id":
+            return int(self.ids[i])
+        if name in self.numeric:
+            v = float(self.numeric[name][i])
+            return None if v != v else v
+        if name in self.codes:
+            return self.dictionaries[name][self.codes[name][i]]
+        raise AttributeError(name)
+
+    def row(self, customer_id):
+        """Row view for a customer id, or None."""
+        i = int(self.lookup([customer_id])[0])
+        return CustomerRow(self, i) if i >= 0 else None
+
+    def lookup(self, customer_ids):
+        """Row position of each customer id (-1 when absent); binary search over the sorted ids."""
+        if np is not None:
+            q = np.asarray(customer_ids, dtype=np.int64)
+            pos = np.searchsorted(self.ids, q)
+            pos[pos >= len(self.ids)] = 0
+            found = (self.ids[pos] == q) if len(self.ids) else np.zeros(len(q), dtype=bool)
+            return np.where(found, pos, -1)
+        out = []
+        for cid in customer_ids:
+            i = bisect.bisect_left(self.ids, cid)
+            out.append(i if i < len(self.ids) and self.ids[i] == cid else -1)
+        return out
+
+    def code_of(self, column, value):
+        """Code of value in a categorical column (None when the value never occurs)."""
+        return self._index[column].get(value)
+
+    def matching_codes(self, column, pred):
+        """Codes whose decoded value satisfies pred(value)."""
+        return [code for code, v in enumerate(self.dictionaries[column]) if pred(v)]
+
+    def decode(self, column, positions=None):
+        """Decoded values (shared string objects, no copies) for a categorical column."""
+        d, codes = self.dictionaries[column], self.codes[column]
+        if positions is None:
+            return [d[c] for c in codes]
+        return [d[codes[i]] for i in positions]
+
+    def numbers(self, column, positions=None, default=0.0):
+        """Python floats for a numeric column, NULL replaced by default."""
+        col = self.numeric[column]
+        vals = col.tolist() if positions is None else [float(col[i]) for i in positions]
+        return [default if v != v else v for v in vals]
+
+    def mapped(self, column, fn):
+        """Apply fn once per distinct value and spread the results over every row (fn(value) -> float)."""
+        lut = [fn(v) for v in self.dictionaries[column]]
+        if np is not None:
+            return np.asarray(lut, dtype=np.float64)[self.codes[column]]
+        return [lut[c] for c in self.codes[column]]
+
+    def memory(self):
+        """Bytes held per column and in total (dictionary strings included)."""
+        def nbytes(a):
+            return int(a.nbytes) if np is not None else a.itemsize * len(a)
+
+        cols = {"id": nbytes(self.ids)}
+        cols.update({c: nbytes(a) for c, a in self.numeric.items()})
+        for c, a in self.codes.items():
+            cols[c] = nbytes(a) + sum(sys.getsizeof(v) for v in self.dictionaries[c] if v is not None)
+        return {
+            "rows": len(self),
+            "columns": cols,
+            "total_bytes": sum(cols.values()),
+            "bytes_per_row": round(sum(cols.values()) / len(self), 1) if len(self) else 0,
+            "distinct": {c: len(d) - 1 for c, d in self.dictionaries.items()},
+        }
+
+
+def _version(conn):
+    return (db_init.get_version(conn, "customers"), db_init.get_version(conn, "customer_profile"))
+
+
+def get(conn):
+    """The CustomerTable for conn's database at its current data version (built on first use)."""
+    path = os.path.abspath(conn.execute("PRAGMA database_list").fetchone()[2] or ":memory:")
+    version = _version(conn)
+    with _lock:
+        table = _tables.get(path)
+        if table is not None and table.version == version:
+            return table
+    if shared_features.enabled():
+        bundle = shared_features.get(conn, "customers", "_".join(map(str, version)),
+                                     lambda: CustomerTable(conn.execute(BUILD_SQL), version).parts())
+        table = CustomerTable.from_parts(bundle.arrays, bundle.meta, version)
+    else:
+        table = CustomerTable(conn.execute(BUILD_SQL), version)
+    with _lock:
+        _tables[path] = table
+    return table
+
+
+def dict_rows_bytes(table):
+    """Rough size of the same data as one dict per customer (what dict(r) per row costs)."""
+    if not len(table):
+        return 0
+    sample = [table[i].as_dict() for i in range(min(len(table), 1000))]
+    per_row = sum(sys.getsizeof(d) + sum(sys.getsizeof(v) for v in d.values()) for d in sample) / len(sample)
+    return int(per_row * len(table))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Build the compact customer table and report its memory use")
+    p.add_argument("--db", default="csp.db")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    db_init.ensure_schema(conn)
+    table = get(conn)
+    conn.close()
+    rep = table.memory()
+    for c, n in rep["columns"].items():
+        print(f"{c:18s} {n:>12,d} B")
+    print(f"{'total':18s} {rep['total_bytes']:>12,d} B  ({rep['bytes_per_row']} B/row, {rep['rows']} rows)")
+    print(f"{'as dicts (est.)':18s} {dict_rows_bytes(table):>12,d} B")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,103 +2,334 @@
 # Initialize SQLite DB for CSP Use Case.
 # Run standalone: python db_init.py
 # Or it will be called from server.py if csp.db is missing.
+#
+# Fast bootstrap options:
+#   python db_init.py --snapshot prebuilt.db          restore a prebuilt snapshot (backup API)
+#   python db_init.py --make-snapshot prebuilt.db     write the current DB out as a snapshot
+#   python db_init.py --customers c.csv --usage u.csv --offers o.csv
+#                                                     bulk-load seed files in one transaction
 
 import sqlite3
 import os
+import csv
+import sys
 import datetime
 import random
+import argparse
 
 DB = "csp.db"
 
+SCHEMA_SQL = """
+    CREATE TABLE customers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        msisdn TEXT UNIQUE,
+        name TEXT,
+        age INTEGER,
+        gender TEXT,
+        region TEXT,
+        city TEXT,
+        occupation TEXT,
+        marital_status TEXT,
+        income_bracket TEXT,
+        device_brand TEXT,
+        device_type TEXT,
+        hobby TEXT,
+        preferred_app TEXT,
+        data_preference TEXT,
+        voice_preference TEXT,
+        churn_risk_score REAL
+    );
 
-def seed():
-    if os.path.exists(DB):
-        os.remove(DB)
+    CREATE TABLE customer_profile (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER,
+        income_bracket TEXT,
+        email TEXT,
+        FOREIGN KEY (customer_id) REFERENCES customers(id)
+    );
 
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
+    CREATE TABLE usage_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER,
+        date TEXT,
+        data_mb REAL,
+        call_minutes REAL,
+        sms_count INTEGER,
+        app_usage_score REAL,
+        FOREIGN KEY (customer_id) REFERENCES customers(id)
+    );
 
-    # ---------------- Tables ----------------
-    cur.executescript(
-        """
-        CREATE TABLE customers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            msisdn TEXT UNIQUE,
-            name TEXT,
-            age INTEGER,
-            gender TEXT,
-            region TEXT,
-            city TEXT,
-            occupation TEXT,
-            marital_status TEXT,
-            income_bracket TEXT,
-            device_brand TEXT,
-            device_type TEXT,
-            hobby TEXT,
-            preferred_app TEXT,
-            data_preference TEXT,
-            voice_preference TEXT,
-            churn_risk_score REAL
-        );
-
-        CREATE TABLE customer_profile (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_id INTEGER,
-            income_bracket TEXT,
-            email TEXT,
-            FOREIGN KEY (customer_id) REFERENCES customers(id)
-        );
-
-        CREATE TABLE usage_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_id INTEGER,
-            date TEXT,
-            data_mb REAL,
-            call_minutes REAL,
-            sms_count INTEGER,
-            app_usage_score REAL,
-            FOREIGN KEY (customer_id) REFERENCES customers(id)
-        );
-
-        CREATE TABLE segments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE,
-            description TEXT
-        );
-
-        CREATE TABLE customer_segment_map (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_id INTEGER,
-            segment_id INTEGER,
-            assigned_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            assigned_by TEXT,
-            method TEXT,
-            FOREIGN KEY (customer_id) REFERENCES customers(id),
-            FOREIGN KEY (segment_id) REFERENCES segments(id)
-        );
-
-        CREATE TABLE offers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT UNIQUE,
-            title TEXT,
-            description TEXT,
-            eligibility_simple TEXT,
-            active INTEGER
-        );
-
-        CREATE TABLE offer_assignment (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_id INTEGER,
-            offer_id INTEGER,
-            assigned_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            assigned_by TEXT,
-            status TEXT,
-            FOREIGN KEY (customer_id) REFERENCES customers(id),
-            FOREIGN KEY (offer_id) REFERENCES offers(id)
-        );
-        """
+    CREATE TABLE segments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE,
+        description TEXT
+    );
+
+    CREATE TABLE customer_segment_map (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER,
+        segment_id INTEGER,
+        assigned_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        assigned_by TEXT,
+        method TEXT,
+        FOREIGN KEY (customer_id) REFERENCES customers(id),
+        FOREIGN KEY (segment_id) REFERENCES segments(id)
+    );
+
+    CREATE TABLE offers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE,
+        title TEXT,
+        description TEXT,
+        eligibility_simple TEXT,
+        active INTEGER
+    );
+
+    CREATE TABLE offer_assignment (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER,
+        offer_id INTEGER,
+        assigned_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        assigned_by TEXT,
+        status TEXT,
+        FOREIGN KEY (customer_id) REFERENCES customers(id),
+        FOREIGN KEY (offer_id) REFERENCES offers(id)
+    );
+"""
+
+
+# Secondary indexes are kept apart from the tables so bulk loads can build them
+# once, after the data is in, instead of maintaining them row by row.
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_usage_customer_date ON usage_history(customer_id, date)",
+    "CREATE INDEX IF NOT EXISTS idx_csm_customer ON customer_segment_map(customer_id)",
+    "CREATE INDEX IF NOT EXISTS idx_csm_run_segment_customer ON customer_segment_map(run_id, segment_id, customer_id)",
+    "CREATE INDEX IF NOT EXISTS idx_assignment_cust_offer_time ON offer_assignment(customer_id, offer_id, assigned_at)",
+    "CREATE INDEX IF NOT EXISTS idx_assignment_time ON offer_assignment(assigned_at)",
+    "CREATE INDEX IF NOT EXISTS idx_profile_customer ON customer_profile(customer_id)",
+]
+
+# Full-text index over the free-text customer columns (customer_search.py). External content:
+# the text stays in customers and the triggers mirror every change into the index. Built with the
+# secondary indexes, so bulk loads index once at the end. msisdn prefixes use the UNIQUE index.
+SEARCH_COLUMNS = ["name", "city", "occupation", "hobby"]
+_cols = ", ".join(SEARCH_COLUMNS)
+_new = ", ".join("new." + c for c in SEARCH_COLUMNS)
+_old = ", ".join("old." + c for c in SEARCH_COLUMNS)
+SEARCH_SQL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS customers_fts USING fts5({_cols}, content='customers', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3 4 5 6')",
+    f"CREATE TRIGGER IF NOT EXISTS trg_customers_fts_insert AFTER INSERT ON customers "
+    f"BEGIN INSERT INTO customers_fts(rowid, {_cols}) VALUES (new.id, {_new}); END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_customers_fts_delete AFTER DELETE ON customers "
+    f"BEGIN INSERT INTO customers_fts(customers_fts, rowid, {_cols}) VALUES ('delete', old.id, {_old}); END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_customers_fts_update AFTER UPDATE OF id, {_cols} ON customers BEGIN "
+    f"INSERT INTO customers_fts(customers_fts, rowid, {_cols}) VALUES ('delete', old.id, {_old}); "
+    f"INSERT INTO customers_fts(rowid, {_cols}) VALUES (new.id, {_new}); END",
+]
+
+# Tables added after the original schema; created IF NOT EXISTS on new and old databases alike.
+EXTRA_TABLES = [
+    """CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )""",
+    # one row per segmentation run; customer_segment_map rows carry the run_id
+    """CREATE TABLE IF NOT EXISTS segment_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        features TEXT,
+        backend TEXT,
+        k INTEGER,
+        assigned INTEGER,
+        status TEXT
+    )""",
+    # per-run, per-segment profile computed when the run is persisted
+    """CREATE TABLE IF NOT EXISTS segment_stats (
+        run_id INTEGER,
+        segment_id INTEGER,
+        member_count INTEGER,
+        centroid TEXT,
+        region_dist TEXT,
+        income_dist TEXT,
+        device_dist TEXT,
+        PRIMARY KEY (run_id, segment_id)
+    )""",
+    # assignments older than every cap window, moved out by capping.compact()
+    """CREATE TABLE IF NOT EXISTS offer_assignment_archive (
+        id INTEGER PRIMARY KEY,
+        customer_id INTEGER,
+        offer_id INTEGER,
+        assigned_at TEXT,
+        assigned_by TEXT,
+        status TEXT,
+        archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    # single-row pointer to the run readers should see
+    """CREATE TABLE IF NOT EXISTS active_segment_run (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        run_id INTEGER
+    )""",
+    # running per-customer usage sums, kept in step with usage_history by ingest.py
+    """CREATE TABLE IF NOT EXISTS usage_aggregates (
+        customer_id INTEGER PRIMARY KEY,
+        rows INTEGER NOT NULL,
+        sum_data_mb REAL NOT NULL,
+        sum_call_mins REAL NOT NULL,
+        sum_sms REAL NOT NULL,
+        sum_app_usage REAL NOT NULL,
+        last_date TEXT
+    )""",
+    # segment-targeted offer campaigns run by campaigns.py; checkpoint = last member id persisted
+    """CREATE TABLE IF NOT EXISTS campaigns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        segment_id INTEGER,
+        run_id INTEGER,
+        offer_ids TEXT,
+        max_per_customer INTEGER DEFAULT 1,
+        max_total INTEGER,
+        status TEXT DEFAULT 'draft',
+        members INTEGER,
+        checkpoint INTEGER DEFAULT 0,
+        notified_through INTEGER DEFAULT 0,
+        processed INTEGER DEFAULT 0,
+        assigned INTEGER DEFAULT 0,
+        stats TEXT,
+        error TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        started_at TEXT,
+        finished_at TEXT,
+        heartbeat_at TEXT
+    )""",
+]
+
+# Columns added to original tables: (table, column, declaration)
+EXTRA_COLUMNS = [
+    ("customer_segment_map", "run_id", "INTEGER"),
+    # JSON weight vector used by scoring.py; NULL falls back to rules derived from eligibility
+    ("offers", "score_weights", "TEXT"),
+    # frequency cap: at most cap_count assignments per customer within cap_window_days (NULL = default)
+    ("offers", "cap_count", "INTEGER"),
+    ("offers", "cap_window_days", "INTEGER"),
+]
+
+# Tables whose changes bump a counter in data_versions. Caches derived from a
+# table (feature matrices, offer rankings) key themselves on that counter.
+VERSIONED_TABLES = ["customers", "usage_history", "offers", "customer_profile"]
+
+CUSTOMER_COLUMNS = ["msisdn", "name", "age", "gender", "region", "city", "occupation", "marital_status",
+                    "income_bracket", "device_brand", "device_type", "hobby", "preferred_app",
+                    "data_preference", "voice_preference", "churn_risk_score"]
+USAGE_COLUMNS = ["customer_id", "date", "data_mb", "call_minutes", "sms_count", "app_usage_score"]
+OFFER_COLUMNS = ["code", "title", "description", "eligibility_simple", "active"]
+
+BATCH = 50000
+
+
+def create_schema(conn, indexes=True):
+    """Create all tables on an empty database (secondary indexes and version triggers optional)."""
+    conn.executescript(SCHEMA_SQL)
+    _create_extras(conn)
+    if indexes:
+        create_indexes(conn)
+
+
+def _create_extras(conn):
+    for stmt in EXTRA_TABLES:
+        conn.execute(stmt)
+    for table, column, decl in EXTRA_COLUMNS:
+        have = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in have:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    for table in VERSIONED_TABLES:
+        # start from a random value so a re-created DB never reuses an old cache key
+        conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, ?)",
+                     (table, random.getrandbits(40)))
+
+
+def create_version_triggers(conn):
+    # per-row triggers: created with the indexes so bulk loads do not pay for them row by row
+    for table in VERSIONED_TABLES:
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()}_version AFTER {op} ON {table} "
+                f"BEGIN UPDATE data_versions SET version = version + 1 WHERE name = '{table}'; END"
+            )
+
+
+def ensure_schema(conn):
+    """Bring an existing database up to the current schema. Safe to call repeatedly."""
+    _create_extras(conn)
+    create_indexes(conn)
+    _adopt_legacy_mappings(conn)
+    if conn.execute("SELECT 1 FROM usage_aggregates LIMIT 1").fetchone() is None:
+        rebuild_usage_aggregates(conn)
+    conn.commit()
+
+
+def rebuild_usage_aggregates(conn):
+    """Recompute usage_aggregates from usage_history (after bulk loads that bypass ingest)."""
+    conn.execute("DELETE FROM usage_aggregates")
+    conn.execute(
+        "INSERT INTO usage_aggregates (customer_id, rows, sum_data_mb, sum_call_mins, sum_sms, sum_app_usage, last_date) "
+        "SELECT customer_id, COUNT(*), TOTAL(data_mb), TOTAL(call_minutes), TOTAL(sms_count), TOTAL(app_usage_score), "
+        "MAX(date) FROM usage_history WHERE customer_id IS NOT NULL GROUP BY customer_id"
     )
 
+
+def _adopt_legacy_mappings(conn):
+    # mappings written before versioned runs become one completed "legacy" run
+    if conn.execute("SELECT 1 FROM customer_segment_map WHERE run_id IS NULL LIMIT 1").fetchone() is None:
+        return
+    cur = conn.execute(
+        "INSERT INTO segment_runs (features, backend, k, assigned, status) "
+        "SELECT 'legacy', NULL, COUNT(DISTINCT segment_id), COUNT(*), 'complete' "
+        "FROM customer_segment_map WHERE run_id IS NULL"
+    )
+    run_id = cur.lastrowid
+    conn.execute("UPDATE customer_segment_map SET run_id=? WHERE run_id IS NULL", (run_id,))
+    conn.execute("INSERT OR IGNORE INTO active_segment_run (id, run_id) VALUES (1, ?)", (run_id,))
+
+
+def get_version(conn, name):
+    row = conn.execute("SELECT version FROM data_versions WHERE name=?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def create_indexes(conn):
+    # plain execute (not executescript) so this joins the caller's open transaction
+    for stmt in INDEXES:
+        conn.execute(stmt)
+    create_search_index(conn)
+    create_version_triggers(conn)
+
+
+def create_search_index(conn):
+    """Create customers_fts and its sync triggers, filled from customers on first creation.
+
+    Returns False when this SQLite build has no FTS5 (search then falls back to LIKE).
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='customers_fts'").fetchone():
+        return True
+    try:
+        for stmt in SEARCH_SQL:
+            conn.execute(stmt)
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("INSERT INTO customers_fts(customers_fts) VALUES ('rebuild')")
+    return True
+
+
+def seed(db=DB):
+    if os.path.exists(db):
+        os.remove(db)
+
+    conn = sqlite3.connect(db)
+    cur = conn.cursor()
+
+    create_schema(conn)
+
     # ---------------- Sample customers ----------------
     customers = [
         ("9990000001", "Alice", 29, "F", "South", "Chennai", "Software Engineer", "Single", "high", "Apple", "iPhone 14", "Streaming", "YouTube", "High", "Medium", 0.10),
@@ -118,13 +349,10 @@ def seed():
     )
 
     # Profiles
-    cur.execute("SELECT id, income_bracket, name FROM customers")
-    for cid, income, name in cur.fetchall():
-        email = f"{name.lower()}@example.com"
-        cur.execute(
-            "INSERT INTO customer_profile (customer_id, income_bracket, email) VALUES (?,?,?)",
-            (cid, income, email),
-        )
+    cur.execute(
+        "INSERT INTO customer_profile (customer_id, income_bracket, email) "
+        "SELECT id, income_bracket, lower(name) || '@example.com' FROM customers"
+    )
 
     # ---------------- Sample usage_history ----------------
     cur.execute("SELECT id FROM customers")
@@ -168,10 +396,195 @@ def seed():
         offers,
     )
 
+    rebuild_usage_aggregates(conn)
     conn.commit()
     conn.close()
-    print("Database seeded:", DB)
+    print("Database seeded:", db)
+
+
+# ---------------------------------------------------------------------
+# FAST BOOTSTRAP
+# ---------------------------------------------------------------------
+
+def make_snapshot(db=DB, snapshot="csp_snapshot.db"):
+    """Copy a live database into a standalone snapshot file via the backup API."""
+    src = sqlite3.connect(db)
+    dst = sqlite3.connect(snapshot)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    return snapshot
+
+
+def restore_snapshot(snapshot, db=DB):
+    """Restore a prebuilt snapshot into db.
+
+    The copy goes to a temp file first and is renamed into place, so a crash
+    mid-restore never leaves a half-written database behind.
+    """
+    if not os.path.exists(snapshot):
+        raise FileNotFoundError(snapshot)
+    tmp = db + ".restore"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    src = sqlite3.connect(snapshot)
+    dst = sqlite3.connect(tmp)
+    try:
+        # large pages per step keep the copy close to raw file speed
+        src.backup(dst, pages=4096)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, db)
+    return db
+
+
+def _csv_rows(path, columns, convert=None):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            vals = [row.get(c) if row.get(c) != "" else None for c in columns]
+            yield convert(vals) if convert else vals
+
+
+def _chunks(it, size=BATCH):
+    buf = []
+    for row in it:
+        buf.append(row)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+def bulk_load(db=DB, customers_csv=None, usage_csv=None, offers_csv=None):
+    """Build a fresh database from seed CSV files in a single transaction.
+
+    Customers use the upload CSV layout. Usage rows may reference customers by
+    `customer_id` or by `msisdn`; rows whose msisdn matches no customer are
+    skipped and counted under "usage_skipped". Secondary indexes are created
+    after the data is loaded. db is only replaced once the load succeeded.
+    Returns a dict of row counts.
+    """
+    tmp = db + ".load"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp, isolation_level=None)
+    try:
+        counts = _bulk_insert(conn, customers_csv, usage_csv, offers_csv)
+        conn.close()
+        os.replace(tmp, db)
+        return counts
+    finally:
+        conn.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _bulk_insert(conn, customers_csv, usage_csv, offers_csv):
+    cur = conn.cursor()
+    # the file is private until the final rename, so durability can wait until then
+    cur.execute("PRAGMA journal_mode=OFF")
+    cur.execute("PRAGMA synchronous=OFF")
+    cur.execute("PRAGMA cache_size=-200000")
+    counts = {"customers": 0, "usage_history": 0, "usage_skipped": 0, "offers": 0}
+    create_schema(conn, indexes=False)
+    cur.execute("BEGIN")
+
+    if customers_csv:
+        def conv(v):
+            v[2] = int(v[2]) if v[2] is not None else None
+            v[15] = float(v[15]) if v[15] is not None else None
+            return v
+
+        sql = ("INSERT INTO customers (" + ",".join(CUSTOMER_COLUMNS) + ") VALUES ("
+               + ",".join("?" * len(CUSTOMER_COLUMNS)) + ")")
+        for chunk in _chunks(_csv_rows(customers_csv, CUSTOMER_COLUMNS, conv)):
+            cur.executemany(sql, chunk)
+            counts["customers"] += len(chunk)
+        cur.execute(
+            "INSERT INTO customer_profile (customer_id, income_bracket, email) "
+            "SELECT id, income_bracket, NULL FROM customers"
+        )
+
+    if usage_csv:
+        with open(usage_csv, newline="", encoding="utf-8") as f:
+            header = next(csv.reader(f), [])
+        by_msisdn = "customer_id" not in header and "msisdn" in header
+        ids = dict(cur.execute("SELECT msisdn, id FROM customers")) if by_msisdn else None
+        cols = ["msisdn"] + USAGE_COLUMNS[1:] if by_msisdn else USAGE_COLUMNS
+
+        def conv(v):
+            cid = ids.get(v[0]) if by_msisdn else int(v[0])
+            if cid is None:
+                return None
+            return (cid, v[1], float(v[2] or 0), float(v[3] or 0), int(v[4] or 0), float(v[5] or 0))
+
+        for chunk in _chunks(_csv_rows(usage_csv, cols, conv)):
+            rows = [r for r in chunk if r is not None]
+            cur.executemany(
+                "INSERT INTO usage_history (customer_id,date,data_mb,call_minutes,sms_count,app_usage_score) "
+                "VALUES (?,?,?,?,?,?)",
+                rows,
+            )
+            counts["usage_history"] += len(rows)
+            counts["usage_skipped"] += len(chunk) - len(rows)
+
+    if offers_csv:
+        def conv(v):
+            act = (v[4] or "1").strip().lower()
+            v[4] = 1 if act in ("1", "true", "yes") else 0
+            return v
+
+        rows = list(_csv_rows(offers_csv, OFFER_COLUMNS, conv))
+        cur.executemany("INSERT INTO offers (code,title,description,eligibility_simple,active) VALUES (?,?,?,?,?)", rows)
+        counts["offers"] = len(rows)
+
+    create_indexes(conn)
+    if usage_csv:
+        rebuild_usage_aggregates(conn)
+    cur.execute("COMMIT")
+    return counts
+
+
+def bootstrap(db=DB, snapshot=None):
+    """Create db for a fresh instance: restore a snapshot if one is given, else seed demo data.
+
+    Raises FileNotFoundError when snapshot is given but missing, rather than seeding in its place.
+    """
+    if snapshot:
+        if not os.path.exists(snapshot):
+            raise FileNotFoundError(f"snapshot not found: {snapshot}")
+        restore_snapshot(snapshot, db)
+        print("Database restored from snapshot:", snapshot)
+    else:
+        seed(db)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Initialize the CSP database")
+    p.add_argument("--db", default=DB)
+    p.add_argument("--snapshot", help="restore this prebuilt snapshot instead of seeding")
+    p.add_argument("--make-snapshot", help="write the current database to this snapshot file")
+    p.add_argument("--customers", help="customers CSV to bulk-load")
+    p.add_argument("--usage", help="usage_history CSV to bulk-load")
+    p.add_argument("--offers", help="offers CSV to bulk-load")
+    args = p.parse_args(argv)
+
+    if args.make_snapshot:
+        make_snapshot(args.db, args.make_snapshot)
+        print("Snapshot written:", args.make_snapshot)
+    elif args.snapshot:
+        restore_snapshot(args.snapshot, args.db)
+        print("Database restored from snapshot:", args.snapshot)
+    elif args.customers or args.usage or args.offers:
+        counts = bulk_load(args.db, args.customers, args.usage, args.offers)
+        print("Database bulk-loaded:", args.db, counts)
+    else:
+        seed(args.db)
 
 
 if __name__ == "__main__":
-    seed()
+    main(sys.argv[1:])
@@ -0,0 +1,87 @@
+# engines.py
+# On-demand loading of the analytics modules (scoring, segmentation, campaigns,
+# feature and customer tables, and through them NumPy / scikit-learn).
+#
+# server.py binds these names to lazy() proxies, so a worker that only answers
+# customer lookups never pays their import time; the first attribute access
+# imports the module. Workers that will segment or score can load everything
+# up front with `python server.py --preload` (or --preload segmentation,scoring).
+
+import sys
+import time
+import importlib
+import threading
+
+# engine name -> module path
+ENGINES = {
+    "scoring": "scoring",
+    "segmentation": "segmentation",
+    "campaigns": "campaigns",
+    "customer_table": "customer_table",
+    "features": "features",
+    "shared_features": "shared_features",
+    "usage_store": "usage_store",
+    "ml": "ml",
+    "sklearn": "sklearn.cluster",
+}
+
+_lock = threading.RLock()
+_load_ms = {}  # engine name -> import time in ms (near 0 when another engine imported it first)
+
+
+def load(name):
+    """Import an engine (once) and return its module."""
+    path = ENGINES.get(name, name)
+    mod = sys.modules.get(path)
+    if mod is not None and name in _load_ms:
+        return mod
+    with _lock:
+        if name not in _load_ms:
+            t0 = time.perf_counter()
+            mod = importlib.import_module(path)
+            _load_ms[name] = round((time.perf_counter() - t0) * 1000, 1)
+        return sys.modules[path]
+
+
+class LazyModule:
+    """Stands in for a module until an attribute is first needed."""
+
+    __slots__ = ("_name",)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(load(self._name), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._name in _load_ms else "not loaded"
+        return f"<lazy engine {self._name!r} ({state})>"
+
+
+def lazy(name):
+    if name not in ENGINES:
+        raise KeyError(f"unknown engine: {name}")
+    return LazyModule(name)
+
+
+def preload(names="all"):
+    """Import engines now ("all" or a comma-separated list); returns {name: ms}. Missing optional ones are skipped."""
+    wanted = list(ENGINES) if names in (None, "", "all") else [n.strip() for n in names.split(",") if n.strip()]
+    for n in wanted:
+        if n not in ENGINES:
+            raise KeyError(f"unknown engine: {n}")
+    out = {}
+    for n in wanted:
+        try:
+            load(n)
+            out[n] = _load_ms[n]
+        except ImportError:
+            out[n] = None  # optional dependency (e.g. scikit-learn) not installed
+    return out
+
+
+def status():
+    """{engine: import ms, or None while not loaded}."""
+    with _lock:
+        return {n: _load_ms.get(n) for n in ENGINES}
@@ -0,0 +1,281 @@
+# features.py
+# Deterministic feature encoding for customer segmentation.
+# Categorical values map through fixed vocabularies (stable CRC32 hashing for
+# values outside them), so the same customer always gets the same vector across
+# process restarts. The encoded matrix is cached on disk keyed by the customers
+# data version and reloaded memory-mapped until customers change. With
+# CSP_SHARED_FEATURES=1 the loaded matrix is also published to shared memory
+# so every server worker maps the same copy.
+#
+# Feature sets: demographic (customers columns), usage (usage_history averages,
+# read from the columnar usage_store when CSP_USAGE_BACKEND=columnar) and
+# combined (both, for every customer).
+
+import os
+import zlib
+from array import array
+
+import db_init
+import customer_table
+import shared_features
+import usage_store
+
+try:
+    import numpy as np
+except ImportError:  # pure-Python fallback keeps the server dependency-free
+    np = None
+
+CACHE_DIR = "cache"
+
+# feature vector (order): age, income, churn, data_pref, voice_pref, gender, region, device
+DEMOGRAPHIC_FEATURES = ["age", "income", "churn", "data_pref", "voice_pref", "gender", "region", "device"]
+
+INCOME_VOCAB = {"low": 0.0, "medium": 1.0, "high": 2.0}
+LEVEL_VOCAB = {"low": 0.0, "medium": 1.0, "high": 2.0}
+REGION_VOCAB = {"north": 0.0, "south": 1.0, "east": 2.0, "west": 3.0}
+DEVICE_VOCAB = {"apple": 0.0, "samsung": 1.0, "xiaomi": 2.0, "oneplus": 3.0, "realme": 4.0}
+
+USAGE_FEATURES = ["avg_data_mb", "avg_call_mins", "avg_sms", "avg_app_usage"]
+COMBINED_FEATURES = DEMOGRAPHIC_FEATURES + USAGE_FEATURES
+
+DEMOGRAPHIC_SQL = """
+    SELECT id, age, income_bracket, churn_risk_score, data_preference, voice_preference,
+           gender, region, device_brand
+    FROM customers
+    ORDER BY id
+"""
+
+USAGE_AGG_SQL = """
+    SELECT customer_id, sum_data_mb / rows, sum_call_mins / rows, sum_sms / rows, sum_app_usage / rows
+    FROM usage_aggregates
+    WHERE rows > 0
+    ORDER BY customer_id
+"""
+
+USAGE_SQL = """
+    SELECT customer_id, AVG(data_mb), AVG(call_minutes), AVG(sms_count), AVG(app_usage_score)
+    FROM usage_history
+    GROUP BY customer_id
+    ORDER BY customer_id
+"""
+
+
+def stable_hash(s, buckets=1000):
+    """Process-independent replacement for hash(): CRC32 of the UTF-8 text."""
+    return zlib.crc32(str(s).encode("utf-8")) % buckets
+
+
+def encode_category(v, vocab, default):
+    """Ordinal code from a fixed vocabulary; unseen values land past the end via stable_hash."""
+    if v is None or str(v).strip() == "":
+        return default
+    key = str(v).strip().lower()
+    if key in vocab:
+        return vocab[key]
+    return len(vocab) + stable_hash(key) / 1000.0
+
+
+def encode_gender(v):
+    if not v:
+        return 0.5
+    return 1.0 if str(v).strip().upper() == "F" else 0.0
+
+
+def encode_demographic(row):
+    """Encode one customers row (DEMOGRAPHIC_SQL column order) as a list of floats."""
+    _, age, income, churn, data_pref, voice_pref, gender, region, device = row
+    return [
+        float(age) if age is not None else 30.0,
+        encode_category(income, INCOME_VOCAB, 1.0),
+        float(churn or 0.0),
+        encode_category(data_pref, LEVEL_VOCAB, 1.0),
+        encode_category(voice_pref, LEVEL_VOCAB, 1.0),
+        encode_gender(gender),
+        encode_category(region, REGION_VOCAB, 0.0),
+        encode_category(device, DEVICE_VOCAB, 0.0),
+    ]
+
+
+def minmax(matrix):
+    """Min-max normalize each column. Returns (normalized, mins, ranges)."""
+    if np is not None:
+        m = np.asarray(matrix, dtype=np.float32)
+        if m.size == 0:
+            return m, np.zeros(0, np.float32), np.ones(0, np.float32)
+        mins = m.min(axis=0)
+        ranges = m.max(axis=0) - mins
+        ranges[ranges <= 0] = 1.0
+        return (m - mins) / ranges, mins, ranges
+    if not matrix:
+        return [], [], []
+    cols = list(zip(*matrix))
+    mins = [min(c) for c in cols]
+    ranges = [(max(c) - lo) or 1.0 for c, lo in zip(cols, mins)]
+    return [[(v - lo) / r for v, lo, r in zip(row, mins, ranges)] for row in matrix], mins, ranges
+
+
+# ---------------------------------------------------------------------
+# DISK CACHE
+# ---------------------------------------------------------------------
+
+def _db_tag(conn):
+    path = conn.execute("PRAGMA database_list").fetchone()[2] or ":memory:"
+    return "%08x" % zlib.crc32(os.path.abspath(path).encode("utf-8"))
+
+
+def _cache_paths(cache_dir, kind, tag, version):
+    ext = "npy" if np is not None else "bin"
+    stem = os.path.join(cache_dir, f"features_{kind}_{tag}_v{version}")
+    return f"{stem}.{ext}", f"{stem}.ids.{ext}", os.path.join(cache_dir, f"features_{kind}_{tag}_v")
+
+
+def _save(path, data, typecode):
+    tmp = path + ".tmp"
+    if np is not None:
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+    else:
+        with open(tmp, "wb") as f:
+            array(typecode, data).tofile(f)
+    os.replace(tmp, path)
+
+
+def _load(path, typecode, cols=None):
+    if np is not None:
+        return np.load(path, mmap_mode="r")
+    a = array(typecode)
+    with open(path, "rb") as f:
+        a.frombytes(f.read())
+    if cols is None:
+        return a.tolist()
+    return [a[i:i + cols].tolist() for i in range(0, len(a), cols)]
+
+
+def _prune(prefix, keep):
+    d = os.path.dirname(prefix) or "."
+    base = os.path.basename(prefix)
+    for name in os.listdir(d):
+        full = os.path.join(d, name)
+        if name.startswith(base) and full not in keep:
+            try:
+                os.remove(full)
+            except OSError:
+                pass
+
+
+def _to_matrix(ids, encoded, cols):
+    if np is not None:
+        flat = matrix = np.asarray(encoded, dtype=np.float32).reshape(len(ids), cols)
+        return flat, matrix, np.asarray(ids, dtype=np.int64)
+    # round through float32 so cold and cached runs see identical values
+    flat = array("f", [v for row in encoded for v in row])
+    matrix = [flat[i:i + cols].tolist() for i in range(0, len(flat), cols)]
+    return flat, matrix, list(ids)
+
+
+def _load_cached(conn, kind, tables, cols, build, cache_dir, use_cache):
+    """Shared cache plumbing: key on the data versions of `tables`, rebuild via build(conn)."""
+    version = "_".join(str(db_init.get_version(conn, t)) for t in tables)
+    if "usage_history" in tables and usage_store.enabled():
+        version += "_c" + usage_store.signature()
+    if shared_features.enabled():
+        return _load_shared(conn, kind, version, cols,
+                            lambda: _load_version(conn, kind, version, cols, build, cache_dir, use_cache))
+    return _load_version(conn, kind, version, cols, build, cache_dir, use_cache)
+
+
+def _load_shared(conn, kind, version, cols, load):
+    # one copy per node: the first process publishes (from the disk cache when it can), the others map it
+    def publish():
+        ids, matrix = load()
+        if np is not None:
+            return {"ids": np.asarray(ids, dtype=np.int64), "matrix": np.asarray(matrix, dtype=np.float32)}, {}
+        return {"ids": array("q", ids), "matrix": array("f", [v for row in matrix for v in row])}, {}
+
+    bundle = shared_features.get(conn, "features_" + kind, version, publish)
+    ids, flat = bundle.arrays["ids"], bundle.arrays["matrix"]
+    if np is not None:
+        return ids, flat.reshape(len(ids), cols)
+    return ids.tolist(), [flat[i:i + cols].tolist() for i in range(0, len(flat), cols)]
+
+
+def _load_version(conn, kind, version, cols, build, cache_dir, use_cache):
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        mpath, ipath, prefix = _cache_paths(cache_dir, kind, _db_tag(conn), version)
+        if os.path.exists(mpath) and os.path.exists(ipath):
+            return _load(ipath, "q"), _load(mpath, "f", cols)
+
+    ids, encoded = build(conn)
+    flat, matrix, ids_out = _to_matrix(ids, encoded, cols)
+    if use_cache:
+        _save(mpath, flat, "f")
+        _save(ipath, ids_out, "q")
+        _prune(prefix, {mpath, ipath})
+    return ids_out, matrix
+
+
+def _build_demographic(conn):
+    # encode each distinct categorical value once, then spread it over the compact table's codes
+    table = customer_table.get(conn)
+    if not len(table):
+        return [], []
+    cols = [
+        table.numbers("age", default=30.0),
+        table.mapped("income_bracket", lambda v: encode_category(v, INCOME_VOCAB, 1.0)),
+        table.numbers("churn_risk_score", default=0.0),
+        table.mapped("data_preference", lambda v: encode_category(v, LEVEL_VOCAB, 1.0)),
+        table.mapped("voice_preference", lambda v: encode_category(v, LEVEL_VOCAB, 1.0)),
+        table.mapped("gender", encode_gender),
+        table.mapped("region", lambda v: encode_category(v, REGION_VOCAB, 0.0)),
+        table.mapped("device_brand", lambda v: encode_category(v, DEVICE_VOCAB, 0.0)),
+    ]
+    if np is not None:
+        return table.ids, np.column_stack([np.asarray(c, dtype=np.float64) for c in cols])
+    return list(table.ids), [list(r) for r in zip(*cols)]
+
+
+def _build_usage(conn):
+    if usage_store.enabled():
+        return usage_store.aggregate()
+    populated = conn.execute("SELECT 1 FROM usage_aggregates LIMIT 1").fetchone() is not None
+    rows = conn.execute(USAGE_AGG_SQL if populated else USAGE_SQL).fetchall()
+    return [r[0] for r in rows], [[float(v or 0.0) for v in r[1:]] for r in rows]
+
+
+def _build_combined(conn):
+    # every customer; those without usage history get zero aggregates
+    ids, demo = _build_demographic(conn)
+    u_ids, usage = _build_usage(conn)
+    by_id = dict(zip(u_ids, usage))
+    zeros = [0.0] * len(USAGE_FEATURES)
+    return ids, [list(d) + list(by_id.get(cid, zeros)) for cid, d in zip(ids, demo)]
+
+
+def load_demographic(conn, cache_dir=CACHE_DIR, use_cache=True):
+    """Return (ids, raw_matrix) for all customers, float32, rows in id order.
+
+    With NumPy the matrix is a (memory-mapped) float32 ndarray, otherwise a
+    list of lists. A cache hit skips the customers scan entirely.
+    """
+    return _load_cached(conn, "demographic", ["customers"], len(DEMOGRAPHIC_FEATURES),
+                        _build_demographic, cache_dir, use_cache)
+
+
+def load_usage(conn, cache_dir=CACHE_DIR, use_cache=True):
+    """Per-customer usage averages (USAGE_FEATURES) for customers that have usage rows."""
+    return _load_cached(conn, "usage", ["usage_history"], len(USAGE_FEATURES),
+                        _build_usage, cache_dir, use_cache)
+
+
+def load_combined(conn, cache_dir=CACHE_DIR, use_cache=True):
+    """Demographic features followed by usage averages, for all customers."""
+    return _load_cached(conn, "combined", ["customers", "usage_history"], len(COMBINED_FEATURES),
+                        _build_combined, cache_dir, use_cache)
+
+
+FEATURE_SETS = {
+    "demographic": (DEMOGRAPHIC_FEATURES, load_demographic),
+    "usage": (USAGE_FEATURES, load_usage),
+    "combined": (COMBINED_FEATURES, load_combined),
+}
@@ -0,0 +1,385 @@
+# ingest.py
+# Streaming usage ingestion: NDJSON usage records are buffered in memory and
+# flushed into usage_history as micro-batches (by size or age) with executemany.
+# The same transaction folds the batch into usage_aggregates, so averages are
+# never out of step with the raw rows. A full buffer rejects new records
+# (BufferFull -> HTTP 503 + Retry-After) instead of growing without bound.
+#
+# Record: {"customer_id": 1, "date": "2024-01-31", "data_mb": 120.5,
+#          "call_minutes": 12, "sms_count": 3, "app_usage_score": 7}
+# Feeds keyed by subscriber send "msisdn" instead of "customer_id"; it is resolved
+# through the customers table (as db_init.bulk_load does) and unknown numbers are rejected.
+# Tail a file: python ingest.py --db csp.db --follow usage.ndjson
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import datetime
+import argparse
+import threading
+
+import db_init
+
+BATCH_ROWS = int(os.environ.get("CSP_INGEST_BATCH", "5000"))
+FLUSH_MS = int(os.environ.get("CSP_INGEST_FLUSH_MS", "200"))
+MAX_BUFFER = int(os.environ.get("CSP_INGEST_MAX", "200000"))
+
+INSERT_SQL = """
+    INSERT INTO usage_history (customer_id, date, data_mb, call_minutes, sms_count, app_usage_score)
+    VALUES (?,?,?,?,?,?)
+"""
+
+UPSERT_SQL = """
+    INSERT INTO usage_aggregates (customer_id, rows, sum_data_mb, sum_call_mins, sum_sms, sum_app_usage, last_date)
+    VALUES (?,?,?,?,?,?,?)
+    ON CONFLICT(customer_id) DO UPDATE SET
+        rows = rows + excluded.rows,
+        sum_data_mb = sum_data_mb + excluded.sum_data_mb,
+        sum_call_mins = sum_call_mins + excluded.sum_call_mins,
+        sum_sms = sum_sms + excluded.sum_sms,
+        sum_app_usage = sum_app_usage + excluded.sum_app_usage,
+        last_date = MAX(COALESCE(last_date, ''), excluded.last_date)
+"""
+
+
+class BufferFull(Exception):
+    pass
+
+
+def _msisdn(obj):
+    if isinstance(obj, dict) and obj.get("customer_id") is None and obj.get("msisdn") not in (None, ""):
+        return str(obj["msisdn"]).strip()
+    return None
+
+
+def lookup_msisdns(conn, msisdns, table="customers"):
+    """{msisdn: customer id} for the known msisdns (table: customers, or the shard catalog's customer_directory)."""
+    msisdns = list(dict.fromkeys(msisdns))
+    out = {}
+    for i in range(0, len(msisdns), 900):
+        part = msisdns[i:i + 900]
+        out.update(conn.execute(
+            f"SELECT msisdn, id FROM {table} WHERE msisdn IN ({','.join('?' * len(part))})", part))
+    return out
+
+
+def parse_record(obj, ids=None):
+    """usage_history row tuple from a decoded record; ValueError when it is unusable.
+
+    ids: {msisdn: customer id} for records that carry an msisdn instead of a customer_id.
+    """
+    if not isinstance(obj, dict):
+        raise ValueError("record must be an object")
+    msisdn = _msisdn(obj)
+    if msisdn is not None:
+        cid = (ids or {}).get(msisdn)
+        if cid is None:
+            raise ValueError(f"unknown msisdn {msisdn}")
+    else:
+        try:
+            cid = int(obj["customer_id"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("customer_id or msisdn is required")
+    day = obj.get("date") or datetime.date.today().isoformat()
+    try:
+        day = datetime.date.fromisoformat(str(day)[:10]).isoformat()
+        return (
+            cid,
+            day,
+            float(obj.get("data_mb") or 0),
+            float(obj.get("call_minutes") or 0),
+            int(obj.get("sms_count") or 0),
+            float(obj.get("app_usage_score") or 0),
+        )
+    except (TypeError, ValueError):
+        raise ValueError("bad date or numeric field")
+
+
+def _parse_records(numbered, resolve):
+    # numbered: [(line number, decoded record)]; msisdns are resolved in one lookup
+    wanted = [m for m in (_msisdn(obj) for _, obj in numbered) if m is not None]
+    ids = resolve(wanted) if wanted and resolve else {}
+    rows, errors = [], []
+    for n, obj in numbered:
+        try:
+            rows.append(parse_record(obj, ids))
+        except ValueError as e:
+            errors.append({"line": n, "error": str(e)})
+    return rows, errors
+
+
+def parse_ndjson(lines, resolve=None):
+    """(rows, errors) from NDJSON lines; errors are [{"line": n, "error": msg}].
+
+    resolve(msisdns) -> {msisdn: customer id}, e.g. via lookup_msisdns, for msisdn-keyed records.
+    """
+    numbered, errors = [], []
+    for n, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            numbered.append((n, json.loads(line)))
+        except ValueError as e:
+            errors.append({"line": n, "error": str(e)})
+    rows, bad = _parse_records(numbered, resolve)
+    return rows, sorted(errors + bad, key=lambda e: e["line"])
+
+
+def parse_payload(body, resolve=None):
+    """(rows, errors) from a request body: NDJSON, or a JSON array of records."""
+    if body.lstrip()[:1] != b"[":
+        return parse_ndjson(body.splitlines(), resolve)
+    try:
+        records = json.loads(body.decode("utf-8"))
+    except ValueError:
+        return [], [{"line": 1, "error": "invalid JSON"}]
+    if not isinstance(records, list):
+        return [], [{"line": 1, "error": "expected a JSON array of records"}]
+    return _parse_records(list(enumerate(records, start=1)), resolve)
+
+
+def write_batch(conn, rows):
+    """Insert rows and fold them into usage_aggregates in one transaction."""
+    sums = {}
+    for cid, day, data_mb, call_minutes, sms_count, app_usage_score in rows:
+        s = sums.get(cid)
+        if s is None:
+            sums[cid] = [1, data_mb, call_minutes, sms_count, app_usage_score, day]
+        else:
+            s[0] += 1
+            s[1] += data_mb
+            s[2] += call_minutes
+            s[3] += sms_count
+            s[4] += app_usage_score
+            if day > s[5]:
+                s[5] = day
+    with conn:
+        conn.executemany(INSERT_SQL, rows)
+        conn.executemany(UPSERT_SQL, [(cid, *s) for cid, s in sums.items()])
+    return list(sums)
+
+
+class Ingestor:
+    """Thread-safe micro-batching buffer in front of one SQLite database.
+
+    db: path, or a callable returning the path (so callers can repoint it).
+    route(customer_id): optional shard path per customer (see shards.py); overrides db.
+    on_flush(customer_ids) runs after each committed batch, e.g. to drop cached offers.
+    """
+
+    def __init__(self, db, batch_rows=BATCH_ROWS, flush_ms=FLUSH_MS, max_buffer=MAX_BUFFER, on_flush=None,
+                 route=None):
+        self.db = db
+        self.route = route
+        self.batch_rows = batch_rows
+        self.flush_s = flush_ms / 1000.0
+        self.max_buffer = max_buffer
+        self.on_flush = on_flush
+        self._buf = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.accepted = 0
+        self.written = 0
+        self.batches = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def _connect(self, path=None):
+        conn = sqlite3.connect(path or (self.db() if callable(self.db) else self.db), timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def add(self, rows):
+        """Queue parsed rows; raises BufferFull (nothing queued) when they do not fit."""
+        with self._lock:
+            if len(self._buf) + len(rows) > self.max_buffer:
+                self.rejected += len(rows)
+                raise BufferFull(f"ingest buffer full ({len(self._buf)}/{self.max_buffer} rows)")
+            if not self._buf:
+                self._oldest = time.monotonic()
+            self._buf.extend(rows)
+            self.accepted += len(rows)
+            full = len(self._buf) >= self.batch_rows
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+        return len(rows)
+
+    def flush(self):
+        """Write everything buffered now, in batch_rows chunks. Returns rows written."""
+        written = 0
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buf, self._oldest = self._buf, [], None
+            if not rows:
+                return 0
+            if self.route is None:
+                groups = {None: rows}
+            else:
+                groups = {}
+                for r in rows:
+                    groups.setdefault(self.route(r[0]), []).append(r)
+            pending = list(groups.items())
+            while pending:
+                path, part = pending[0]
+                conn = self._connect(path)
+                try:
+                    for i in range(0, len(part), self.batch_rows):
+                        chunk = part[i:i + self.batch_rows]
+                        try:
+                            touched = write_batch(conn, chunk)
+                        except sqlite3.Error:
+                            # put the unwritten rows back in front so nothing is lost
+                            with self._lock:
+                                self._buf[:0] = part[i:] + [r for _, p in pending[1:] for r in p]
+                                self._oldest = self._oldest or time.monotonic()
+                                self.errors += 1
+                            raise
+                        written += len(chunk)
+                        self.written += len(chunk)
+                        self.batches += 1
+                        if self.on_flush:
+                            self.on_flush(touched)
+                finally:
+                    conn.close()
+                pending.pop(0)
+        return written
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="usage-ingest", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_s)
+            self._wake.clear()
+            with self._lock:
+                due = bool(self._buf) and (
+                    len(self._buf) >= self.batch_rows or time.monotonic() - self._oldest >= self.flush_s
+                )
+            if due:
+                try:
+                    self.flush()
+                except sqlite3.Error as e:
+                    print("usage ingest flush failed:", e, file=sys.stderr)
+                    time.sleep(self.flush_s)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffered": len(self._buf),
+                "max_buffer": self.max_buffer,
+                "batch_rows": self.batch_rows,
+                "flush_ms": int(self.flush_s * 1000),
+                "accepted": self.accepted,
+                "written": self.written,
+                "batches": self.batches,
+                "rejected": self.rejected,
+                "flush_errors": self.errors,
+            }
+
+
+# ---------------------------------------------------------------------
+# FILE TAIL
+# ---------------------------------------------------------------------
+
+def tail(path, ingestor, follow=False, poll=0.5, resolve=None):
+    """Feed an NDJSON file (or '-' for stdin) through ingestor; with follow, keep reading appended lines.
+
+    The byte offset of the last flushed line is kept in <path>.offset so a restarted tail resumes there.
+    """
+    offset_path = None if path == "-" else path + ".offset"
+    f = sys.stdin.buffer if path == "-" else open(path, "rb")
+    done = 0  # byte offset just past the last complete line read
+    if offset_path and os.path.exists(offset_path):
+        with open(offset_path) as o:
+            done = int(o.read().strip() or 0)
+        f.seek(done)
+    pending, bad = [], 0
+    partial = b""  # start of a line the writer has not finished yet (no seeking back: stdin and pipes cannot)
+    last_flush = time.monotonic()
+
+    def commit():
+        nonlocal pending, last_flush
+        while pending:
+            try:
+                ingestor.add(pending)
+                pending = []
+            except BufferFull:
+                time.sleep(poll)
+        ingestor.flush()
+        last_flush = time.monotonic()
+        if offset_path:
+            with open(offset_path, "w") as o:
+                o.write(str(done))
+
+    def take(line):
+        nonlocal bad, done
+        rows, errors = parse_ndjson([line], resolve)
+        pending.extend(rows)
+        bad += len(errors)
+        done += len(line)
+
+    try:
+        while True:
+            line = f.readline()
+            if line:
+                line, partial = partial + line, b""
+                if line.endswith(b"\n"):
+                    take(line)
+                    if len(pending) >= ingestor.batch_rows:
+                        commit()
+                    continue
+                partial = line  # completed by a later read
+            if pending or time.monotonic() - last_flush >= ingestor.flush_s:
+                commit()
+            if not follow:
+                if partial:
+                    take(partial)  # not following: an unterminated last line is complete (flushed below)
+                break
+            time.sleep(poll)
+    finally:
+        if pending:
+            commit()
+        if f is not sys.stdin.buffer:
+            f.close()
+    return bad
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Ingest NDJSON usage records into usage_history")
+    p.add_argument("path", help="NDJSON file ('-' for stdin)")
+    p.add_argument("--db", default="csp.db")
+    p.add_argument("--follow", action="store_true", help="keep tailing the file for new lines")
+    p.add_argument("--batch", type=int, default=BATCH_ROWS)
+    args = p.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    db_init.ensure_schema(conn)
+    ing = Ingestor(args.db, batch_rows=args.batch)
+    t0 = time.time()
+    try:
+        bad = tail(args.path, ing, follow=args.follow, resolve=lambda msisdns: lookup_msisdns(conn, msisdns))
+    except KeyboardInterrupt:
+        bad = 0
+    finally:
+        conn.close()
+    s = ing.stats()
+    secs = time.time() - t0
+    print(f"written {s['written']} rows in {s['batches']} batches, {bad} bad lines, "
+          f"{s['written'] / secs if secs else 0:.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,149 @@
+# kselect.py
+# Automatic choice of K for KMeans segmentation.
+# Every candidate K is fitted on a random subsample in its own worker process and
+# scored with inertia (for the elbow) and a silhouette score computed on a
+# smaller sample, so the cost stays sub-quadratic in the number of customers.
+# Workers are spawned, not forked: select_k runs inside the threaded server and its
+# pre-fork workers, where a forked child could inherit locks held by other threads.
+
+import os
+import math
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from simple_kmeans import kmeans, kmeans_numpy
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FIT_SAMPLE = 20000 if np is not None else 3000
+SCORE_SAMPLE = 2000 if np is not None else 400
+
+
+def _distance2(a, b):
+    return sum((x - y) ** 2 for x, y in zip(a, b))
+
+
+def inertia(points, labels, centroids):
+    """Sum of squared distances from each point to its centroid."""
+    if np is not None:
+        X = np.asarray(points, dtype=np.float32)
+        C = np.asarray(centroids, dtype=np.float32)
+        return float(((X - C[np.asarray(labels)]) ** 2).sum())
+    return sum(_distance2(p, centroids[lbl]) for p, lbl in zip(points, labels))
+
+
+def silhouette(points, labels):
+    """Mean silhouette coefficient over all given points (O(n^2); call on a sample)."""
+    n = len(labels)
+    if n < 2 or len(set(int(l) for l in labels)) < 2:
+        return 0.0
+    if np is not None:
+        X = np.asarray(points, dtype=np.float64)
+        L = np.asarray(labels)
+        sq = (X * X).sum(axis=1)
+        D = np.sqrt(np.maximum(sq[:, None] - 2.0 * (X @ X.T) + sq[None, :], 0.0))
+        uniq = np.unique(L)
+        # mean distance from every point to every cluster
+        per = np.stack([D[:, L == c].sum(axis=1) for c in uniq], axis=1)
+        sizes = np.array([(L == c).sum() for c in uniq], dtype=np.float64)
+        own = np.searchsorted(uniq, L)
+        own_size = sizes[own]
+        a = per[np.arange(n), own] / np.maximum(own_size - 1, 1)
+        other = per / sizes[None, :]
+        other[np.arange(n), own] = np.inf
+        b = other.min(axis=1)
+        s = np.where(own_size > 1, (b - a) / np.maximum(np.maximum(a, b), 1e-12), 0.0)
+        return float(s.mean())
+
+    total = 0.0
+    for i in range(n):
+        sums = {}
+        sizes = {}
+        for j in range(n):
+            if i == j:
+                continue
+            d = math.sqrt(_distance2(points[i], points[j]))
+            sums[labels[j]] = sums.get(labels[j], 0.0) + d
+            sizes[labels[j]] = sizes.get(labels[j], 0) + 1
+        own = labels[i]
+        if own not in sizes:
+            continue  # singleton cluster scores 0
+        a = sums[own] / sizes[own]
+        b = min(sums[c] / sizes[c] for c in sums if c != own)
+        total += (b - a) / max(a, b, 1e-12)
+    return total / n
+
+
+def _evaluate(args):
+    points, k, seed, score_sample = args
+    if np is not None:
+        labels, centroids = kmeans_numpy(points, k=k, max_iter=100, seed=seed)
+    else:
+        labels, centroids = kmeans(points, k=k, max_iter=100, seed=seed)
+    rnd = random.Random(seed)
+    idx = rnd.sample(range(len(labels)), min(score_sample, len(labels)))
+    sample_pts = [points[i] for i in idx]
+    sample_lbl = [int(labels[i]) for i in idx]
+    return {
+        "k": k,
+        "inertia": round(inertia(points, labels, centroids), 4),
+        "silhouette": round(silhouette(sample_pts, sample_lbl), 4),
+    }
+
+
+def _elbow(curve):
+    """K whose (k, inertia) point lies farthest below the chord joining the ends of the curve."""
+    if len(curve) < 3:
+        return curve[0]["k"] if curve else None
+    x0, y0 = curve[0]["k"], curve[0]["inertia"]
+    x1, y1 = curve[-1]["k"], curve[-1]["inertia"]
+    span_y = (y0 - y1) or 1.0
+    best, best_d = curve[0]["k"], -1.0
+    for c in curve:
+        # normalize both axes so the distance is scale free
+        xn = (c["k"] - x0) / ((x1 - x0) or 1)
+        yn = (y0 - c["inertia"]) / span_y
+        d = yn - xn
+        if d > best_d:
+            best, best_d = c["k"], d
+    return best
+
+
+def select_k(points, k_min=2, k_max=10, fit_sample=FIT_SAMPLE, score_sample=SCORE_SAMPLE, workers=None, seed=0):
+    """Evaluate K in [k_min, k_max] in parallel and pick the best silhouette.
+
+    points: normalized feature rows (list of lists or ndarray).
+    returns: {"k", "elbow_k", "curve": [{"k", "inertia", "silhouette"}], "fit_sample", "score_sample"}
+    """
+    n = len(points)
+    k_max = max(k_min, min(k_max, n - 1))
+    rnd = random.Random(seed)
+    if n > fit_sample:
+        idx = sorted(rnd.sample(range(n), fit_sample))
+        sample = points[idx] if np is not None and hasattr(points, "shape") else [points[i] for i in idx]
+    else:
+        sample = points
+    if np is not None:
+        sample = np.ascontiguousarray(sample, dtype=np.float32)
+
+    jobs = [(sample, k, seed, score_sample) for k in range(k_min, k_max + 1)]
+    workers = workers or min(len(jobs), os.cpu_count() or 1)
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            curve = list(ex.map(_evaluate, jobs))
+    else:
+        curve = [_evaluate(j) for j in jobs]
+
+    # highest silhouette wins; ties go to the smaller K
+    best = max(curve, key=lambda c: (c["silhouette"], -c["k"]))
+    return {
+        "k": best["k"],
+        "elbow_k": _elbow(curve),
+        "curve": curve,
+        "fit_sample": len(sample),
+        "score_sample": min(score_sample, len(sample)),
+    }
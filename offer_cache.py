@@ -0,0 +1,113 @@
+# offer_cache.py
+# In-process LRU + TTL cache of ranked offer lists per customer.
+# Entries are stamped with the offer catalogue version (data_versions 'offers')
+# and the active segmentation run, so uploads and new runs invalidate lazily.
+# Writers in the server call invalidate() for the customers they touch (write-through):
+# the customer CSV upload and usage ingest flushes. The TTL bounds staleness from
+# out-of-process writers (ingest.py, db_init bulk loads, direct SQL).
+# Under pre-fork workers share() moves per-customer versions into shared memory:
+# invalidate() bumps the customer's version, callers add version() to the stamp,
+# so a write in one worker retires the entries every other worker holds.
+
+import os
+import mmap
+import time
+import threading
+from collections import OrderedDict
+
+DEFAULT_SIZE = int(os.environ.get("CSP_OFFER_CACHE_SIZE", "100000"))
+DEFAULT_TTL = float(os.environ.get("CSP_OFFER_CACHE_TTL", "300"))
+VERSION_SLOTS = int(os.environ.get("CSP_OFFER_CACHE_SLOTS", "65536"))
+
+
+class OfferCache:
+    def __init__(self, capacity=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # customer_id -> (stamp, expires_at, value)
+        self._catalogue = (None, None)  # (stamp, compiled catalogue)
+        self._versions = None  # shared per-customer versions, see share()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, customer_id, stamp):
+        """Cached ranking for customer_id if it was computed under the same stamp and is fresh."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is None or entry[0] != stamp or entry[1] < now:
+                if entry is not None:
+                    del self._entries[customer_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(customer_id)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, customer_id, stamp, value):
+        with self._lock:
+            self._entries[customer_id] = (stamp, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(customer_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def share(self, slots=VERSION_SLOTS):
+        """Keep per-customer versions in anonymous shared memory; call before forking workers.
+
+        Customers hash onto `slots` counters, so a write also retires the entries of the
+        few customers sharing its slot.
+        """
+        self._versions = memoryview(mmap.mmap(-1, slots * 8)).cast("Q")
+
+    def version(self, customer_id):
+        """Shared version of customer_id (0 when not shared); part of the caller's stamp."""
+        v = self._versions
+        return 0 if v is None else v[customer_id % len(v)]
+
+    def invalidate(self, *customer_ids):
+        v = self._versions
+        with self._lock:
+            for cid in customer_ids:
+                if v is not None:
+                    # unlocked across processes: a racing bump may be lost, but the value still moves
+                    slot = cid % len(v)
+                    v[slot] = (v[slot] + 1) & 0xFFFFFFFFFFFFFFFF
+                if self._entries.pop(cid, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._catalogue = (None, None)
+
+    def catalogue(self, stamp, build):
+        """Compiled offer catalogue for stamp, rebuilt via build() when the stamp moves."""
+        with self._lock:
+            if self._catalogue[0] == stamp:
+                return self._catalogue[1]
+        compiled = build()
+        with self._lock:
+            self._catalogue = (stamp, compiled)
+        return compiled
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+CACHE = OfferCache()
@@ -0,0 +1,148 @@
+# replica.py
+# Where heavy analytical reads (segment runs, exports, segment stats) go, so
+# they never hold locks that interactive writes (assignments, uploads) wait on.
+#
+# CSP_READ_MODE:
+#   primary   read the live database (original behaviour)
+#   wal       switch the live database to WAL; readers get a read-only connection
+#             pinned to one read transaction, which writers never wait for
+#   snapshot  read a copy refreshed in the background with the backup API when it
+#             is older than CSP_SNAPSHOT_MAX_AGE seconds or the app marked it stale;
+#             the primary is put in WAL so the copy never blocks writers
+
+import os
+import time
+import sqlite3
+import threading
+
+READ_MODE = os.environ.get("CSP_READ_MODE", "primary")
+MAX_AGE = float(os.environ.get("CSP_SNAPSHOT_MAX_AGE", "30"))
+MODES = ("primary", "wal", "snapshot")
+STEP_PAGES = 1024  # backup pages per step when the primary cannot use WAL
+STEP_SLEEP = 0.005
+
+_lock = threading.Lock()
+_refreshing = set()
+_dirty = {}  # db -> changes marked by the app
+_clean = {}  # db -> _dirty value the current snapshot was taken at
+_wal_ready = set()
+
+
+def snapshot_path(db):
+    return db + ".read"
+
+
+def enable_wal(db):
+    """Put db in WAL mode (persistent on the file). Returns the journal mode now in effect."""
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def refresh(db):
+    """Copy db into its read snapshot: backup into a temp file, then rename over the old copy.
+
+    The primary is switched to WAL first, so the copy's read transaction never blocks writers.
+    Where WAL is unavailable, pages are copied STEP_PAGES at a time with a pause in between, so
+    writers get the lock between steps. Readers of the previous snapshot keep it until they close.
+    """
+    path = snapshot_path(db)
+    tmp = path + ".tmp"
+    wal = enable_wal(db) == "wal"
+    with _lock:
+        gen = _dirty.get(db, 0)
+    src = sqlite3.connect(db, timeout=30)
+    dst = sqlite3.connect(tmp)
+    try:
+        if wal:
+            src.backup(dst)
+        else:
+            src.backup(dst, pages=STEP_PAGES, sleep=STEP_SLEEP)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, path)
+    with _lock:
+        _clean[db] = gen
+    return path
+
+
+def _stale(db):
+    with _lock:
+        return _dirty.get(db, 0) != _clean.get(db, 0)
+
+
+def _refresh_async(db):
+    with _lock:
+        if db in _refreshing:
+            return
+        _refreshing.add(db)
+
+    def work():
+        try:
+            refresh(db)
+            while _stale(db):  # marked again while copying
+                refresh(db)
+        finally:
+            with _lock:
+                _refreshing.discard(db)
+
+    threading.Thread(target=work, name="snapshot-refresh", daemon=True).start()
+
+
+def mark_stale(db):
+    """Refresh the snapshot in the background (after the app itself changed analytical data).
+
+    Readers keep the previous copy until the new one is renamed into place.
+    """
+    with _lock:
+        _dirty[db] = _dirty.get(db, 0) + 1
+    if READ_MODE == "snapshot" or os.path.exists(snapshot_path(db)):
+        _refresh_async(db)
+
+
+def snapshot_age(db):
+    path = snapshot_path(db)
+    return time.time() - os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def get_read_db(db, mode=None):
+    """Connection for analytical reads under the configured read mode (sqlite3.Row rows)."""
+    mode = mode or READ_MODE
+    if mode not in MODES:
+        raise ValueError(f"unknown read mode: {mode}")
+    if mode == "snapshot":
+        age = snapshot_age(db)
+        if age is None or age > MAX_AGE or _stale(db):
+            # never copy inside a request: serve the current copy while a fresh one is made
+            _refresh_async(db)
+        if age is None:
+            # no copy yet: a read transaction on the (now WAL) primary until the first one lands
+            mode = "wal"
+        else:
+            conn = sqlite3.connect(f"file:{snapshot_path(db)}?mode=ro", uri=True)
+    if mode == "wal":
+        if db not in _wal_ready:
+            enable_wal(db)
+            _wal_ready.add(db)
+        conn = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+        # one read transaction: every query sees the same snapshot, writers carry on
+        conn.isolation_level = None
+        conn.execute("BEGIN")
+    elif mode == "primary":
+        conn = sqlite3.connect(db)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def info(db, mode=None):
+    """Read mode in effect, plus the snapshot's age in snapshot mode (GET /api/read/stats)."""
+    mode = mode or READ_MODE
+    out = {"mode": mode}
+    if mode == "snapshot":
+        age = snapshot_age(db)
+        out["snapshot_age_s"] = round(age, 1) if age is not None else None
+        out["max_age_s"] = MAX_AGE
+    return out
@@ -0,0 +1,443 @@
+# scoring.py
+# Offer eligibility + scoring for single customers and whole batches.
+# Each offer carries a weight vector over customer features (offers.score_weights,
+# JSON like {"avg_data_mb": 0.001, "income_high": 10, "segment:3": 2}). A batch is
+# scored as one matrix product customers x offers, ineligible pairs are masked out,
+# and the top-K per customer is picked with a partition (NumPy) or a heap.
+# Offline: python scoring.py --top-k 3 --out ranked.csv
+
+import sys
+import csv
+import json
+import heapq
+import sqlite3
+import argparse
+from array import array
+
+import db_init
+import capping
+import customer_table
+import usage_store
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# customer feature columns available to weight vectors ("segment:<id>" adds one-hot columns)
+FEATURES = ["bias", "avg_data_mb", "avg_call_mins", "avg_sms", "avg_app_usage", "churn_risk_score",
+            "income_low", "income_medium", "income_high"]
+AGG_FEATURES = ["avg_data_mb", "avg_call_mins", "avg_sms", "avg_app_usage"]
+
+# eligibility_simple keys that compare against a customer attribute
+MATCH_KEYS = ["income_bracket", "preferred_app", "region", "city", "device_brand"]
+
+BATCH_SQL = """
+    SELECT c.id,
+           COALESCE((SELECT p.income_bracket FROM customer_profile p WHERE p.customer_id = c.id LIMIT 1),
+                    c.income_bracket) AS income_bracket,
+           c.preferred_app, c.region, c.city, c.device_brand, c.churn_risk_score,
+           u.avg_data_mb, u.avg_call_mins, u.avg_sms, u.avg_app_usage,
+           m.segment_id
+    FROM customers c
+    LEFT JOIN ({usage}) u ON u.customer_id = c.id
+    LEFT JOIN customer_segment_map m
+      -- unary + keeps the planner on the customer_id index instead of scanning the whole run
+      ON m.customer_id = c.id AND +m.run_id = (SELECT run_id FROM active_segment_run WHERE id = 1)
+    {where}
+    ORDER BY c.id
+"""
+
+# running sums maintained by ingest.py (one indexed row per customer)
+USAGE_AGG = """
+    SELECT customer_id, sum_data_mb / rows AS avg_data_mb, sum_call_mins / rows AS avg_call_mins,
+           sum_sms / rows AS avg_sms, sum_app_usage / rows AS avg_app_usage
+    FROM usage_aggregates WHERE rows > 0 {filter}
+"""
+
+# fallback for databases whose usage_aggregates table has not been filled
+USAGE_ALL = """
+    SELECT customer_id, AVG(data_mb) AS avg_data_mb, AVG(call_minutes) AS avg_call_mins,
+           AVG(sms_count) AS avg_sms, AVG(app_usage_score) AS avg_app_usage
+    FROM usage_history WHERE 1 {filter} GROUP BY customer_id
+"""
+
+# usage aggregates come from usage_store instead (CSP_USAGE_BACKEND=columnar)
+USAGE_NONE = """
+    SELECT NULL AS customer_id, NULL AS avg_data_mb, NULL AS avg_call_mins,
+           NULL AS avg_sms, NULL AS avg_app_usage
+    WHERE 0
+"""
+
+CHUNK = 900  # stay under SQLite's bound-parameter limit
+
+
+# ---------------------------------------------------------------------
+# OFFER CATALOGUE
+# ---------------------------------------------------------------------
+
+def parse_eligibility(elig):
+    """Split eligibility_simple ("k=v,k=v") into [(key, value)]; non k=v parts are ignored."""
+    conds = []
+    for part in (elig or "").split(","):
+        part = part.strip()
+        if "=" in part:
+            k, v = part.split("=", 1)
+            conds.append((k.strip(), v.strip()))
+    return conds
+
+
+def default_weights(elig):
+    """Weights reproducing the original rule-based score for offers without score_weights."""
+    w = {}
+    if "min_avg_data_mb" in (elig or ""):
+        w["avg_data_mb"] = 0.001
+    if "income_bracket=high" in (elig or ""):
+        w["income_high"] = 10.0
+    return w
+
+
+def parse_weights(raw, elig):
+    if not raw:
+        return default_weights(elig)
+    try:
+        w = json.loads(raw)
+    except ValueError:
+        return default_weights(elig)
+    return {str(k): float(v) for k, v in w.items()} if isinstance(w, dict) else default_weights(elig)
+
+
+def compile_offers(conn):
+    """Load active offers once into a scoring catalogue.
+
+    Returns {"offers": [{id, code, title}], "conds": [[(k, v)]], "features": [...],
+             "weights": matrix offers x features, "caps": {offer_id: (count, days)}}.
+    """
+    rows = conn.execute(
+        "SELECT id, code, title, eligibility_simple, score_weights, cap_count, cap_window_days "
+        "FROM offers WHERE active=1 ORDER BY id"
+    ).fetchall()
+    weights = [parse_weights(r[4], r[3]) for r in rows]
+    seg_feats = sorted({f for w in weights for f in w if f.startswith("segment:")})
+    feats = FEATURES + seg_feats
+    index = {f: i for i, f in enumerate(feats)}
+    W = [[0.0] * len(feats) for _ in rows]
+    for j, w in enumerate(weights):
+        for f, v in w.items():
+            if f in index:
+                W[j][index[f]] = v
+    return {
+        "offers": [{"offer_id": r[0], "code": r[1], "title": r[2]} for r in rows],
+        "conds": [parse_eligibility(r[3]) for r in rows],
+        "features": feats,
+        "weights": np.asarray(W, dtype=np.float64).reshape(len(rows), len(feats)) if np is not None else W,
+        "caps": {r[0]: capping.rule(r[5], r[6]) for r in rows if capping.rule(r[5], r[6])},
+    }
+
+
+def catalogue_parts(catalogue):
+    """(arrays, meta) of a compiled catalogue for shared_features.publish."""
+    W = catalogue["weights"]
+    flat = W.ravel() if np is not None else array("d", [v for row in W for v in row])
+    meta = {k: catalogue[k] for k in ("offers", "conds", "features")}
+    meta["caps"] = [[oid, count, days] for oid, (count, days) in catalogue["caps"].items()]
+    return {"weights": flat}, meta
+
+
+def catalogue_from_parts(arrays, meta):
+    """Inverse of catalogue_parts; the weight matrix stays a view over arrays["weights"]."""
+    m, f = len(meta["offers"]), len(meta["features"])
+    flat = arrays["weights"]
+    return {
+        "offers": meta["offers"],
+        "conds": [[tuple(c) for c in conds] for conds in meta["conds"]],
+        "features": meta["features"],
+        "weights": flat.reshape(m, f) if np is not None else [flat[j * f:(j + 1) * f].tolist() for j in range(m)],
+        "caps": {oid: (count, days) for oid, count, days in meta["caps"]},
+    }
+
+
+# ---------------------------------------------------------------------
+# CUSTOMER BATCH
+# ---------------------------------------------------------------------
+
+def usage_sql(conn):
+    """Per-customer usage averages query: usage_aggregates when populated, else usage_history."""
+    if conn.execute("SELECT 1 FROM usage_aggregates LIMIT 1").fetchone() is not None:
+        return USAGE_AGG
+    return USAGE_ALL
+
+
+def load_batch(conn, customer_ids=None):
+    """Customer attributes, usage aggregates and active segment for a batch (all customers if None).
+
+    Returns a column dict: {"id": [...], "income_bracket": [...], ..., "avg_data_mb": [...], "segment_id": [...]}.
+    The full-base batch instead carries the shared customer_table.CustomerTable under "table"
+    in place of the attribute lists.
+    """
+    if customer_ids is None:
+        return _load_all(conn)
+    cols = ["id"] + MATCH_KEYS + ["churn_risk_score"] + AGG_FEATURES + ["segment_id"]
+    columnar = usage_store.enabled()
+    usage = USAGE_NONE if columnar else usage_sql(conn)
+    rows = []
+    ids = list(dict.fromkeys(int(c) for c in customer_ids))
+    for i in range(0, len(ids), CHUNK):
+        part = ids[i:i + CHUNK]
+        marks = ",".join("?" * len(part))
+        where = f"WHERE c.id IN ({marks})"
+        if columnar:
+            rows += conn.execute(BATCH_SQL.format(usage=USAGE_NONE, where=where), part).fetchall()
+        else:
+            sub = usage.format(filter=f"AND customer_id IN ({marks})")
+            rows += conn.execute(BATCH_SQL.format(usage=sub, where=where), part + part).fetchall()
+    batch = {c: [r[i] for r in rows] for i, c in enumerate(cols)}
+    if columnar:
+        u_ids, usage = usage_store.aggregate(customer_ids=batch["id"])
+        by_id = dict(zip(u_ids, usage))
+        for j, c in enumerate(AGG_FEATURES):
+            batch[c] = [by_id[cid][j] if cid in by_id else None for cid in batch["id"]]
+    for c in AGG_FEATURES + ["churn_risk_score"]:
+        batch[c] = [float(v or 0) for v in batch[c]]
+    return batch
+
+
+def _load_all(conn):
+    # every customer: attributes from the compact table, usage and segment joined by position
+    table = customer_table.get(conn)
+    n = len(table)
+    batch = {"id": table.ids.tolist(), "table": table, "churn_risk_score": table.numbers("churn_risk_score")}
+    if usage_store.enabled():
+        u_ids, usage = usage_store.aggregate()
+    else:
+        got = conn.execute(usage_sql(conn).format(filter="")).fetchall()
+        u_ids, usage = [r[0] for r in got], [r[1:] for r in got]
+    aggs = [[0.0] * n for _ in AGG_FEATURES]
+    for p, row in zip(table.lookup(u_ids), usage):
+        if p >= 0:
+            for col, v in zip(aggs, row):
+                col[p] = float(v or 0)
+    batch.update(zip(AGG_FEATURES, aggs))
+    seg = [None] * n
+    mapped = conn.execute(
+        "SELECT customer_id, segment_id FROM customer_segment_map "
+        "WHERE run_id = (SELECT run_id FROM active_segment_run WHERE id = 1)"
+    ).fetchall()
+    for p, (_, sid) in zip(table.lookup([r[0] for r in mapped]), mapped):
+        if p >= 0:
+            seg[p] = sid
+    batch["segment_id"] = seg
+    return batch
+
+
+def feature_matrix(batch, feats):
+    """Customers x features matrix in catalogue feature order."""
+    n = len(batch["id"])
+    cols = {"bias": [1.0] * n}
+    table = batch.get("table")
+    for level in ("low", "medium", "high"):
+        if table is not None:
+            cols[f"income_{level}"] = table.mapped("effective_income", lambda v: 1.0 if v == level else 0.0)
+        else:
+            cols[f"income_{level}"] = [1.0 if v == level else 0.0 for v in batch["income_bracket"]]
+    for f in AGG_FEATURES + ["churn_risk_score"]:
+        cols[f] = batch[f]
+    for f in feats:
+        if f.startswith("segment:"):
+            sid = f.split(":", 1)[1]
+            cols[f] = [1.0 if str(s) == sid else 0.0 for s in batch["segment_id"]]
+    if np is not None:
+        return np.column_stack([np.asarray(cols[f], dtype=np.float64) for f in feats]) if n else np.zeros((0, len(feats)))
+    return [list(r) for r in zip(*[cols[f] for f in feats])]
+
+
+def _attr(batch, key):
+    vals = batch[key]
+    # income is compared as-is (the profile value wins); other attributes are stripped
+    return [v for v in vals] if key == "income_bracket" else [(v or "").strip() for v in vals]
+
+
+def _code_matcher(table):
+    # (key, value) -> codes of the table column that satisfy key=value, computed once per pair
+    memo = {}
+
+    def codes(key, value):
+        if (key, value) not in memo:
+            if key == "income_bracket":
+                memo[key, value] = table.matching_codes("effective_income", lambda v: v == value)
+            else:
+                memo[key, value] = table.matching_codes(key, lambda v: (v or "").strip() == value)
+        return memo[key, value]
+
+    return codes
+
+
+def eligibility_mask(batch, catalogue):
+    """customers x offers booleans following the eligibility_simple rules."""
+    n, m = len(batch["id"]), len(catalogue["offers"])
+    table = batch.get("table")
+    if table is not None:
+        return _table_mask(batch, catalogue, table)
+    attrs = {k: _attr(batch, k) for k in MATCH_KEYS}
+    if np is not None:
+        mask = np.ones((n, m), dtype=bool)
+        arr = {k: np.asarray(v, dtype=object) for k, v in attrs.items()}
+        data = np.asarray(batch["avg_data_mb"], dtype=np.float64)
+        for j, conds in enumerate(catalogue["conds"]):
+            for k, v in conds:
+                if k in arr:
+                    mask[:, j] &= arr[k] == v
+                elif k == "min_avg_data_mb":
+                    try:
+                        mask[:, j] &= data >= float(v)
+                    except ValueError:
+                        mask[:, j] = False
+        return mask
+    mask = [[True] * m for _ in range(n)]
+    for j, conds in enumerate(catalogue["conds"]):
+        for k, v in conds:
+            if k in attrs:
+                col = attrs[k]
+                for i in range(n):
+                    if col[i] != v:
+                        mask[i][j] = False
+            elif k == "min_avg_data_mb":
+                try:
+                    thr = float(v)
+                except ValueError:
+                    thr = None
+                for i in range(n):
+                    if thr is None or batch["avg_data_mb"][i] < thr:
+                        mask[i][j] = False
+    return mask
+
+
+def _table_mask(batch, catalogue, table):
+    # same rules as eligibility_mask, compared on dictionary codes instead of strings
+    n, m = len(batch["id"]), len(catalogue["offers"])
+    codes = _code_matcher(table)
+    col = {k: table.codes["effective_income" if k == "income_bracket" else k] for k in MATCH_KEYS}
+    if np is not None:
+        mask = np.ones((n, m), dtype=bool)
+        data = np.asarray(batch["avg_data_mb"], dtype=np.float64)
+        for j, conds in enumerate(catalogue["conds"]):
+            for k, v in conds:
+                if k in col:
+                    mask[:, j] &= np.isin(col[k], codes(k, v))
+                elif k == "min_avg_data_mb":
+                    try:
+                        mask[:, j] &= data >= float(v)
+                    except ValueError:
+                        mask[:, j] = False
+        return mask
+    mask = [[True] * m for _ in range(n)]
+    for j, conds in enumerate(catalogue["conds"]):
+        for k, v in conds:
+            if k in col:
+                ok, c = set(codes(k, v)), col[k]
+                for i in range(n):
+                    if c[i] not in ok:
+                        mask[i][j] = False
+            elif k == "min_avg_data_mb":
+                try:
+                    thr = float(v)
+                except ValueError:
+                    thr = None
+                for i in range(n):
+                    if thr is None or batch["avg_data_mb"][i] < thr:
+                        mask[i][j] = False
+    return mask
+
+
+def rank(batch, catalogue, top_k=None, exclude=None, mask=None):
+    """Score a batch and return, per customer, [(offer_index, score)] best first.
+
+    top_k=None keeps every eligible offer. Ties keep catalogue (offer id) order.
+    exclude: (customer_id, offer_id) pairs to drop, e.g. capping.blocked_pairs().
+    mask: a precomputed eligibility_mask() for this batch (modified in place by exclude).
+    """
+    n, m = len(batch["id"]), len(catalogue["offers"])
+    if n == 0 or m == 0:
+        return [[] for _ in range(n)]
+    X = feature_matrix(batch, catalogue["features"])
+    mask = eligibility_mask(batch, catalogue) if mask is None else mask
+    if exclude:
+        row = {cid: i for i, cid in enumerate(batch["id"])}
+        col = {o["offer_id"]: j for j, o in enumerate(catalogue["offers"])}
+        for cid, oid in exclude:
+            if cid in row and oid in col:
+                mask[row[cid]][col[oid]] = False
+    k = m if top_k is None else max(1, min(int(top_k), m))
+
+    if np is not None:
+        S = X @ catalogue["weights"].T
+        S = np.where(mask, S, -np.inf)
+        # keep the k best per row without sorting the row: everything above the k-th largest
+        # score, then the offers tied with it in catalogue order until k are kept
+        kth = np.partition(S, m - k, axis=1)[:, m - k:m - k + 1]
+        above = S > kth
+        tied = S == kth
+        keep = above | (tied & (np.cumsum(tied, axis=1, dtype=np.int32) <= k - above.sum(axis=1, keepdims=True)))
+        idx = np.nonzero(keep)[1].reshape(n, k)  # ascending offer index within each row
+        top = np.take_along_axis(S, idx, axis=1)
+        # only the k survivors are sorted; stable on -score, so ties keep catalogue order
+        order = np.argsort(-top, axis=1, kind="stable")
+        idx = np.take_along_axis(idx, order, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        ninf = float("-inf")
+        return [
+            [(j, s) for j, s in zip(ir, tr) if s != ninf]
+            for ir, tr in zip(idx.tolist(), top.tolist())
+        ]
+
+    W = catalogue["weights"]
+    out = []
+    for i in range(n):
+        x = X[i]
+        cand = ((-sum(a * b for a, b in zip(x, W[j])), j) for j in range(m) if mask[i][j])
+        out.append([(j, -s) for s, j in heapq.nsmallest(k, cand)])
+    return out
+
+
+def results(batch, catalogue, ranked):
+    """Shape rank() output as API rows: [{"customer_id", "offers": [{offer_id, code, title, score}]}]."""
+    offers = catalogue["offers"]
+    return [
+        {
+            "customer_id": cid,
+            "offers": [dict(offers[j], score=round(s, 2)) for j, s in r],
+        }
+        for cid, r in zip(batch["id"], ranked)
+    ]
+
+
+# ---------------------------------------------------------------------
+# OFFLINE CAMPAIGN SCORING
+# ---------------------------------------------------------------------
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Score every customer against the active offer catalogue")
+    p.add_argument("--db", default="csp.db")
+    p.add_argument("--top-k", type=int, default=3)
+    p.add_argument("--out", default="-", help="CSV output path ('-' for stdout)")
+    args = p.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    db_init.ensure_schema(conn)
+    catalogue = compile_offers(conn)
+    batch = load_batch(conn)
+    ranked = rank(batch, catalogue, top_k=args.top_k, exclude=capping.blocked_pairs(conn, catalogue["caps"]))
+    conn.close()
+
+    f = sys.stdout if args.out == "-" else open(args.out, "w", newline="", encoding="utf-8")
+    w = csv.writer(f)
+    w.writerow(["customer_id", "rank", "offer_code", "score"])
+    for cid, r in zip(batch["id"], ranked):
+        for pos, (j, s) in enumerate(r, start=1):
+            w.writerow([cid, pos, catalogue["offers"][j]["code"], round(s, 4)])
+    if f is not sys.stdout:
+        f.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,337 @@
+# scripts/bench.py
+# Reproducible benchmark suite for the CSP server.
+# Generates deterministic synthetic customers, usage history and offers at
+# configurable scale, then times the main API paths in-process against server.app.
+# Run: python scripts/bench.py --scales 10000,100000,1000000 --out bench.json
+
+import os
+import sys
+import io
+import csv
+import json
+import time
+import random
+import sqlite3
+import datetime
+import argparse
+import platform
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import db_init  # noqa: E402
+
+# value pools mirror customers_1000_v2.csv so synthetic data looks like the real extract
+FIRST_NAMES = ["Harish", "Naveen", "Priya", "Anjali", "Rahul", "Sneha", "Arjun", "Kavya", "Vikram", "Divya",
+               "Suresh", "Meera", "Karthik", "Pooja", "Rohan", "Lakshmi", "Amit", "Neha", "Sanjay", "Deepa"]
+LAST_INITIALS = list("ABCDEGHIJKLMNPRSTV")
+REGION_CITIES = {
+    "North": ["Delhi", "Chandigarh", "Jaipur", "Lucknow"],
+    "South": ["Chennai", "Bengaluru", "Hyderabad", "Coimbatore"],
+    "East": ["Kolkata", "Patna", "Ranchi", "Bhubaneswar"],
+    "West": ["Mumbai", "Pune", "Ahmedabad", "Surat"],
+}
+OCCUPATIONS = ["Teacher", "Sales Executive", "Manager", "Student", "Consultant", "Designer", "Engineer", "Doctor"]
+INCOME = ["low", "medium", "high"]
+DEVICES = {
+    "Samsung": ["Galaxy A34", "Galaxy S21", "Galaxy S22", "A52"],
+    "Xiaomi": ["Mi 11", "Redmi 10", "Redmi 12"],
+    "Realme": ["8 Pro", "9i", "9 Pro"],
+    "OnePlus": ["8T", "Nord 2", "9 Pro"],
+    "Apple": ["iPhone 11", "iPhone 12", "iPhone 13", "iPhone 14", "iPhone 15"],
+}
+HOBBIES = ["Reading", "Browsing", "Social Media", "Travel", "Music", "Streaming", "Gaming"]
+APPS = ["YouTube", "PUBG", "Netflix", "Instagram", "Chrome"]
+LEVELS = ["Low", "Medium", "High"]
+ELIGIBILITY = ["", "income_bracket=high", "income_bracket=low", "preferred_app=YouTube", "preferred_app=PUBG",
+               "preferred_app=Instagram", "region=South", "region=North", "device_brand=Apple",
+               "min_avg_data_mb=1500", "min_avg_data_mb=3000", "city=Mumbai", "income_bracket=medium,region=West"]
+
+CUSTOMER_COLUMNS = db_init.CUSTOMER_COLUMNS
+BATCH = db_init.BATCH
+
+
+# ---------------------------------------------------------------------
+# SYNTHETIC DATA
+# ---------------------------------------------------------------------
+
+def synth_customers(n, seed=0, msisdn_base=9900000000):
+    """Yield n deterministic customer tuples in CUSTOMER_COLUMNS order."""
+    rng = random.Random(seed)
+    regions = sorted(REGION_CITIES)
+    brands = sorted(DEVICES)
+    for i in range(n):
+        region = rng.choice(regions)
+        brand = rng.choice(brands)
+        yield (
+            str(msisdn_base + i),
+            f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_INITIALS)}",
+            rng.randint(18, 70),
+            rng.choice("MF"),
+            region,
+            rng.choice(REGION_CITIES[region]),
+            rng.choice(OCCUPATIONS),
+            rng.choice(["Single", "Married"]),
+            rng.choice(INCOME),
+            brand,
+            rng.choice(DEVICES[brand]),
+            rng.choice(HOBBIES),
+            rng.choice(APPS),
+            rng.choice(LEVELS),
+            rng.choice(LEVELS),
+            round(rng.random(), 2),
+        )
+
+
+def synth_usage(customer_ids, days, seed=0, today=None):
+    """Yield usage_history tuples, `days` per customer, ending at `today`."""
+    rng = random.Random(seed + 1)
+    today = today or datetime.date(2024, 1, 31)
+    dates = [(today - datetime.timedelta(days=d)).isoformat() for d in range(days)]
+    for cid in customer_ids:
+        # per-customer base level keeps averages spread out, like real usage
+        base = rng.randint(100, 5000)
+        for day in dates:
+            yield (
+                cid,
+                day,
+                float(max(0, base + rng.randint(-base // 2, base // 2))),
+                float(rng.randint(10, 200)),
+                rng.randint(0, 50),
+                float(rng.randint(1, 10)),
+            )
+
+
+def synth_offers(n, seed=0):
+    """Yield n offer tuples (code, title, description, eligibility_simple, active)."""
+    rng = random.Random(seed + 2)
+    for i in range(n):
+        elig = ELIGIBILITY[i % len(ELIGIBILITY)]
+        yield (f"BOFR{i + 1:04d}", f"Bench Offer {i + 1}", f"{rng.randint(1, 50)}GB for {rng.choice([7, 28, 84])} days",
+               elig, 1)
+
+
+def generate(db_path, customers, days=30, offers=50, seed=0):
+    """Create a fresh database at db_path filled with synthetic data using bulk inserts."""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=OFF")
+    db_init.create_schema(conn, indexes=False)
+    cur = conn.cursor()
+    for chunk in db_init._chunks(synth_customers(customers, seed)):
+        cur.executemany(
+            "INSERT INTO customers (" + ",".join(CUSTOMER_COLUMNS) + ") VALUES (" + ",".join("?" * len(CUSTOMER_COLUMNS)) + ")",
+            chunk,
+        )
+    cur.execute(
+        "INSERT INTO customer_profile (customer_id, income_bracket, email) "
+        "SELECT id, income_bracket, 'c' || msisdn || '@example.com' FROM customers"
+    )
+    ids = [r[0] for r in cur.execute("SELECT id FROM customers ORDER BY id")]
+    for chunk in db_init._chunks(synth_usage(ids, days, seed)):
+        cur.executemany(
+            "INSERT INTO usage_history (customer_id,date,data_mb,call_minutes,sms_count,app_usage_score) VALUES (?,?,?,?,?,?)",
+            chunk,
+        )
+    cur.executemany(
+        "INSERT INTO offers (code,title,description,eligibility_simple,active) VALUES (?,?,?,?,?)",
+        list(synth_offers(offers, seed)),
+    )
+    db_init.create_indexes(conn)
+    conn.commit()
+    conn.close()
+
+
+# ---------------------------------------------------------------------
+# IN-PROCESS WSGI CLIENT
+# ---------------------------------------------------------------------
+
+def call_app(app, method, path, body=None, query=""):
+    """Invoke a WSGI app directly. Returns (status_code, headers, body_bytes)."""
+    if isinstance(body, (dict, list)):
+        data = json.dumps(body).encode("utf-8")
+        ctype = "application/json"
+    elif isinstance(body, str):
+        data = body.encode("utf-8")
+        ctype = "application/x-ndjson"
+    else:
+        data = body or b""
+        ctype = "application/octet-stream"
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "bench",
+        "SERVER_PORT": "0",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "CONTENT_TYPE": ctype,
+        "CONTENT_LENGTH": str(len(data)),
+        "wsgi.input": io.BytesIO(data),
+        "wsgi.errors": sys.stderr,
+        "wsgi.url_scheme": "http",
+        "wsgi.version": (1, 0),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured["status"] = status
+        captured["headers"] = headers
+
+    out = b"".join(app(environ, start_response))
+    return int(captured["status"].split(" ", 1)[0]), captured["headers"], out
+
+
+# ---------------------------------------------------------------------
+# BENCHMARKS
+# ---------------------------------------------------------------------
+
+def _timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {"repeat": repeat, "min_s": round(min(times), 6), "median_s": round(statistics.median(times), 6),
+            "max_s": round(max(times), 6)}
+
+
+def _check(res):
+    status, _, out = res
+    if status >= 400:
+        raise RuntimeError(f"HTTP {status}: {out[:200]!r}")
+    return out
+
+
+def run_scale(n, args):
+    """Generate (or reuse) the dataset for n customers and time each operation."""
+    os.makedirs(args.data_dir, exist_ok=True)
+    db_path = os.path.join(args.data_dir, f"bench_{n}_d{args.days}_o{args.offers}_s{args.seed}.db")
+    work_path = db_path + ".work"
+    gen = None
+    if args.regenerate or not os.path.exists(db_path):
+        t0 = time.perf_counter()
+        generate(db_path, n, days=args.days, offers=args.offers, seed=args.seed)
+        gen = round(time.perf_counter() - t0, 3)
+    # every scale runs on a scratch copy so write paths never drift the cached dataset
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(work_path)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+    import server
+    server.DB = work_path
+    app = server.app
+
+    rng = random.Random(args.seed + n)
+    results = {"customers": n, "days": args.days, "offers": args.offers, "generate_s": gen, "ops": {}}
+    ops = results["ops"]
+    skip = set(args.skip)
+
+    if "list" not in skip:
+        ops["customers_list"] = _timed(lambda: _check(call_app(app, "GET", "/api/customers")), args.repeat)
+    if "export" not in skip:
+        ops["customers_export"] = _timed(lambda: _check(call_app(app, "GET", "/api/export/customers.csv")), args.repeat)
+    if "import" not in skip:
+        rows = min(n, args.import_rows)
+        base = [9800000000 + n * 10]
+
+        def do_import():
+            buf = io.StringIO()
+            w = csv.writer(buf)
+            w.writerow(CUSTOMER_COLUMNS)
+            w.writerows(synth_customers(rows, args.seed, msisdn_base=base[0]))
+            base[0] += rows
+            _check(call_app(app, "POST", "/api/customers/upload", {"csv": buf.getvalue()}))
+
+        ops["customers_import"] = dict(_timed(do_import, args.repeat), rows=rows)
+    if "segment" not in skip:
+        ops["segment_run"] = _timed(lambda: _check(call_app(app, "POST", "/api/segment/run")), args.repeat)
+    if "generate" not in skip:
+        sample = [rng.randint(1, n) for _ in range(args.generate_calls)]
+        # the offer cache would turn repeats into hits: single calls draw fresh customers on an empty
+        # cache, and hits are timed on their own over the customers just scored
+        server.offer_cache.CACHE.clear()
+        fresh = rng.sample(range(1, n + 1), min(n, args.generate_calls * args.repeat))
+        it = iter(fresh)
+        single = _timed(lambda: _check(call_app(app, "POST", "/api/offers/generate", {"customer_id": next(it)})),
+                        len(fresh))
+        ops["offer_generate_single"] = single
+        it = iter(fresh)
+        ops["offer_generate_cached"] = _timed(
+            lambda: _check(call_app(app, "POST", "/api/offers/generate", {"customer_id": next(it)})), len(fresh))
+
+        # every batch repeat scores customers not seen before, on an empty cache
+        batches = iter([rng.sample(range(1, n + 1), min(n, len(sample))) for _ in range(2 * args.repeat)])
+
+        def do_batch():
+            server.offer_cache.CACHE.clear()
+            for cid in next(batches):
+                _check(call_app(app, "POST", "/api/offers/generate", {"customer_id": cid}))
+
+        def do_batch_api():
+            server.offer_cache.CACHE.clear()
+            _check(call_app(app, "POST", "/api/offers/generate_batch", {"customer_ids": next(batches), "top_k": 3}))
+
+        ops["offer_generate_batch"] = dict(_timed(do_batch, args.repeat), customers=len(sample))
+        # as many customers scored in one request
+        ops["offer_generate_batch_api"] = dict(_timed(do_batch_api, args.repeat), customers=len(sample))
+    if "assignments" not in skip:
+        ops["assignments_list"] = _timed(lambda: _check(call_app(app, "GET", "/api/offer_assignments")), args.repeat)
+
+    os.remove(work_path)
+    return results
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="CSP benchmark suite")
+    p.add_argument("--scales", default="10000,100000,1000000", help="comma-separated customer counts")
+    p.add_argument("--days", type=int, default=30, help="usage_history days per customer")
+    p.add_argument("--offers", type=int, default=50)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--import-rows", type=int, default=10000, help="rows per CSV import run")
+    p.add_argument("--generate-calls", type=int, default=100, help="customers per offer generation batch")
+    p.add_argument("--skip", default="", help="comma-separated ops to skip: list,export,import,segment,generate,assignments")
+    p.add_argument("--data-dir", default=os.path.join(ROOT, "bench_data"))
+    p.add_argument("--regenerate", action="store_true", help="rebuild cached datasets")
+    p.add_argument("--out", default="bench.json")
+    args = p.parse_args(argv)
+    args.skip = [s for s in args.skip.split(",") if s]
+
+    report = {
+        "commit": _git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "started_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "data_dir")},
+        "scales": [],
+    }
+    for n in [int(s) for s in args.scales.split(",") if s]:
+        print(f"[bench] scale={n}", flush=True)
+        report["scales"].append(run_scale(n, args))
+        for op, r in report["scales"][-1]["ops"].items():
+            print(f"  {op:<24} median={r['median_s']:.4f}s", flush=True)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.out)
+
+
+if __name__ == "__main__":
+    main()
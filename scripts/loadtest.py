@@ -0,0 +1,482 @@
+# scripts/loadtest.py
+# Load generator for the CSP server: replays a request log or a synthetic traffic mix
+# (lookups, search, offer generation, assignment, CSV upload, segmentation runs) at a
+# target rate from N concurrent clients, and reports throughput, latency percentiles
+# and error rates per operation.
+#
+# In-process (default) it drives server.app through bench.call_app on a scratch copy
+# of the database; --socket starts server.py on a free port (or uses --url) and sends
+# real HTTP requests, so --workers sizing and the socket path are covered too.
+#
+# Requests are scheduled open-loop: request i is due at i / rps, and its latency is
+# counted from that moment, so a server that falls behind shows it in the percentiles.
+# Run: python scripts/loadtest.py --customers 100000 --rps 200 --clients 16 --duration 30
+#      python scripts/loadtest.py --socket --workers 4 --mix lookup=70,generate=30 --rps 0
+#      python scripts/loadtest.py --replay requests.ndjson --speed 2
+# A replayed log with timestamps keeps its own timing unless --rps is given.
+
+import os
+import re
+import sys
+import csv
+import io
+import json
+import time
+import shutil
+import random
+import socket
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.request
+from urllib.parse import urlsplit, urlencode
+
+from bench import ROOT, CUSTOMER_COLUMNS, FIRST_NAMES, REGION_CITIES, call_app, generate, synth_customers, _git_rev
+
+DEFAULT_MIX = "lookup=55,search=20,generate=15,assign=8,upload=2"
+DEFAULT_RPS = 100.0
+OPS = ["lookup", "search", "generate", "assign", "upload", "segment"]
+UPLOAD_ROWS = 20
+PERCENTILES = (50, 90, 95, 99)
+
+# common / combined log format, as written by server.py (wsgiref) and most proxies
+_CLF = re.compile(r'"(GET|POST|PUT|DELETE|PATCH) (\S+) HTTP/[\d.]+" (\d{3})')
+
+
+# ---------------------------------------------------------------------
+# TRAFFIC
+# ---------------------------------------------------------------------
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        if part.strip():
+            name, _, weight = part.partition("=")
+            name = name.strip()
+            if name not in OPS:
+                raise ValueError(f"unknown operation in mix: {name} (known: {', '.join(OPS)})")
+            mix[name] = float(weight or 1)
+    return mix
+
+
+def load_log(path):
+    """Requests from a log: NDJSON ({"method", "path", "query", "body", "t", "op"}) or access-log lines.
+
+    Access-log lines carry no bodies, so only their GET requests are replayed.
+    """
+    reqs, skipped = [], 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                r = json.loads(line)
+                r.setdefault("method", "GET")
+                r.setdefault("query", "")
+                reqs.append(r)
+                continue
+            m = _CLF.search(line)
+            if not m or m.group(1) != "GET":
+                skipped += 1
+                continue
+            target = urlsplit(m.group(2))
+            reqs.append({"method": "GET", "path": target.path, "query": target.query})
+    return reqs, skipped
+
+
+class Synthetic:
+    """Endless weighted mix of realistic requests over the customers and offers of a database."""
+
+    def __init__(self, db, mix, seed=0, sample=10000):
+        conn = sqlite3.connect(db)
+        self.customers = conn.execute(
+            "SELECT id, msisdn, name FROM customers ORDER BY random() LIMIT ?", (sample,)).fetchall()
+        self.offers = [r[0] for r in conn.execute("SELECT id FROM offers WHERE active = 1")]
+        top = conn.execute("SELECT MAX(CAST(msisdn AS INTEGER)) FROM customers").fetchone()[0] or 9700000000
+        conn.close()
+        if not self.customers:
+            raise ValueError(f"{db} has no customers to drive traffic with")
+        self.rng = random.Random(seed)
+        self.names, self.weights = zip(*mix.items())
+        self.next_msisdn = int(top) + 1_000_000
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            op = self.rng.choices(self.names, self.weights)[0]
+            return getattr(self, "_" + op)()
+
+    def _lookup(self):
+        # agent typing a number: an msisdn prefix, sometimes the whole number
+        _, msisdn, _ = self.rng.choice(self.customers)
+        q = msisdn if self.rng.random() < 0.5 else msisdn[:self.rng.randint(6, len(msisdn))]
+        return {"op": "lookup", "method": "GET", "path": "/api/customers/search", "query": urlencode({"q": q})}
+
+    def _search(self):
+        _, _, name = self.rng.choice(self.customers)
+        first = (name or self.rng.choice(FIRST_NAMES)).split()[0]
+        q = first[:self.rng.randint(2, len(first))] if len(first) > 2 else first
+        if self.rng.random() < 0.3:
+            q += " " + self.rng.choice(self.rng.choice(list(REGION_CITIES.values())))[:3]
+        return {"op": "search", "method": "GET", "path": "/api/customers/search", "query": urlencode({"q": q})}
+
+    def _generate(self):
+        cid = self.rng.choice(self.customers)[0]
+        return {"op": "generate", "method": "POST", "path": "/api/offers/generate",
+                "body": {"customer_id": cid, "preview": self.rng.random() < 0.7}}
+
+    def _assign(self):
+        cid = self.rng.choice(self.customers)[0]
+        oid = self.rng.choice(self.offers) if self.offers else 0
+        return {"op": "assign", "method": "POST", "path": "/api/offers/assign",
+                "body": {"customer_id": cid, "offer_id": oid}}
+
+    def _upload(self):
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(CUSTOMER_COLUMNS)
+        w.writerows(synth_customers(UPLOAD_ROWS, self.rng.randrange(1 << 30), msisdn_base=self.next_msisdn))
+        self.next_msisdn += UPLOAD_ROWS
+        return {"op": "upload", "method": "POST", "path": "/api/customers/upload", "body": {"csv": buf.getvalue()}}
+
+    def _segment(self):
+        return {"op": "segment", "method": "POST", "path": "/api/segment/run",
+                "body": {"features": self.rng.choice(["demographic", "usage", "combined"])}}
+
+
+def op_of(req):
+    if req.get("op"):
+        return req["op"]
+    return f"{req['method']} {re.sub(r'/[0-9]+(?=/|$)', '/<id>', req['path'])}"
+
+
+# ---------------------------------------------------------------------
+# TRANSPORTS
+# ---------------------------------------------------------------------
+
+def inproc_sender(app):
+    def send(req):
+        status, _, _ = call_app(app, req["method"], req["path"], req.get("body"), req.get("query", ""))
+        return status
+    return send
+
+
+def socket_sender(base_url, timeout):
+    target = urlsplit(base_url)
+
+    def send(req):
+        body = req.get("body")
+        data = json.dumps(body).encode("utf-8") if isinstance(body, (dict, list)) else (body or "").encode("utf-8")
+        headers = {"Content-Type": "application/json" if isinstance(body, (dict, list)) else "application/x-ndjson"}
+        url = req["path"] + ("?" + req["query"] if req.get("query") else "")
+        # the wsgiref server answers HTTP/1.0 and closes, so every request opens its own connection
+        conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=timeout)
+        try:
+            conn.request(req["method"], url, body=data if req["method"] != "GET" else None, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        finally:
+            conn.close()
+    return send
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, workers, preload, timeout=120.0):
+    """Start server.py in workdir on a free port; returns (process, base url) once it answers."""
+    port = _free_port()
+    cmd = [sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port), "--workers", str(workers)]
+    if preload:
+        cmd.append("--preload")
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server.py exited with {proc.returncode}")
+        try:
+            with urllib.request.urlopen(url + "/api/engines", timeout=1):
+                return proc, url
+        except OSError:
+            time.sleep(0.05)
+    proc.terminate()
+    raise TimeoutError("server.py did not start")
+
+
+# ---------------------------------------------------------------------
+# RUNNER
+# ---------------------------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []  # (op, scheduled-to-done s, send-to-done s, status or None, error)
+
+    def add(self, *sample):
+        with self.lock:
+            self.samples.append(sample)
+
+
+def run(send, source, clients, rps, duration, max_requests, record=None):
+    """Issue requests from source() on `clients` threads; rps 0 = as fast as the clients go.
+
+    source() returns the next request dict or None when a replay is exhausted. A request's
+    "t" (seconds from start, from a recorded log) overrides the rate schedule.
+    """
+    rec = Recorder()
+    lock = threading.Lock()
+    counter = [0]
+    start = time.perf_counter() + 0.05
+    end = start + duration if duration else None
+    log = open(record, "w", encoding="utf-8") if record else None
+
+    def worker():
+        while True:
+            with lock:
+                i = counter[0]
+                if max_requests and i >= max_requests:
+                    return
+                req = source()
+                if req is None:
+                    return
+                due = start + (req["t"] if req.get("t") is not None else (i / rps if rps else 0.0))
+                if end and max(due, time.perf_counter()) >= end:
+                    return
+                counter[0] += 1
+                paced = bool(rps) or req.get("t") is not None
+                if log:
+                    log.write(json.dumps(dict(req, t=round(due - start, 6) if paced else None)) + "\n")
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            sent = time.perf_counter()
+            status, error = None, None
+            try:
+                status = send(req)
+            except Exception as e:  # transport failures count as errors, the run goes on
+                error = type(e).__name__
+            done = time.perf_counter()
+            rec.add(op_of(req), done - (due if paced else sent), done - sent, status, error)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if log:
+        log.close()
+    return rec.samples, elapsed
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = (len(sorted_vals) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+
+def summarize(samples, elapsed):
+    def block(rows):
+        lat = sorted(r[1] for r in rows)
+        svc = sorted(r[2] for r in rows)
+        statuses = {}
+        for r in rows:
+            key = str(r[3]) if r[3] is not None else r[4]
+            statuses[key] = statuses.get(key, 0) + 1
+        errors = sum(1 for r in rows if r[3] is None or r[3] >= 500)
+        rejected = sum(1 for r in rows if r[3] is not None and 400 <= r[3] < 500)
+        out = {
+            "requests": len(rows),
+            "throughput_rps": round(len(rows) / elapsed, 2) if elapsed else None,
+            "errors": errors,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "rejected_4xx": rejected,
+            "statuses": statuses,
+            "latency_ms": {f"p{p}": round(percentile(lat, p) * 1000, 2) for p in PERCENTILES},
+            "service_ms": {f"p{p}": round(percentile(svc, p) * 1000, 2) for p in PERCENTILES},
+        }
+        out["latency_ms"]["max"] = round(lat[-1] * 1000, 2) if lat else None
+        out["latency_ms"]["mean"] = round(sum(lat) / len(lat) * 1000, 2) if lat else None
+        return out
+
+    by_op = {}
+    for s in samples:
+        by_op.setdefault(s[0], []).append(s)
+    return {"elapsed_s": round(elapsed, 3), "total": block(samples) if samples else {"requests": 0},
+            "ops": {op: block(rows) for op, rows in sorted(by_op.items())}}
+
+
+def print_report(summary):
+    print(f"{'operation':<28} {'reqs':>7} {'rps':>8} {'err%':>6} {'4xx':>5} "
+          f"{'p50':>8} {'p90':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)")
+    rows = list(summary["ops"].items()) + [("TOTAL", summary["total"])]
+    for op, b in rows:
+        if not b.get("requests"):
+            continue
+        lat = b["latency_ms"]
+        print(f"{op:<28} {b['requests']:>7} {b['throughput_rps']:>8.1f} {b['error_rate'] * 100:>6.2f} "
+              f"{b['rejected_4xx']:>5} {lat['p50']:>8.1f} {lat['p90']:>8.1f} {lat['p95']:>8.1f} "
+              f"{lat['p99']:>8.1f} {lat['max']:>8.1f}")
+
+
+def _dataset(args):
+    if args.db:
+        return args.db
+    path = os.path.join(args.data_dir, f"bench_{args.customers}_d{args.days}_o{args.offers}_s{args.seed}.db")
+    if not os.path.exists(path):  # same naming as scripts/bench.py, so datasets are shared
+        os.makedirs(args.data_dir, exist_ok=True)
+        print(f"Generating {args.customers} customers into {path}", flush=True)
+        generate(path, args.customers, days=args.days, offers=args.offers, seed=args.seed)
+    return path
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Replay or synthesize traffic against the CSP server")
+    src = p.add_argument_group("traffic")
+    src.add_argument("--mix", default=DEFAULT_MIX, help=f"weighted synthetic mix of {','.join(OPS)}")
+    src.add_argument("--replay", help="request log to replay: NDJSON (as written by --record) or an access log")
+    src.add_argument("--speed", type=float, default=1.0, help="replay time compression for logs with timestamps")
+    src.add_argument("--loop", action="store_true", help="restart the replay log when it runs out")
+    src.add_argument("--record", help="write the issued requests as NDJSON, replayable with --replay")
+    load = p.add_argument_group("load")
+    load.add_argument("--rps", type=float, default=None,
+                      help=f"target request rate; 0 = closed loop, no pacing (default {DEFAULT_RPS:g}, "
+                           "or the recorded timing of a replayed log)")
+    load.add_argument("--clients", type=int, default=8, help="concurrent client threads")
+    load.add_argument("--duration", type=float, default=10.0, help="seconds to run (0 = until --requests / log end)")
+    load.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    load.add_argument("--warmup", type=int, default=20, help="unmeasured requests sent first (caches, imports)")
+    tgt = p.add_argument_group("target")
+    tgt.add_argument("--socket", action="store_true", help="over HTTP: start server.py (or use --url)")
+    tgt.add_argument("--url", help="already running server, e.g. http://127.0.0.1:5000 (implies --socket)")
+    tgt.add_argument("--workers", type=int, default=1, help="server.py --workers when --socket starts it")
+    tgt.add_argument("--preload", action="store_true", help="start server.py with --preload")
+    tgt.add_argument("--timeout", type=float, default=30.0, help="per-request socket timeout")
+    data = p.add_argument_group("data")
+    data.add_argument("--db", help="database to copy and run against (default: a generated bench dataset)")
+    data.add_argument("--customers", type=int, default=10000, help="size of the generated dataset")
+    data.add_argument("--days", type=int, default=30)
+    data.add_argument("--offers", type=int, default=50)
+    data.add_argument("--seed", type=int, default=42)
+    data.add_argument("--data-dir", default=os.path.join(ROOT, "bench_data"))
+    chk = p.add_argument_group("regression checks (non-zero exit when exceeded)")
+    chk.add_argument("--max-error-rate", type=float, help="e.g. 0.01")
+    chk.add_argument("--max-p99-ms", type=float, help="overall p99 latency")
+    p.add_argument("--out", default="loadtest.json")
+    args = p.parse_args(argv)
+    for name in ("out", "replay", "record", "db", "data_dir"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    workdir = tempfile.mkdtemp(prefix="csp_load_")
+    proc = None
+    try:
+        url = args.url
+        if not url:
+            # every run works on a scratch copy so write traffic never drifts the source data
+            src_db = sqlite3.connect(_dataset(args))
+            dst_db = sqlite3.connect(os.path.join(workdir, "csp.db"))
+            src_db.backup(dst_db)
+            src_db.close()
+            dst_db.close()
+        if args.socket or url:
+            if not url:
+                proc, url = start_server(workdir, args.workers, args.preload)
+            send = socket_sender(url, args.timeout)
+        else:
+            os.chdir(workdir)  # server.py writes outbox/ and caches relative to the working directory
+            sys.path.insert(0, ROOT)
+            import server
+            server.DB = os.path.join(workdir, "csp.db")
+            send = inproc_sender(server.app)
+
+        if args.replay:
+            reqs, skipped = load_log(args.replay)
+            if skipped:
+                print(f"{skipped} log lines skipped (no body for non-GET, or unparsable)")
+            if not reqs:
+                p.error("nothing to replay")
+            # recorded timestamps are kept (scaled by --speed) unless a target rate is given
+            timed = args.rps is None and all(r.get("t") is not None for r in reqs)
+            span = (max(r["t"] for r in reqs) + 1e-3) if timed else 0.0
+
+            def replay(timed, loop):
+                it = {"i": 0, "base": 0.0}
+
+                def source():
+                    i = it["i"]
+                    if i >= len(reqs):
+                        if not loop:
+                            return None
+                        it["i"], i = 0, 0
+                        it["base"] += span
+                    it["i"] += 1
+                    req = dict(reqs[i])
+                    req["t"] = (it["base"] + req["t"]) / args.speed if timed else None
+                    return req
+
+                return source
+
+            source = replay(timed, args.loop)
+            # warmup walks its own copy of the log, untimed, so the measured run still starts at entry one
+            warm = replay(False, True)
+        else:
+            if args.url:
+                p.error("synthetic traffic needs the database: use --socket with --db instead of --url, or --replay")
+            gen = Synthetic(os.path.join(workdir, "csp.db"), parse_mix(args.mix), seed=args.seed)
+            source = gen.next
+            warm = Synthetic(os.path.join(workdir, "csp.db"), parse_mix(args.mix), seed=args.seed + 1).next
+            timed = False
+
+        if args.warmup:
+            run(send, warm, min(args.clients, args.warmup), 0, 0, args.warmup)
+        if args.rps is None:
+            args.rps = 0 if timed else DEFAULT_RPS  # the report's params show the rate actually used
+        samples, elapsed = run(send, source, args.clients, args.rps, args.duration, args.requests, args.record)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize(samples, elapsed)
+    report = {
+        "commit": _git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        "target": "socket" if (args.socket or args.url) else "inproc",
+        "summary": summary,
+    }
+    print_report(summary)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.out)
+
+    failed = []
+    total = summary["total"]
+    if args.max_error_rate is not None and total.get("error_rate", 0) > args.max_error_rate:
+        failed.append(f"error rate {total['error_rate']} > {args.max_error_rate}")
+    if args.max_p99_ms is not None and total.get("requests") and total["latency_ms"]["p99"] > args.max_p99_ms:
+        failed.append(f"p99 {total['latency_ms']['p99']} ms > {args.max_p99_ms} ms")
+    if failed:
+        print("FAILED:", "; ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -41,16 +41,18 @@ def seed():
             today = datetime.date.today()
             # usage history for last 3 months
             import random
+            # build mapping dicts and insert them in one executemany batch
+            usage_rows = []
             for cust in customers:
                 for m in range(3):
                     d = today - datetime.timedelta(days=30*m)
-                    usage = UsageHistory(customer_id=cust.id,
-                                         date=d,
-                                         data_mb=random.randint(100, 10000),
-                                         call_minutes=random.randint(10, 500),
-                                         sms_count=random.randint(0, 200),
-                                         app_usage_score=round(random.random()*10,2))
-                    session.add(usage)
+                    usage_rows.append(dict(customer_id=cust.id,
+                                           date=d,
+                                           data_mb=random.randint(100, 10000),
+                                           call_minutes=random.randint(10, 500),
+                                           sms_count=random.randint(0, 200),
+                                           app_usage_score=round(random.random()*10,2)))
+            session.bulk_insert_mappings(UsageHistory, usage_rows)
 
         # sample offers: use simple eligibility string: "min_avg_data_mb=XXXX" or "income_bracket=high"
         if session.query(Offer).count() == 0:
@@ -0,0 +1,139 @@
+# scripts/startup_bench.py
+# Cold-start benchmark for server workers: how long `import server` takes (with
+# the per-module breakdown from `python -X importtime`) and how long a freshly
+# started server process needs before it answers its first request, with lazy
+# engines (the default) and with --preload.
+# Run: python scripts/startup_bench.py --repeat 5 --out startup.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "lazy": [],
+    "preload": ["--preload"],
+}
+
+
+def parse_importtime(stderr):
+    """[(module, self_us, cumulative_us, depth)] from `-X importtime` output."""
+    out = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        out.append((name.strip(), int(self_us), int(cum_us), depth))
+    return out
+
+
+def import_profile(workdir, preload=False):
+    """Wall time of importing server (and preloading engines) in a fresh interpreter, plus importtime records."""
+    code = (
+        "import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); import server; "
+        "%s print(time.perf_counter() - t)" % (ROOT, "server.engines.preload();" if preload else "")
+    )
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=workdir,
+                       capture_output=True, text=True, check=True)
+    return float(p.stdout.strip().splitlines()[-1]), parse_importtime(p.stderr)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_ready(workdir, extra, timeout=60.0):
+    """Seconds from spawning `server.py` until GET /api/engines answers 200."""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/api/engines"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port)] + extra,
+                            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - t0 < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - t0
+            except OSError:
+                time.sleep(0.005)
+        raise TimeoutError(f"server did not answer within {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def top_modules(records, n, key):
+    best = {}
+    for name, self_us, cum_us, _ in records:
+        best[name] = max(best.get(name, 0), self_us if key == "self" else cum_us)
+    return [{"module": m, f"{key}_ms": round(us / 1000, 2)} for m, us in sorted(best.items(), key=lambda kv: -kv[1])[:n]]
+
+
+def summary(values):
+    return {"median_s": statistics.median(values), "min_s": min(values), "max_s": max(values), "runs": values}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Server cold-start benchmark")
+    p.add_argument("--db", default=os.path.join(ROOT, "csp.db"), help="database copied into the scratch directory")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--top", type=int, default=15, help="modules listed in the import breakdown")
+    p.add_argument("--skip-ready", action="store_true", help="only measure imports, do not start servers")
+    p.add_argument("--out", default="startup.json")
+    args = p.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="csp_startup_")
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        "scenarios": {},
+    }
+    try:
+        if os.path.exists(args.db):
+            shutil.copy(args.db, os.path.join(workdir, "csp.db"))
+        for name, extra in SCENARIOS.items():
+            imports, records = [], []
+            for _ in range(args.repeat):
+                secs, records = import_profile(workdir, preload=bool(extra))
+                imports.append(secs)
+            res = {
+                "import": summary(imports),
+                "modules_imported": len({r[0] for r in records}),
+                "top_cumulative": top_modules(records, args.top, "cumulative"),
+                "top_self": top_modules(records, args.top, "self"),
+            }
+            if not args.skip_ready:
+                res["ready"] = summary([time_to_ready(workdir, extra) for _ in range(args.repeat)])
+            report["scenarios"][name] = res
+            line = f"  {name:<8} import median={res['import']['median_s'] * 1000:7.1f} ms"
+            if "ready" in res:
+                line += f"  first response median={res['ready']['median_s'] * 1000:7.1f} ms"
+            print(line + f"  ({res['modules_imported']} modules)", flush=True)
+            for m in res["top_cumulative"][:5]:
+                print(f"           {m['module']:<32} {m['cumulative_ms']:8.1f} ms", flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.out)
+
+
+if __name__ == "__main__":
+    main()
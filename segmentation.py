@@ -0,0 +1,555 @@
+# segmentation.py
+# Single segmentation engine behind /api/segment/run and ml.run_segmentation.
+# Feature sets (see features.FEATURE_SETS): demographic, usage, combined.
+# Backends: python (simple_kmeans.kmeans), numpy (simple_kmeans.kmeans_numpy),
+# sklearn (sklearn.cluster.KMeans, imported only when asked for).
+# Each run is stored under its own run_id and swapped in atomically via the
+# active_segment_run pointer; readers filter customer_segment_map on that run.
+
+import os
+import json
+import math
+import time
+import heapq
+import itertools
+
+import customer_table
+import features
+import kselect
+import shards
+from simple_kmeans import kmeans, kmeans_numpy
+
+# completed runs kept for rollback/comparison; older ones are garbage-collected
+RETAIN_RUNS = int(os.environ.get("CSP_SEGMENT_RUNS_KEEP", "3"))
+
+# how each feature set labels the segments and mappings it writes
+FEATURE_SET_LABELS = {
+    "demographic": {"prefix": "Attr-Segment", "description": "Generated from demographics",
+                    "assigned_by": "attr_kmeans", "method": "demographics"},
+    "usage": {"prefix": "Auto-Segment", "description": "Auto created by ML pipeline",
+              "assigned_by": "ml_pipeline", "method": "ml"},
+    "combined": {"prefix": "Mixed-Segment", "description": "Generated from demographics and usage",
+                 "assigned_by": "mixed_kmeans", "method": "combined"},
+}
+
+
+def _fit_python(points, k, seed):
+    rows = points.tolist() if hasattr(points, "tolist") else points
+    return kmeans(rows, k=k, max_iter=100, seed=seed)
+
+
+def _fit_numpy(points, k, seed):
+    labels, centroids = kmeans_numpy(points, k=k, max_iter=100, seed=seed)
+    return labels.tolist(), centroids.tolist()
+
+
+def _fit_sklearn(points, k, seed):
+    try:
+        from sklearn.cluster import KMeans
+    except ImportError:
+        raise ValueError("sklearn backend requires scikit-learn")
+
+    km = KMeans(n_clusters=k, random_state=seed, n_init="auto")
+    labels = km.fit_predict(points)
+    return labels.tolist(), km.cluster_centers_.tolist()
+
+
+BACKENDS = {
+    "python": _fit_python,
+    "numpy": _fit_numpy,
+    "sklearn": _fit_sklearn,
+}
+
+
+def default_backend():
+    return "numpy" if features.np is not None else "python"
+
+
+def choose_k(points, k=None, seed=0):
+    """Resolve the k parameter: int, "auto", or None for the sqrt(N) heuristic.
+
+    Returns (K, k_selection) where k_selection is the select_k() report for "auto".
+    """
+    n = max(1, len(points))
+    k_param = str(k if k is not None else "").strip().lower()
+    if k_param == "auto":
+        sel = kselect.select_k(points, k_min=2, k_max=min(10, n), seed=seed)
+        return sel["k"], sel
+    if k_param.isdigit() and int(k_param) > 0:
+        return min(int(k_param), n), None
+    # choose K proportional to sqrt(N) heuristic (but at least 2, at most 10)
+    return min(10, max(2, int(round(math.sqrt(n))))), None
+
+
+def active_run_id(conn):
+    """run_id of the segmentation snapshot readers should use (None before the first run)."""
+    row = conn.execute("SELECT run_id FROM active_segment_run WHERE id=1").fetchone()
+    return row[0] if row else None
+
+
+def centroids(raw, labels, k):
+    """Per-label mean of the raw (un-normalized) feature rows: {label: [means]}."""
+    if features.np is not None:
+        np = features.np
+        X = np.asarray(raw, dtype=np.float64)
+        L = np.asarray(labels)
+        counts = np.bincount(L, minlength=k)
+        sums = np.stack([np.bincount(L, weights=X[:, j], minlength=k) for j in range(X.shape[1])], axis=1)
+        means = sums / np.maximum(counts, 1)[:, None]
+        return {lab: means[lab].tolist() for lab in range(k) if counts[lab]}
+    sums, counts = {}, {}
+    for row, lab in zip(raw, labels):
+        acc = sums.setdefault(lab, [0.0] * len(row))
+        for j, v in enumerate(row):
+            acc[j] += v
+        counts[lab] = counts.get(lab, 0) + 1
+    return {lab: [v / counts[lab] for v in acc] for lab, acc in sums.items()}
+
+
+def member_profile(conn, ids, labels):
+    """{label: {"member_count", "region", "income", "device"}} from the compact customer table.
+
+    Computed before the run is written (on the read connection), so the write
+    transaction only inserts rows. Ids without a customers row are not counted.
+    """
+    table = customer_table.get(conn)
+    stats = {lab: {"member_count": 0, "region": {}, "income": {}, "device": {}} for lab in set(labels)}
+    pos = table.lookup(ids)
+    cols = (("region", "region"), ("income", "income_bracket"), ("device", "device_brand"))
+    if features.np is not None:
+        np = features.np
+        labs = np.asarray(labels)
+        ok = pos >= 0
+        pos, labs = pos[ok], labs[ok]
+        uniq, inv = np.unique(labs, return_inverse=True)
+        for lab, n in zip(uniq.tolist(), np.bincount(inv, minlength=len(uniq)).tolist()):
+            stats[lab]["member_count"] = n
+        for key, col in cols:
+            values = table.dictionaries[col]
+            grid = np.bincount(inv * len(values) + table.codes[col][pos], minlength=len(uniq) * len(values))
+            for (li, code), n in zip(np.argwhere(grid.reshape(len(uniq), len(values))).tolist(), grid[grid > 0].tolist()):
+                val = values[code] or "unknown"
+                dist = stats[uniq[li].item()][key]
+                dist[val] = dist.get(val, 0) + n
+        return stats
+    codes = {col: table.codes[col] for _, col in cols}
+    for p, lab in zip(pos, labels):
+        if p < 0:
+            continue
+        st = stats[lab]
+        st["member_count"] += 1
+        for key, col in cols:
+            val = table.dictionaries[col][codes[col][p]] or "unknown"
+            st[key][val] = st[key].get(val, 0) + 1
+    return stats
+
+
+def _write_stats(conn, run_id, seg_map, feature_set, cents, profile):
+    names, _ = features.FEATURE_SETS[feature_set]
+    conn.executemany(
+        "INSERT INTO segment_stats (run_id, segment_id, member_count, centroid, region_dist, income_dist, device_dist) "
+        "VALUES (?,?,?,?,?,?,?)",
+        [
+            (
+                run_id,
+                seg_map[lab],
+                profile[lab]["member_count"],
+                json.dumps({n: round(v, 4) for n, v in zip(names, cents.get(lab, []))}),
+                json.dumps(profile[lab]["region"]),
+                json.dumps(profile[lab]["income"]),
+                json.dumps(profile[lab]["device"]),
+            )
+            for lab in seg_map
+        ],
+    )
+
+
+def _open_run(conn, labels, feature_set, backend, k):
+    # segments (created on first use) and a 'building' segment_runs row
+    meta = FEATURE_SET_LABELS[feature_set]
+    cur = conn.cursor()
+    seg_map = {}
+    for lab in sorted(set(labels)):
+        name = f"{meta['prefix']}-{lab}"
+        cur.execute("INSERT OR IGNORE INTO segments (name, description) VALUES (?,?)", (name, meta["description"]))
+        cur.execute("SELECT id FROM segments WHERE name=?", (name,))
+        seg_map[lab] = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO segment_runs (features, backend, k, assigned, status) VALUES (?,?,?,?,?)",
+        (feature_set, backend, k, len(labels), "building"),
+    )
+    return cur.lastrowid, seg_map
+
+
+def _write_mappings(conn, run_id, seg_map, feature_set, ids, labels):
+    meta = FEATURE_SET_LABELS[feature_set]
+    conn.executemany(
+        "INSERT INTO customer_segment_map (customer_id, segment_id, assigned_by, method, run_id) VALUES (?,?,?,?,?)",
+        ((cid, seg_map[lab], meta["assigned_by"], meta["method"], run_id) for cid, lab in zip(ids, labels)),
+    )
+
+
+def _activate(conn, run_id):
+    conn.execute("UPDATE segment_runs SET status='complete' WHERE id=?", (run_id,))
+    conn.execute(
+        "INSERT INTO active_segment_run (id, run_id) VALUES (1, ?) "
+        "ON CONFLICT(id) DO UPDATE SET run_id=excluded.run_id",
+        (run_id,),
+    )
+
+
+def persist(conn, ids, labels, feature_set, backend=None, k=None, cents=None, read_conn=None):
+    """Write a run's segments, mappings and segment_stats as a new run_id and make it active.
+
+    Everything, including the active-run pointer flip, happens in one
+    transaction, so readers see either the previous complete run or this one.
+    cents: {label: raw-unit centroid} from centroids(), stored in segment_stats.
+    read_conn: where member attributes are read (defaults to conn).
+    Returns (run_id, {label: segment_id}).
+    """
+    profile = member_profile(read_conn or conn, ids, labels)
+    run_id, seg_map = _open_run(conn, labels, feature_set, backend, k)
+    _write_mappings(conn, run_id, seg_map, feature_set, ids, labels)
+    _write_stats(conn, run_id, seg_map, feature_set, cents or {}, profile)
+    _activate(conn, run_id)
+    conn.commit()
+    gc_runs(conn)
+    return run_id, seg_map
+
+
+def persist_sharded(smap, connect, ids, labels, feature_set, backend=None, k=None, cents=None):
+    """persist() across shards: mappings go to each customer's shard, the run, stats and pointer to the catalog.
+
+    Shard mappings are written under a 'building' run first and sync_globals carries
+    the run, segments and stats to every shard while the old run stays active. The
+    pointer then flips shard by shard and in the catalog last. Files cannot flip
+    together: for that moment some shards already serve the new run while others
+    still serve the old one (each shard stays consistent with itself). Offer cache
+    stamps read the catalog's pointer, so rankings cached in the window expire with
+    the catalog flip.
+    """
+    parts = {}
+    for cid, lab in zip(ids, labels):
+        p = parts.setdefault(shards.path_for_customer(smap, cid), ([], []))
+        p[0].append(cid)
+        p[1].append(lab)
+
+    def profile_of(path):
+        conn = connect(path)
+        try:
+            return member_profile(conn, *parts[path])
+        finally:
+            conn.close()
+
+    profile = {lab: {"member_count": 0, "region": {}, "income": {}, "device": {}} for lab in set(labels)}
+    for prof in shards.fan_out(profile_of, parts):
+        for lab, st in prof.items():
+            profile[lab]["member_count"] += st["member_count"]
+            for key in ("region", "income", "device"):
+                for val, n in st[key].items():
+                    profile[lab][key][val] = profile[lab][key].get(val, 0) + n
+
+    cat = connect(smap["catalog"])
+    try:
+        run_id, seg_map = _open_run(cat, labels, feature_set, backend, k)
+        cat.commit()
+
+        def write(path):
+            conn = connect(path)
+            try:
+                _write_mappings(conn, run_id, seg_map, feature_set, *parts[path])
+                conn.commit()
+            finally:
+                conn.close()
+
+        shards.fan_out(write, parts)
+        _write_stats(cat, run_id, seg_map, feature_set, cents or {}, profile)
+        cat.commit()
+        shards.sync_globals(smap)
+
+        def activate(path):
+            conn = connect(path)
+            try:
+                _activate(conn, run_id)
+                conn.commit()
+            finally:
+                conn.close()
+
+        shards.fan_out(activate, shards.paths(smap))
+        _activate(cat, run_id)
+        cat.commit()
+        removed = gc_runs(cat)
+    finally:
+        cat.close()
+    shards.sync_globals(smap)  # drops collected runs from the mirrors
+
+    def gc(path):
+        conn = connect(path)
+        try:
+            if removed:
+                conn.execute("DELETE FROM customer_segment_map WHERE run_id IN (%s)" % ",".join("?" * len(removed)),
+                             removed)
+                conn.commit()
+        finally:
+            conn.close()
+
+    shards.fan_out(gc, shards.paths(smap))
+    return run_id, seg_map
+
+
+def gc_runs(conn, keep=None):
+    """Delete all but the newest `keep` runs (the active run is always kept). Returns removed run ids."""
+    keep = RETAIN_RUNS if keep is None else keep
+    active = active_run_id(conn)
+    old = [
+        r[0] for r in conn.execute(
+            "SELECT id FROM segment_runs WHERE id NOT IN (SELECT id FROM segment_runs ORDER BY id DESC LIMIT ?)",
+            (max(keep, 1),),
+        )
+        if r[0] != active
+    ]
+    if old:
+        marks = ",".join("?" * len(old))
+        conn.execute(f"DELETE FROM customer_segment_map WHERE run_id IN ({marks})", old)
+        conn.execute(f"DELETE FROM segment_stats WHERE run_id IN ({marks})", old)
+        conn.execute(f"DELETE FROM segment_runs WHERE id IN ({marks})", old)
+        conn.commit()
+    return old
+
+
+def list_runs(conn):
+    active = active_run_id(conn)
+    rows = conn.execute(
+        "SELECT id, created_at, features, backend, k, assigned, status FROM segment_runs ORDER BY id DESC"
+    ).fetchall()
+    keys = ["id", "created_at", "features", "backend", "k", "assigned", "status"]
+    return [dict(zip(keys, r), active=(r[0] == active)) for r in rows]
+
+
+def _sample_ids(ids, labels, per_cluster=5):
+    sample_ids = {}
+    for lab, cid in zip(labels, ids):
+        bucket = sample_ids.setdefault(str(lab), [])
+        if len(bucket) < per_cluster:
+            bucket.append(cid)
+    return sample_ids
+
+
+def _sample_rows(conn, wanted):
+    rows = conn.execute(
+        "SELECT id, msisdn, name FROM customers WHERE id IN (%s)" % ",".join("?" * len(wanted)), wanted
+    ).fetchall()
+    return {r[0]: {"id": r[0], "msisdn": r[1], "name": r[2]} for r in rows}
+
+
+def _samples(conn, ids, labels, per_cluster=5):
+    sample_ids = _sample_ids(ids, labels, per_cluster)
+    wanted = [cid for group in sample_ids.values() for cid in group]
+    if not wanted:
+        return {}
+    by_id = _sample_rows(conn, wanted)
+    return {lab: [by_id[cid] for cid in group if cid in by_id] for lab, group in sample_ids.items()}
+
+
+def run(conn, feature_set="demographic", backend=None, k=None, seed=None, read_conn=None):
+    """Cluster customers on one feature set and persist the result.
+
+    read_conn (e.g. replica.get_read_db()) serves the feature and attribute
+    scans; conn only takes the final write.
+
+    Returns the summary served by /api/segment/run:
+    {"status", "run_id", "features", "backend", "k", "assigned", "clusters", "samples", "k_selection"}
+    """
+    backend, seed = _check(feature_set, backend, seed)
+
+    # encoded feature matrix; served from the on-disk cache until the data changes
+    _, loader = features.FEATURE_SETS[feature_set]
+    rc = read_conn or conn
+    ids, raw = loader(rc)
+    if len(ids) == 0:
+        return {"status": "no_data" if feature_set == "usage" else "no_customers"}
+    ids = [int(i) for i in ids]
+    labels, K, k_selection = _cluster(raw, k, backend, seed)
+
+    run_id, _ = persist(conn, ids, labels, feature_set, backend=backend, k=K, cents=centroids(raw, labels, K),
+                        read_conn=rc)
+    return _summary(run_id, feature_set, backend, K, labels, k_selection, _samples(rc, ids, labels))
+
+
+def run_sharded(smap, connect, feature_set="demographic", backend=None, k=None, seed=None):
+    """run() over every shard: features are loaded in parallel and clustered as one matrix.
+
+    connect(path) opens a shard or the catalog; see shards.py.
+    """
+    backend, seed = _check(feature_set, backend, seed)
+    _, loader = features.FEATURE_SETS[feature_set]
+
+    def load(path):
+        conn = connect(path)
+        try:
+            ids, raw = loader(conn)
+            return [int(i) for i in ids], raw
+        finally:
+            conn.close()
+
+    parts = [p for p in shards.fan_out(load, shards.paths(smap)) if p[0]]
+    if not parts:
+        return {"status": "no_data" if feature_set == "usage" else "no_customers"}
+    ids = [cid for p in parts for cid in p[0]]
+    if features.np is not None:
+        raw = features.np.concatenate([features.np.asarray(p[1]) for p in parts])
+    else:
+        raw = [row for p in parts for row in p[1]]
+    labels, K, k_selection = _cluster(raw, k, backend, seed)
+    run_id, _ = persist_sharded(smap, connect, ids, labels, feature_set, backend=backend, k=K,
+                                cents=centroids(raw, labels, K))
+
+    sample_ids = _sample_ids(ids, labels)
+    by_shard = shards.group_by_shard(smap, [cid for group in sample_ids.values() for cid in group])
+
+    def fetch(path):
+        conn = connect(path)
+        try:
+            return _sample_rows(conn, by_shard[path])
+        finally:
+            conn.close()
+
+    by_id = {}
+    for rows in shards.fan_out(fetch, by_shard):
+        by_id.update(rows)
+    samples = {lab: [by_id[cid] for cid in group if cid in by_id] for lab, group in sample_ids.items()}
+    return _summary(run_id, feature_set, backend, K, labels, k_selection, samples)
+
+
+def _check(feature_set, backend, seed):
+    if feature_set not in features.FEATURE_SETS:
+        raise ValueError(f"unknown feature set: {feature_set}")
+    backend = backend or default_backend()
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend: {backend}")
+    if backend == "numpy" and features.np is None:
+        raise ValueError("numpy backend requires NumPy")
+    if seed is None:
+        seed = int(time.time() // 60)
+    return backend, seed
+
+
+def _cluster(raw, k, backend, seed):
+    points, _, _ = features.minmax(raw)
+    K, k_selection = choose_k(points, k, seed)
+    labels, _ = BACKENDS[backend](points, K, seed)
+    return [int(lab) for lab in labels], K, k_selection
+
+
+def _summary(run_id, feature_set, backend, K, labels, k_selection, samples):
+    counts = {}
+    for lab in labels:
+        counts[str(lab)] = counts.get(str(lab), 0) + 1
+    return {
+        "status": "ok",
+        "run_id": run_id,
+        "features": feature_set,
+        "backend": backend,
+        "k": K,
+        "assigned": len(labels),
+        "clusters": counts,
+        "samples": samples,
+        "k_selection": k_selection,
+    }
+
+
+# ---------------------------------------------------------------------
+# READERS
+# ---------------------------------------------------------------------
+
+MEMBERS_SQL = """
+    SELECT c.id, c.msisdn, c.name, c.age, c.gender, c.region, c.city, c.income_bracket, c.device_brand,
+           c.churn_risk_score
+    FROM customer_segment_map m JOIN customers c ON c.id = m.customer_id
+    WHERE m.run_id = ? AND m.segment_id = ?
+    ORDER BY m.customer_id
+    LIMIT ? OFFSET ?
+"""
+MEMBER_KEYS = ["id", "msisdn", "name", "age", "gender", "region", "city", "income_bracket", "device_brand",
+               "churn_risk_score"]
+
+def segment_stats(conn, segment_id, run_id=None):
+    """Precomputed profile of one segment in the active (or given) run, or None."""
+    run_id = run_id or active_run_id(conn)
+    row = conn.execute(
+        "SELECT run_id, segment_id, member_count, centroid, region_dist, income_dist, device_dist "
+        "FROM segment_stats WHERE run_id=? AND segment_id=?",
+        (run_id, segment_id),
+    ).fetchone()
+    if not row:
+        return None
+    return {
+        "run_id": row[0],
+        "segment_id": row[1],
+        "member_count": row[2],
+        "centroid": json.loads(row[3] or "{}"),
+        "distributions": {
+            "region": json.loads(row[4] or "{}"),
+            "income_bracket": json.loads(row[5] or "{}"),
+            "device_brand": json.loads(row[6] or "{}"),
+        },
+    }
+
+
+def segment_members(conn, segment_id, page=1, page_size=50, run_id=None):
+    """One page of a segment's customers, ordered by customer id; None when the run has no such segment.
+
+    The total comes from segment_stats and the page from the
+    (run_id, segment_id, customer_id) index, so neither needs a full scan.
+    """
+    run_id = run_id or active_run_id(conn)
+    page = max(1, page)
+    page_size = max(1, min(page_size, 1000))
+    total = conn.execute(
+        "SELECT member_count FROM segment_stats WHERE run_id=? AND segment_id=?", (run_id, segment_id)
+    ).fetchone()
+    if not total:
+        return None
+    rows = conn.execute(MEMBERS_SQL, (run_id, segment_id, page_size, (page - 1) * page_size))
+    return {
+        "segment_id": segment_id,
+        "run_id": run_id,
+        "page": page,
+        "page_size": page_size,
+        "total": total[0],
+        "members": [dict(zip(MEMBER_KEYS, r)) for r in rows],
+    }
+
+
+def segment_members_sharded(smap, connect, segment_id, page=1, page_size=50, run_id=None):
+    """segment_members() across shards: each shard returns its first page * page_size members
+    and the pages are merged by customer id. None when the run has no such segment."""
+    page = max(1, page)
+    page_size = max(1, min(page_size, 1000))
+    cat = connect(smap["catalog"])
+    try:
+        total = cat.execute(
+            "SELECT member_count FROM segment_stats WHERE run_id=? AND segment_id=?", (run_id, segment_id)
+        ).fetchone()
+    finally:
+        cat.close()
+    if not total:
+        return None
+
+    def fetch(path):
+        conn = connect(path)
+        try:
+            return [tuple(r) for r in conn.execute(MEMBERS_SQL, (run_id, segment_id, page * page_size, 0))]
+        finally:
+            conn.close()
+
+    merged = heapq.merge(*shards.fan_out(fetch, shards.paths(smap)))
+    rows = list(itertools.islice(merged, (page - 1) * page_size, page * page_size))
+    return {
+        "segment_id": segment_id,
+        "run_id": run_id,
+        "page": page,
+        "page_size": page_size,
+        "total": total[0],
+        "members": [dict(zip(MEMBER_KEYS, r)) for r in rows],
+    }
@@ -1,7 +1,7 @@
 # server.py 
 # Minimal dependency-free HTTP server for CSP Use Case
 # Place this file in your project root (same folder as csp.db, db_init.py and frontend/)
-# Run: python server.py
+# Run: python server.py [--port 5000] [--workers N]
 
 import os
 import sqlite3
@@ -10,13 +10,30 @@ import io
 import csv
 import datetime
 import time
-import math
+import re
 import uuid
+import signal
+import argparse
+import heapq
+import threading
 from wsgiref.simple_server import make_server
 from urllib.parse import parse_qs
 
-# Import local simple KMeans implementation
-from simple_kmeans import kmeans
+import capping
+import customer_search
+import db_init
+import engines
+import ingest
+import offer_cache
+import replica
+import shards
+
+# analytics modules (and NumPy behind them) load on first use, or up front with --preload
+campaigns = engines.lazy("campaigns")
+customer_table = engines.lazy("customer_table")
+scoring = engines.lazy("scoring")
+segmentation = engines.lazy("segmentation")
+shared_features = engines.lazy("shared_features")
 
 DB = "csp.db"
 FRONTEND_DIR = "frontend"
@@ -24,13 +41,53 @@ OUTBOX_DIR = "outbox"
 
 os.makedirs(OUTBOX_DIR, exist_ok=True)
 
+# CSP_SHARDS=shards.json spreads customer-scoped tables over several files;
+# DB is then the catalog (offers, segments, runs)
+SHARDS = shards.load_map()
+if SHARDS:
+    DB = SHARDS["catalog"]
 
-def get_db():
-    conn = sqlite3.connect(DB)
+
+_SCHEMA_READY = set()
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
     conn.row_factory = sqlite3.Row
+    # upgrade older databases (new tables, triggers, indexes) once per process
+    if path not in _SCHEMA_READY:
+        db_init.ensure_schema(conn)
+        _SCHEMA_READY.add(path)
     return conn
 
 
+def get_db():
+    return connect(DB)
+
+
+def get_customer_db(customer_id):
+    # the shard holding this customer (the main DB when not sharded)
+    return connect(shards.path_for_customer(SHARDS, customer_id)) if SHARDS else get_db()
+
+
+def query_shards(sql, params=()):
+    # run one query on every shard in parallel; returns a list of row-dict lists in shard order
+    def run(path):
+        conn = connect(path)
+        try:
+            return [dict(r) for r in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    return shards.fan_out(run, shards.paths(SHARDS))
+
+
+def get_read_db():
+    # analytical reads: live DB, WAL read transaction or backup snapshot (CSP_READ_MODE)
+    get_db().close()
+    return replica.get_read_db(DB)
+
+
 def respond_json(start_response, status, obj):
     payload = json.dumps(obj, default=str).encode("utf-8")
     headers = [("Content-Type", "application/json"), ("Content-Length", str(len(payload)))]
@@ -88,6 +145,66 @@ def parse_post(environ):
         return {}
 
 
+def offer_stamp(conn):
+    # cached rankings are valid for one DB, offer catalogue version and active segment run
+    if SHARDS:
+        # shards hold mirrors; the catalog's versions are the ones every shard converges to
+        cat = get_db()
+        try:
+            return (DB, db_init.get_version(cat, "offers"), segmentation.active_run_id(cat))
+        finally:
+            cat.close()
+    return (DB, db_init.get_version(conn, "offers"), segmentation.active_run_id(conn))
+
+
+def offer_catalogue(conn, stamp):
+    return offer_cache.CACHE.catalogue(stamp[:2], lambda: compile_catalogue(conn, stamp))
+
+
+def compile_catalogue(conn, stamp):
+    if not shared_features.enabled():
+        return scoring.compile_offers(conn)
+    # workers share one compiled copy per offers version
+    bundle = shared_features.get(conn, "offers", str(stamp[1]),
+                                 lambda: scoring.catalogue_parts(scoring.compile_offers(conn)))
+    return scoring.catalogue_from_parts(bundle.arrays, bundle.meta)
+
+
+# usage micro-batches go to whatever DB points at when they flush; cached rankings
+# of the customers in a flushed batch are dropped
+INGEST = ingest.Ingestor(lambda: DB, on_flush=lambda ids: offer_cache.CACHE.invalidate(*ids),
+                        route=(lambda cid: shards.path_for_customer(SHARDS, cid)) if SHARDS else None)
+
+
+# campaign id -> campaigns.Pipeline for runs executing in this process
+CAMPAIGNS = {}
+
+
+def start_campaign(campaign_id):
+    def work():
+        try:
+            campaigns.run(DB, campaign_id, outbox_dir=OUTBOX_DIR, claimed=True,
+                          on_start=lambda pipe: CAMPAIGNS.__setitem__(campaign_id, pipe))
+        except campaigns.CampaignError as e:
+            print(f"campaign {campaign_id}: {e}")
+        finally:
+            CAMPAIGNS.pop(campaign_id, None)
+
+    threading.Thread(target=work, name=f"campaign-{campaign_id}", daemon=True).start()
+
+
+def read_body(environ):
+    try:
+        size = int(environ.get("CONTENT_LENGTH", 0) or 0)
+    except ValueError:
+        size = 0
+    return environ["wsgi.input"].read(size) if size > 0 else b""
+
+
+def parse_query(environ):
+    return {k: v[0] for k, v in parse_qs(environ.get("QUERY_STRING", "")).items()}
+
+
 def app(environ, start_response):
     path = environ.get("PATH_INFO", "/")
     method = environ.get("REQUEST_METHOD", "GET").upper()
@@ -102,21 +219,50 @@ def app(environ, start_response):
 
     # API: GET customers
     if path == "/api/customers" and method == "GET":
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            """
+        sql = """
             SELECT id, msisdn, name, age, gender, region, city, occupation, marital_status,
                    income_bracket, device_brand, device_type, hobby, preferred_app,
                    data_preference, voice_preference, churn_risk_score
             FROM customers
             ORDER BY id
             """
-        )
+        if SHARDS:
+            rows = list(heapq.merge(*query_shards(sql), key=lambda r: r["id"]))
+            return respond_json(start_response, "200 OK", rows)
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(sql)
         rows = [dict(r) for r in cur.fetchall()]
         conn.close()
         return respond_json(start_response, "200 OK", rows)
 
+    # API: customer search for typeahead - ?q=<words and/or msisdn digits>&limit=20&offset=0
+    if path == "/api/customers/search" and method == "GET":
+        qs = parse_query(environ)
+        try:
+            limit = max(1, min(int(qs.get("limit", customer_search.PAGE_SIZE)), customer_search.MAX_LIMIT))
+            offset = max(0, int(qs.get("offset", 0)))
+        except ValueError:
+            return respond_json(start_response, "400 BAD REQUEST", {"error": "limit and offset must be integers"})
+        q = qs.get("q", "")
+        if SHARDS:
+            # each shard returns everything up to the end of the page; merged by score / msisdn / id
+            def search(path_):
+                conn = connect(path_)
+                try:
+                    return customer_search.search(conn, q, offset + limit, 0, max_limit=offset + limit)
+                finally:
+                    conn.close()
+
+            page = customer_search.merge(shards.fan_out(search, shards.paths(SHARDS)), limit, offset)
+            return respond_json(start_response, "200 OK", page)
+        conn = get_db()
+        try:
+            page = customer_search.search(conn, q, limit, offset)
+        finally:
+            conn.close()
+        return respond_json(start_response, "200 OK", page)
+
     # API: CSV upload (POST) - expects JSON { "csv": "<csv text>" }
     if path == "/api/customers/upload" and method == "POST":
         body = parse_post(environ)
@@ -132,8 +278,13 @@ def app(environ, start_response):
 
         inserted = 0
         errors = []
+        written = []  # customer ids, for the offer cache
         conn = get_db()
         cur = conn.cursor()
+        targets = {}  # sharded: shard path -> connection
+        routed = {}  # sharded: shard path -> [(csv row, customer id)] written there
+        if SHARDS:
+            shards.ensure_directory(SHARDS)
         for idx, row in enumerate(reader, start=2):  # start=2 to account for header
             try:
                 msisdn = row.get("msisdn") or row.get("MSISDN")
@@ -160,6 +311,32 @@ def app(environ, start_response):
                     float(row["churn_risk_score"]) if row.get("churn_risk_score") else None,
                 ]
 
+                if SHARDS:
+                    # the catalog's directory hands out the id (and rejects msisdns known on any shard);
+                    # the id picks the shard
+                    cid = shards.register_customer(conn, msisdn)
+                    spath = shards.path_for_customer(SHARDS, cid)
+                    if spath not in targets:
+                        targets[spath] = connect(spath)
+                    try:
+                        targets[spath].execute(
+                            """
+                            INSERT INTO customers
+                              (id,msisdn,name,age,gender,region,city,occupation,marital_status,
+                               income_bracket,device_brand,device_type,hobby,preferred_app,
+                               data_preference,voice_preference,churn_risk_score)
+                            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                            """,
+                            [cid] + vals,
+                        )
+                    except sqlite3.Error:
+                        cur.execute("DELETE FROM customer_directory WHERE id=?", (cid,))
+                        raise
+                    routed.setdefault(spath, []).append((idx, cid))
+                    written.append(cid)
+                    inserted += 1
+                    continue
+
                 cur.execute(
                     """
                     INSERT INTO customers
@@ -170,23 +347,45 @@ def app(environ, start_response):
                     """,
                     vals,
                 )
+                written.append(cur.lastrowid)
                 inserted += 1
 
             except Exception as e:
                 errors.append({"row": idx, "error": str(e)})
 
+        # directory entries commit before the shard rows, so a shard never holds a customer the catalog
+        # does not know; a shard whose commit fails gets its reserved ids released again
         conn.commit()
+        for spath, sconn in targets.items():
+            try:
+                sconn.commit()
+            except sqlite3.Error as e:
+                sconn.rollback()
+                lost = routed.get(spath, [])
+                cur.executemany("DELETE FROM customer_directory WHERE id=?", [(cid,) for _, cid in lost])
+                conn.commit()
+                dropped = {cid for _, cid in lost}
+                written = [cid for cid in written if cid not in dropped]
+                inserted -= len(lost)
+                errors.extend({"row": idx, "error": str(e)} for idx, _ in lost)
+                errors.sort(key=lambda err: err["row"])
+            finally:
+                sconn.close()
         conn.close()
+        offer_cache.CACHE.invalidate(*written)
         return respond_json(start_response, "200 OK", {"inserted": inserted, "errors": errors})
 
     # API: export customers.csv
     if path == "/api/export/customers.csv" and method == "GET":
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT msisdn, name, age, gender, region, city, occupation, marital_status, income_bracket, device_brand, device_type, hobby, preferred_app, data_preference, voice_preference, churn_risk_score FROM customers"
-        )
-        rows = cur.fetchall()
+        sql = "SELECT msisdn, name, age, gender, region, city, occupation, marital_status, income_bracket, device_brand, device_type, hobby, preferred_app, data_preference, voice_preference, churn_risk_score FROM customers"
+        if SHARDS:
+            rows = [r for part in query_shards(sql) for r in part]
+        else:
+            conn = get_read_db()
+            cur = conn.cursor()
+            cur.execute(sql)
+            rows = [dict(r) for r in cur.fetchall()]
+            conn.close()
         output = io.StringIO()
         writer = csv.writer(output)
         writer.writerow(
@@ -210,7 +409,7 @@ def app(environ, start_response):
             ]
         )
         for r in rows:
-            writer.writerow([r[k] for k in r.keys()])
+            writer.writerow(list(r.values()))
         data = output.getvalue().encode("utf-8")
         start_response(
             "200 OK",
@@ -230,7 +429,10 @@ def app(environ, start_response):
     if path == "/api/offers" and method == "GET":
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT id, code, title, description, eligibility_simple, active FROM offers")
+        cur.execute(
+            "SELECT id, code, title, description, eligibility_simple, active, score_weights, cap_count, cap_window_days "
+            "FROM offers"
+        )
         rows = [dict(r) for r in cur.fetchall()]
         conn.close()
         return respond_json(start_response, "200 OK", rows)
@@ -262,6 +464,9 @@ def app(environ, start_response):
 
                 desc = row.get("description")
                 elig = row.get("eligibility_simple")
+                weights = (row.get("score_weights") or "").strip() or None
+                cap_count = int(row["cap_count"]) if (row.get("cap_count") or "").strip() else None
+                cap_days = int(row["cap_window_days"]) if (row.get("cap_window_days") or "").strip() else None
                 act_raw = (row.get("active") or "1").strip().lower()
                 if act_raw in ("1", "true", "yes"):
                     active = 1
@@ -271,10 +476,11 @@ def app(environ, start_response):
                 cur.execute(
                     """
                     INSERT INTO offers
-                        (code, title, description, eligibility_simple, active)
-                    VALUES (?,?,?,?,?)
+                        (code, title, description, eligibility_simple, active, score_weights,
+                         cap_count, cap_window_days)
+                    VALUES (?,?,?,?,?,?,?,?)
                 """,
-                    (code, title, desc, elig, active),
+                    (code, title, desc, elig, active, weights, cap_count, cap_days),
                 )
 
                 inserted += 1
@@ -284,21 +490,27 @@ def app(environ, start_response):
 
         conn.commit()
         conn.close()
+        if SHARDS:
+            shards.sync_globals(SHARDS)
+        # the catalogue version moved; drop rankings now rather than letting them age out
+        offer_cache.CACHE.clear()
         return respond_json(start_response, "200 OK", {"inserted": inserted, "errors": errors})
 
     # API: GET offer assignments
     if path == "/api/offer_assignments" and method == "GET":
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            """
+        sql = """
             SELECT a.id, c.msisdn as customer_msisdn, o.code as offer_code, a.assigned_at, a.assigned_by, a.status
             FROM offer_assignment a
             LEFT JOIN customers c ON c.id = a.customer_id
             LEFT JOIN offers o ON o.id = a.offer_id
             ORDER BY a.assigned_at DESC
             """
-        )
+        if SHARDS:
+            rows = list(heapq.merge(*query_shards(sql), key=lambda r: r["assigned_at"] or "", reverse=True))
+            return respond_json(start_response, "200 OK", rows)
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(sql)
         rows = [dict(r) for r in cur.fetchall()]
         conn.close()
         return respond_json(start_response, "200 OK", rows)
@@ -314,7 +526,7 @@ def app(environ, start_response):
 
         notify_email = (body.get("notify_email") or "").strip()
 
-        conn = get_db()
+        conn = get_customer_db(customer_id)
         cur = conn.cursor()
         # verify existence
         cur.execute("SELECT id, name, msisdn FROM customers WHERE id=?", (customer_id,))
@@ -330,22 +542,20 @@ def app(environ, start_response):
             return respond_json(start_response, "400 Bad Request", {"error": "offer_not_found"})
 
         try:
-            # record assignment
-            cur.execute(
-                "INSERT INTO offer_assignment (customer_id, offer_id, assigned_by, status) VALUES (?,?,?,?)",
-                (customer_id, offer_id, "admin_ui", "assigned"),
-            )
-            conn.commit()
-            assignment_id = cur.lastrowid
+            # record assignment (cap check and insert in one write transaction)
+            _, assignment_id, _ = capping.assign(conn, customer_id, [offer_id], "admin_ui")
+            if assignment_id is None:
+                conn.close()
+                return respond_json(start_response, "409 Conflict", {"error": "frequency_cap"})
 
             # write simple notification file for preview (no SMTP)
             note = (
                 f"Assigned offer {offer['code']} ({offer['title']}) "
-                f"to customer {cust.get('name') or cust.get('msisdn')} (id={customer_id})\n"
+                f"to customer {cust['name'] or cust['msisdn']} (id={customer_id})\n"
             )
             if notify_email:
                 note += f"Notify email: {notify_email}\n"
-            note += f"Description: {offer.get('description') or ''}\n"
+            note += f"Description: {offer['description'] or ''}\n"
             note += f"Assigned at: {datetime.datetime.utcnow().isoformat()}Z\n"
 
             fname = f"assign_{int(time.time())}_{uuid.uuid4().hex[:6]}.txt"
@@ -370,305 +580,431 @@ def app(environ, start_response):
     # SEGMENTS / SEGMENTATION
     # ---------------------------------------------------------------------
 
-    # API: segments list
+    # API: segments list (member_count from the active run's precomputed stats)
     if path == "/api/segments_list" and method == "GET":
-        conn = get_db()
+        conn = get_read_db()
         cur = conn.cursor()
-        cur.execute("SELECT id, name, description FROM segments")
+        cur.execute(
+            """
+            SELECT s.id, s.name, s.description, st.member_count
+            FROM segments s
+            LEFT JOIN segment_stats st
+              ON st.segment_id = s.id AND st.run_id = (SELECT run_id FROM active_segment_run WHERE id=1)
+            """
+        )
         rows = [dict(r) for r in cur.fetchall()]
         conn.close()
         return respond_json(start_response, "200 OK", rows)
 
-    # SEGMENTATION: demographic-based KMeans
-    if path == "/api/segment/run" and method == "POST":
-        conn = get_db()
-        cur = conn.cursor()
+    # API: per-segment stats and paginated members
+    m = re.match(r"^/api/segments/(\d+)/(stats|members)$", path)
+    if m and method == "GET":
+        seg_id = int(m.group(1))
+        q = parse_query(environ)
         try:
-            cur.execute(
-                """
-                SELECT id, msisdn, name, age, gender, region, city, income_bracket, device_brand,
-                       device_type, hobby, preferred_app, data_preference, voice_preference, churn_risk_score
-                FROM customers
-            """
+            run_id = int(q["run_id"]) if q.get("run_id") else None
+            page = int(q.get("page") or 1)
+            page_size = int(q.get("page_size") or 50)
+        except ValueError:
+            return respond_json(start_response, "400 Bad Request", {"error": "invalid paging parameters"})
+        conn = get_read_db()
+        if m.group(2) == "stats":
+            result = segmentation.segment_stats(conn, seg_id, run_id=run_id)
+        elif SHARDS:
+            result = segmentation.segment_members_sharded(
+                SHARDS, connect, seg_id, page=page, page_size=page_size,
+                run_id=run_id or segmentation.active_run_id(conn),
             )
-            customers = [dict(r) for r in cur.fetchall()]
-            if not customers:
-                conn.close()
-                return respond_json(start_response, "200 OK", {"status": "no_customers"})
-
-            # mapping helpers
-            def map_income(v):
-                if not v:
-                    return 1.0
-                m = {"low": 0.0, "medium": 1.0, "high": 2.0}
-                return m.get(str(v).lower(), 1.0)
-
-            def map_pref(v):
-                if not v:
-                    return 1.0
-                vv = str(v).strip().lower()
-                if vv == "high":
-                    return 2.0
-                if vv == "medium":
-                    return 1.0
-                if vv == "low":
-                    return 0.0
-                return 1.0
-
-            def map_gender(v):
-                if not v:
-                    return 0.5
-                v = str(v).strip().upper()
-                return 1.0 if v == "F" else 0.0
-
-            def norm_hash(s):
-                if not s:
-                    return 0.0
-                return (abs(hash(str(s))) % 1000) / 1000.0
-
-            raw_points = []
-            id_list = []
-            meta = []
-            for c in customers:
-                id_list.append(c["id"])
-                age = float(c["age"]) if c.get("age") is not None else 30.0
-                income = float(map_income(c.get("income_bracket")))
-                churn = float(c.get("churn_risk_score") or 0.0)
-                data_pref = float(map_pref(c.get("data_preference")))
-                voice_pref = float(map_pref(c.get("voice_preference")))
-                gender = float(map_gender(c.get("gender")))
-                region_hash = float(norm_hash(c.get("region")))
-                device_hash = float(norm_hash(c.get("device_brand")))
-                # feature vector (order): age, income, churn, data_pref, voice_pref, gender, region_hash, device_hash
-                vec = [age, income, churn, data_pref, voice_pref, gender, region_hash, device_hash]
-                raw_points.append(vec)
-                meta.append({"id": c["id"], "msisdn": c.get("msisdn"), "name": c.get("name")})
-
-            # normalize features (min-max per column)
-            cols = len(raw_points[0])
-            mins = [math.inf] * cols
-            maxs = [-math.inf] * cols
-            for v in raw_points:
-                for i in range(cols):
-                    mins[i] = min(mins[i], v[i])
-                    maxs[i] = max(maxs[i], v[i])
-            ranges = [(maxs[i] - mins[i]) if (maxs[i] - mins[i]) > 0 else 1.0 for i in range(cols)]
-            points = []
-            for v in raw_points:
-                norm = [(v[i] - mins[i]) / ranges[i] for i in range(cols)]
-                points.append(norm)
-
-            # choose K proportional to sqrt(N) heuristic (but at least 2, at most 10)
-            n = max(1, len(points))
-            K = max(2, int(round(math.sqrt(n))))
-            if K > 10:
-                K = 10
-            seed = int(time.time() // 60)
-
-            # run KMeans
-            labels, centroids = kmeans(points, k=K, max_iter=100, seed=seed)
-
-            # create or find segment rows for labels
-            seg_map = {}
-            for lab in sorted(set(labels)):
-                name = f"Attr-Segment-{lab}"
-                cur.execute("SELECT id FROM segments WHERE name=?", (name,))
-                row = cur.fetchone()
-                if row:
-                    seg_id = row["id"]
-                else:
-                    cur.execute(
-                        "INSERT INTO segments (name, description) VALUES (?,?)",
-                        (name, "Generated from demographics"),
-                    )
-                    seg_id = cur.lastrowid
-                seg_map[lab] = seg_id
-
-            # clear previous mappings (demo behavior)
-            cur.execute("DELETE FROM customer_segment_map")
-            conn.commit()
-
-            # insert new mappings
-            for cid, lab in zip(id_list, labels):
-                cur.execute(
-                    "INSERT INTO customer_segment_map (customer_id, segment_id, assigned_by, method) VALUES (?,?,?,?)",
-                    (cid, seg_map[lab], "attr_kmeans", "demographics"),
-                )
-            conn.commit()
-
-            # prepare response summary
-            counts = {}
-            samples = {}
-            for lab, m in zip(labels, meta):
-                lab_s = str(lab)
-                counts[lab_s] = counts.get(lab_s, 0) + 1
-                if lab_s not in samples:
-                    samples[lab_s] = []
-                if len(samples[lab_s]) < 5:
-                    samples[lab_s].append(
-                        {"id": m["id"], "msisdn": m.get("msisdn"), "name": m.get("name")}
-                    )
+        else:
+            result = segmentation.segment_members(conn, seg_id, page=page, page_size=page_size, run_id=run_id)
+        conn.close()
+        if result is None:
+            return respond_json(start_response, "404 Not Found", {"error": "segment_not_in_run"})
+        return respond_json(start_response, "200 OK", result)
+
+    # API: segmentation runs (newest first, active flag)
+    if path == "/api/segment/runs" and method == "GET":
+        conn = get_read_db()
+        rows = segmentation.list_runs(conn)
+        conn.close()
+        return respond_json(start_response, "200 OK", rows)
 
-            conn.close()
-            return respond_json(
-                start_response,
-                "200 OK",
-                {"status": "ok", "k": K, "assigned": len(labels), "clusters": counts, "samples": samples},
+    # SEGMENTATION: KMeans over features=demographic|usage|combined, backend=python|numpy|sklearn
+    if path == "/api/segment/run" and method == "POST":
+        params = dict(parse_query(environ), **parse_post(environ))
+        if SHARDS:
+            try:
+                result = segmentation.run_sharded(
+                    SHARDS, connect,
+                    feature_set=params.get("features") or "demographic",
+                    backend=params.get("backend") or None,
+                    k=params.get("k"),
+                )
+            except ValueError as e:
+                return respond_json(start_response, "400 Bad Request", {"error": str(e)})
+            except Exception as e:
+                return respond_json(start_response, "500 Internal Server Error", {"error": str(e)})
+            replica.mark_stale(DB)
+            return respond_json(start_response, "200 OK", result)
+        conn = get_db()
+        read_conn = get_read_db()
+        try:
+            # features and member attributes come from the read side; only the result is written
+            result = segmentation.run(
+                conn,
+                feature_set=params.get("features") or "demographic",
+                backend=params.get("backend") or None,
+                k=params.get("k"),
+                read_conn=read_conn,
             )
-
+            replica.mark_stale(DB)
+            return respond_json(start_response, "200 OK", result)
+        except ValueError as e:
+            return respond_json(start_response, "400 Bad Request", {"error": str(e)})
         except Exception as e:
-            try:
-                conn.close()
-            except:
-                pass
             return respond_json(start_response, "500 Internal Server Error", {"error": str(e)})
+        finally:
+            read_conn.close()
+            conn.close()
 
     # ---------------------------------------------------------------------
     # OFFER GENERATION (RULE-BASED)
     # ---------------------------------------------------------------------
 
     # API: generate personalized offers for a customer
+    # preview=1 serves the cached ranking without writing an assignment
     if path == "/api/offers/generate" and method == "POST":
         body = parse_post(environ)
         try:
             customer_id = int(body.get("customer_id") or 0)
         except:
             return respond_json(start_response, "400 Bad Request", {"error": "customer_id required"})
-        conn = get_db()
+        preview = str(body.get("preview") or parse_query(environ).get("preview") or "").lower() in ("1", "true", "yes")
+        conn = get_customer_db(customer_id)
         cur = conn.cursor()
-        cur.execute("SELECT * FROM customers WHERE id=?", (customer_id,))
-        cust = cur.fetchone()
-        if not cust:
-            conn.close()
-            return respond_json(start_response, "400 Bad Request", {"error": "customer_not_found"})
-        # profile income (from customer_profile if exists)
-        profile_income = None
-        try:
-            cur.execute("SELECT income_bracket FROM customer_profile WHERE customer_id=?", (customer_id,))
-            prof = cur.fetchone()
-            profile_income = prof["income_bracket"] if prof else None
-        except:
-            profile_income = cust["income_bracket"]
-
-        # usage aggregates (if table exists and data present)
-        try:
-            cur.execute(
-                """
-                SELECT
-                  AVG(data_mb)     as avg_data_mb,
-                  AVG(call_minutes) as avg_call_mins,
-                  AVG(sms_count)   as avg_sms,
-                  AVG(app_usage_score) as avg_app_usage
-                FROM usage_history WHERE customer_id=?
-                """,
-                (customer_id,),
-            )
-            agg = cur.fetchone()
-            agg = {k: (agg[k] or 0) for k in agg.keys()} if agg else {}
-        except:
-            agg = {}
-        if not agg:
-            agg = {"avg_data_mb": 0, "avg_call_mins": 0, "avg_sms": 0, "avg_app_usage": 0}
-
-        cur.execute("SELECT id, code, title, description, eligibility_simple FROM offers WHERE active=1")
-        offers = cur.fetchall()
-        matches = []
-        for o in offers:
-            elig = o["eligibility_simple"] or ""
-            ok = False
-            if elig.strip() == "":
-                ok = True
-            else:
-                # very simple key=value parser
-                conds = [p.strip() for p in elig.split(",") if p.strip()]
-                ok = True
-                for cond in conds:
-                    if "=" in cond:
-                        k2, v2 = cond.split("=", 1)
-                        k2 = k2.strip()
-                        v2 = v2.strip()
-                        if k2 == "income_bracket":
-                            if (profile_income or cust["income_bracket"]) != v2:
-                                ok = False
-                                break
-                        elif k2 == "preferred_app":
-                            if (cust["preferred_app"] or "").strip() != v2:
-                                ok = False
-                                break
-                        elif k2 == "region":
-                            if (cust["region"] or "").strip() != v2:
-                                ok = False
-                                break
-                        elif k2 == "city":
-                            if (cust["city"] or "").strip() != v2:
-                                ok = False
-                                break
-                        elif k2 == "device_brand":
-                            if (cust["device_brand"] or "").strip() != v2:
-                                ok = False
-                                break
-                        elif k2 == "min_avg_data_mb":
-                            try:
-                                if float(agg.get("avg_data_mb", 0)) < float(v2):
-                                    ok = False
-                                    break
-                            except:
-                                ok = False
-                                break
-                        else:
-                            # unknown key -> ignore
-                            pass
-                    else:
-                        # unsupported expression -> ignore
-                        pass
-            if ok:
-                score = 0.0
-                if "min_avg_data_mb" in (o["eligibility_simple"] or ""):
-                    score += float(agg.get("avg_data_mb", 0)) / 1000.0
-                if (profile_income or cust["income_bracket"]) == "high" and "income_bracket=high" in (o["eligibility_simple"] or ""):
-                    score += 10.0
-                matches.append(
-                    {
-                        "offer_id": o["id"],
-                        "code": o["code"],
-                        "title": o["title"],
-                        "score": round(score, 2),
-                    }
-                )
-        matches = sorted(matches, key=lambda x: -x["score"])
-        chosen = matches[0] if matches else None
-        if chosen:
-            cur.execute(
-                "INSERT INTO offer_assignment (customer_id, offer_id, assigned_by, status) VALUES (?,?,?,?)",
-                (customer_id, chosen["offer_id"], "system", "assigned"),
-            )
-            conn.commit()
-            chosen["assignment_id"] = cur.lastrowid
+        stamp = offer_stamp(conn)
+        # the customer's shared version carries invalidations made by other workers
+        key = stamp + (offer_cache.CACHE.version(customer_id),)
+        ranked = offer_cache.CACHE.get(customer_id, key)
+        if ranked is None:
+            batch = scoring.load_batch(conn, [customer_id])
+            if not batch["id"]:
+                conn.close()
+                return respond_json(start_response, "400 Bad Request", {"error": "customer_not_found"})
+            catalogue = offer_catalogue(conn, stamp)
+            ranked = {
+                "matches": scoring.results(batch, catalogue, scoring.rank(batch, catalogue))[0]["offers"],
+                "aggregates": {k: batch[k][0] for k in scoring.AGG_FEATURES},
+            }
+            offer_cache.CACHE.put(customer_id, key, ranked)
+        matches = ranked["matches"]
+        agg = ranked["aggregates"]
+        # frequency caps are checked live: the best uncapped match wins
+        caps = offer_catalogue(conn, stamp)["caps"]
+        chosen = None
+        if preview:
+            capped = [m["offer_id"] for m in matches if capping.is_capped(conn, customer_id, m["offer_id"], caps)]
+            chosen = next((dict(m) for m in matches if m["offer_id"] not in capped), None)
+        else:
+            oid, aid, capped = capping.assign(conn, customer_id, [m["offer_id"] for m in matches], "system", caps)
+            if oid is not None:
+                chosen = dict(next(m for m in matches if m["offer_id"] == oid), assignment_id=aid)
         conn.close()
         return respond_json(
             start_response,
             "200 OK",
-            {"customer_id": customer_id, "chosen_offer": chosen, "all_matches": matches, "aggregates": agg},
+            {"customer_id": customer_id, "chosen_offer": chosen, "all_matches": matches, "aggregates": agg,
+             "capped": capped, "preview": preview},
+        )
+
+    # API: offer cache hit/miss counters
+    if path == "/api/offers/cache_stats" and method == "GET":
+        return respond_json(start_response, "200 OK", offer_cache.CACHE.stats())
+
+    # API: rank offers for many customers at once
+    # JSON { "customer_ids": [..] (omit for everyone), "top_k": 3, "assign": false }
+    if path == "/api/offers/generate_batch" and method == "POST":
+        body = parse_post(environ)
+        try:
+            ids = body.get("customer_ids")
+            ids = [int(c) for c in ids] if ids is not None else None
+            top_k = int(body.get("top_k") or 3)
+        except (TypeError, ValueError):
+            return respond_json(start_response, "400 Bad Request", {"error": "customer_ids must be integers"})
+        assign = str(body.get("assign") or "").lower() in ("1", "true", "yes")
+        conn = get_db()
+        catalogue = offer_catalogue(conn, offer_stamp(conn))
+        conn.close()
+
+        def score(target):
+            # target: (db path, customer ids or None for everyone in it)
+            path_, part = target
+            sconn = connect(path_)
+            try:
+                batch = scoring.load_batch(sconn, part)
+                blocked = capping.blocked_pairs(sconn, catalogue["caps"], part)
+                out = scoring.results(batch, catalogue, scoring.rank(batch, catalogue, top_k=top_k, exclude=blocked))
+                picks = []
+                if assign:
+                    # caps are checked again under the write lock; a customer whose best offer got
+                    # capped meanwhile takes the next one in its ranking
+                    picks = capping.assign_many(
+                        sconn, [(r["customer_id"], [o["offer_id"] for o in r["offers"]]) for r in out if r["offers"]],
+                        "system", catalogue["caps"])
+                return out, len(picks)
+            finally:
+                sconn.close()
+
+        if not SHARDS:
+            targets = [(DB, ids)]
+        elif ids is None:
+            targets = [(p, None) for p in shards.paths(SHARDS)]
+        else:
+            targets = list(shards.group_by_shard(SHARDS, ids).items())
+        parts = shards.fan_out(score, targets)
+        rows = list(heapq.merge(*[out for out, _ in parts], key=lambda r: r["customer_id"]))
+        assigned = sum(n for _, n in parts)
+        return respond_json(
+            start_response, "200 OK", {"customers": len(rows), "top_k": top_k, "assigned": assigned, "results": rows}
         )
 
+    # API: archive assignments outside every frequency-cap window
+    if path == "/api/offers/compact" and method == "POST":
+        body = parse_post(environ)
+        try:
+            # 0 is a real value (archive everything before now); only a missing key means "use the cap windows"
+            keep_days = int(body["keep_days"]) if body.get("keep_days") is not None else None
+            if keep_days is not None and keep_days < 0:
+                raise ValueError(keep_days)
+        except (TypeError, ValueError):
+            return respond_json(start_response, "400 Bad Request", {"error": "keep_days must be a non-negative integer"})
+        def compact(path_):
+            sconn = connect(path_)
+            try:
+                return capping.compact(sconn, keep_days)
+            finally:
+                sconn.close()
+
+        moved = sum(shards.fan_out(compact, shards.paths(SHARDS) if SHARDS else [DB]))
+        return respond_json(start_response, "200 OK", {"archived": moved})
+
+    # ---------------------------------------------------------------------
+    # CAMPAIGNS
+    # ---------------------------------------------------------------------
+
+    # API: list / create campaigns
+    # POST JSON { "name", "segment_id", "offer_ids": [..] (omit for all active), "max_per_customer": 1, "max_total" }
+    if path == "/api/campaigns" and method in ("GET", "POST"):
+        if SHARDS:
+            return respond_json(start_response, "400 Bad Request", {"error": "campaigns are not available with sharding"})
+        conn = get_db()
+        try:
+            if method == "GET":
+                return respond_json(start_response, "200 OK", campaigns.list_campaigns(conn))
+            body = parse_post(environ)
+            try:
+                segment_id = int(body["segment_id"])
+                offer_ids = [int(o) for o in body.get("offer_ids") or []]
+                per_customer = int(body.get("max_per_customer") or 1)
+                max_total = int(body["max_total"]) if body.get("max_total") else None
+            except (KeyError, TypeError, ValueError):
+                return respond_json(start_response, "400 Bad Request",
+                                    {"error": "segment_id required; offer_ids, max_per_customer, max_total integers"})
+            try:
+                c = campaigns.create(conn, body.get("name") or f"segment {segment_id}", segment_id, offer_ids,
+                                     per_customer, max_total)
+            except campaigns.CampaignError as e:
+                return respond_json(start_response, "400 Bad Request", {"error": str(e)})
+            return respond_json(start_response, "201 Created", c)
+        finally:
+            conn.close()
+
+    # API: campaign status (live per-stage stats while it runs here), run / resume, stop
+    m = re.match(r"^/api/campaigns/(\d+)(?:/(run|stop))?$", path)
+    if m:
+        campaign_id, action = int(m.group(1)), m.group(2)
+        conn = get_db()
+        c = campaigns.get(conn, campaign_id)
+        if c is None:
+            conn.close()
+            return respond_json(start_response, "404 Not Found", {"error": "campaign_not_found"})
+        pipe = CAMPAIGNS.get(campaign_id)
+        if action is None and method == "GET":
+            conn.close()
+            if pipe is not None:
+                c["stats"] = {"stages": pipe.stats(), "live": True}
+            return respond_json(start_response, "200 OK", c)
+        if action == "run" and method == "POST":
+            # claimed here, so two concurrent requests cannot both start it
+            try:
+                campaigns.claim(conn, campaign_id)
+            except campaigns.CampaignBusy as e:
+                return respond_json(start_response, "409 Conflict", {"error": str(e)})
+            finally:
+                conn.close()
+            start_campaign(campaign_id)
+            return respond_json(start_response, "202 Accepted", {"status": "started", "campaign_id": campaign_id,
+                                                                 "resume_after": c["checkpoint"]})
+        conn.close()
+        if action == "stop" and method == "POST":
+            if pipe is None:
+                return respond_json(start_response, "409 Conflict", {"error": "campaign is not running here"})
+            pipe.stop.set()
+            return respond_json(start_response, "202 Accepted", {"status": "stopping", "campaign_id": campaign_id})
+
+    # ---------------------------------------------------------------------
+    # USAGE INGEST
+    # ---------------------------------------------------------------------
+
+    # API: NDJSON usage records (one JSON object per line; a JSON array also works)
+    # ?flush=1 writes the buffer before responding; records may carry msisdn instead of customer_id
+    if path == "/api/usage/ingest" and method == "POST":
+        def resolve(msisdns):
+            conn = get_db()
+            try:
+                return ingest.lookup_msisdns(conn, msisdns, "customer_directory" if SHARDS else "customers")
+            finally:
+                conn.close()
+
+        rows, errors = ingest.parse_payload(read_body(environ), resolve)
+        try:
+            INGEST.add(rows)
+        except ingest.BufferFull as e:
+            payload = json.dumps({"error": str(e), "retry_after_s": 1}).encode("utf-8")
+            start_response("503 Service Unavailable", [("Content-Type", "application/json"),
+                                                       ("Content-Length", str(len(payload))), ("Retry-After", "1")])
+            return [payload]
+        flushed = 0
+        if parse_query(environ).get("flush") in ("1", "true"):
+            flushed = INGEST.flush()
+        status = "202 Accepted" if rows or not errors else "400 Bad Request"
+        return respond_json(start_response, status, {
+            "accepted": len(rows), "rejected": len(errors), "errors": errors[:20], "flushed": flushed,
+        })
+
+    # API: ingest buffer and throughput counters
+    if path == "/api/usage/ingest/stats" and method == "GET":
+        return respond_json(start_response, "200 OK", INGEST.stats())
+
+    # API: memory held by the compact in-process customer table(s)
+    if path == "/api/customers/memory" and method == "GET":
+        def report(path_):
+            sconn = connect(path_)
+            try:
+                return dict(customer_table.get(sconn).memory(), db=path_)
+            finally:
+                sconn.close()
+
+        return respond_json(start_response, "200 OK", shards.fan_out(report, shards.paths(SHARDS) if SHARDS else [DB]))
+
+    # API: which analytics engines this worker has imported (and how long each took)
+    if path == "/api/engines" and method == "GET":
+        return respond_json(start_response, "200 OK", {"pid": os.getpid(), "engines": engines.status()})
+
+    # API: where analytical reads go (CSP_READ_MODE) and how old the read snapshot is
+    if path == "/api/read/stats" and method == "GET":
+        return respond_json(start_response, "200 OK", replica.info(DB))
+
+    # API: shared-memory segments this worker has mapped
+    if path == "/api/shared/stats" and method == "GET":
+        return respond_json(start_response, "200 OK", {
+            "enabled": shared_features.enabled(), "pid": os.getpid(), "segments": shared_features.info(),
+        })
+
     # fallback serve static file
     return serve_static(environ, start_response, path)
 
 
+# ---------------------------------------------------------------------
+# PRE-FORK WORKERS
+# ---------------------------------------------------------------------
+
+def warm_shared():
+    # build the shared structures once in the parent so forked workers start out attached to them
+    for path_ in (shards.paths(SHARDS) if SHARDS else [DB]):
+        conn = connect(path_)
+        customer_table.get(conn)
+        conn.close()
+    conn = get_db()
+    offer_catalogue(conn, offer_stamp(conn))
+    conn.close()
+
+
+def serve_workers(httpd, workers):
+    """Fork `workers` processes accepting on httpd's socket; the parent respawns any that die."""
+    shared_features.enable()
+    offer_cache.CACHE.share()
+    warm_shared()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        return pid
+
+    pids = {spawn() for _ in range(workers)}
+    signal.signal(signal.SIGTERM, stop)  # kill <parent> also stops the workers and frees the shared memory
+    try:
+        while True:
+            pid, _ = os.wait()
+            pids.discard(pid)
+            print(f"worker {pid} exited, restarting")
+            pids.add(spawn())
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+    finally:
+        for path_ in (shards.paths(SHARDS) if SHARDS else [DB]):
+            conn = sqlite3.connect(path_)
+            shared_features.cleanup(conn)
+            conn.close()
+
+
 if __name__ == "__main__":
-    # ensure DB exists (calls db_init.seed if missing)
+    ap = argparse.ArgumentParser(description="CSP HTTP server")
+    ap.add_argument("--port", type=int, default=5000)
+    ap.add_argument("--workers", type=int, default=1,
+                    help="pre-forked worker processes sharing one copy of features and offers (POSIX only)")
+    ap.add_argument("--preload", nargs="?", const="all", default=None, metavar="ENGINES",
+                    help="import analytics engines at startup: all (default) or e.g. segmentation,scoring")
+    args = ap.parse_args()
+    if args.workers > 1 and not hasattr(os, "fork"):
+        ap.error("--workers needs os.fork (POSIX)")
+
+    # ensure DB exists: restore CSP_SNAPSHOT if set, otherwise seed demo data
     if not os.path.exists(DB):
         print("DB not found, running db_init.py to create it.")
         try:
-            import db_init
-            db_init.seed()
+            db_init.bootstrap(DB, snapshot=os.environ.get("CSP_SNAPSHOT"))
         except Exception as e:
             print("Failed to run db_init.py:", e)
 
-    port = 5000
-    print(f"Starting server on http://127.0.0.1:{port}")
+    if args.preload:
+        # before any fork, so workers share the imported modules copy-on-write
+        loaded = engines.preload(args.preload)
+        print("Preloaded", ", ".join(f"{n} ({ms} ms)" if ms is not None else f"{n} (unavailable)" for n, ms in loaded.items()))
+
+    port = args.port
+    print(f"Starting server on http://127.0.0.1:{port}" + (f" with {args.workers} workers" if args.workers > 1 else ""))
     httpd = make_server("127.0.0.1", port, app)
     try:
-        httpd.serve_forever()
+        if args.workers > 1:
+            serve_workers(httpd, args.workers)
+        else:
+            httpd.serve_forever()
     except KeyboardInterrupt:
-        print("Server stopped.")
+        pass
+    print("Server stopped.")
@@ -0,0 +1,319 @@
+# shards.py
+# Optional sharding of customer-scoped data over several SQLite files.
+#
+# Customers keep their ids; a customer's bucket is its id modulo BUCKETS, so
+# customer_id routes without a lookup. A JSON shard map assigns contiguous
+# bucket ranges to shard files:
+#
+#   {"buckets": 1024, "catalog": "shards/catalog.db",
+#    "shards": [{"path": "shards/s0.db", "lo": 0, "hi": 512, "slot": 1}, {"path": "shards/s1.db", "lo": 512, "hi": 1024, "slot": 2}]}
+#
+# The catalog holds offers, segments and segmentation runs; every shard keeps
+# a mirror of those tables (sync_globals) so per-shard joins work unchanged.
+# New customer ids come from the catalog's customer_directory (AUTOINCREMENT id,
+# UNIQUE msisdn), which also keeps msisdns unique across shards. Rows that shards
+# number themselves (offer assignments, usage, profiles, segment mappings) draw
+# ids from a range of ID_SPAN per shard slot, so those ids are globally unique too.
+# Enable with CSP_SHARDS=shards.json. Tools (run with the server stopped):
+#   python shards.py init --from csp.db --shards 4 --dir shards --map shards.json
+#   python shards.py split --map shards.json --shard 0
+#   python shards.py info --map shards.json
+
+import os
+import sys
+import json
+import bisect
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import db_init
+
+MAP_PATH = os.environ.get("CSP_SHARDS")
+BUCKETS = 1024
+
+# tables whose rows belong to one customer (column holding the customer id)
+CUSTOMER_TABLES = [
+    ("customers", "id"),
+    ("customer_profile", "customer_id"),
+    ("usage_history", "customer_id"),
+    ("usage_aggregates", "customer_id"),
+    ("customer_segment_map", "customer_id"),
+    ("offer_assignment", "customer_id"),
+    ("offer_assignment_archive", "customer_id"),
+]
+# catalog tables mirrored into every shard
+GLOBAL_TABLES = ["offers", "segments", "segment_runs", "segment_stats", "active_segment_run"]
+# customer tables whose AUTOINCREMENT ids each shard allocates, from slot * ID_SPAN up
+ID_TABLES = ["customer_profile", "usage_history", "customer_segment_map", "offer_assignment"]
+ID_SPAN = 1 << 40
+
+DIRECTORY_SQL = """
+    CREATE TABLE IF NOT EXISTS customer_directory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        msisdn TEXT UNIQUE
+    )
+"""
+
+
+# ---------------------------------------------------------------------
+# SHARD MAP / ROUTING
+# ---------------------------------------------------------------------
+
+def load_map(path=None):
+    """Shard map from path (default CSP_SHARDS); None when sharding is off."""
+    path = path or MAP_PATH
+    if not path:
+        return None
+    with open(path, encoding="utf-8") as f:
+        smap = json.load(f)
+    smap["shards"].sort(key=lambda s: s["lo"])
+    smap["_los"] = [s["lo"] for s in smap["shards"]]
+    return smap
+
+
+def save_map(smap, path):
+    data = {k: v for k, v in smap.items() if not k.startswith("_")}
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def shard_for_bucket(smap, bucket):
+    return smap["shards"][bisect.bisect_right(smap["_los"], bucket) - 1]
+
+
+def path_for_customer(smap, customer_id):
+    return shard_for_bucket(smap, int(customer_id) % smap["buckets"])["path"]
+
+
+def paths(smap):
+    return [s["path"] for s in smap["shards"]]
+
+
+def group_by_shard(smap, customer_ids):
+    """{shard path: [customer ids]} preserving input order within each shard."""
+    out = {}
+    for cid in customer_ids:
+        out.setdefault(path_for_customer(smap, cid), []).append(cid)
+    return out
+
+
+def register_customer(catalog_conn, msisdn):
+    """Reserve a new customer id for msisdn in the catalog's directory (in the caller's transaction).
+
+    Raises sqlite3.IntegrityError when the msisdn is already registered on any shard.
+    """
+    return catalog_conn.execute("INSERT INTO customer_directory (msisdn) VALUES (?)", (msisdn,)).lastrowid
+
+
+def fan_out(fn, items):
+    """[fn(item) for item in items], run concurrently (SQLite releases the GIL while it works)."""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(i) for i in items]
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        return list(pool.map(fn, items))
+
+
+# ---------------------------------------------------------------------
+# CATALOG MIRROR
+# ---------------------------------------------------------------------
+
+def _columns(conn, table, schema="main"):
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def sync_globals(smap, tables=GLOBAL_TABLES):
+    """Copy the catalog tables into every shard, one transaction per shard."""
+    catalog = os.path.abspath(smap["catalog"])
+
+    def sync(path):
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            conn.execute("ATTACH DATABASE ? AS cat", (catalog,))
+            with conn:
+                for t in tables:
+                    cols = ",".join(_columns(conn, t))
+                    conn.execute(f"DELETE FROM main.{t}")
+                    conn.execute(f"INSERT INTO main.{t} ({cols}) SELECT {cols} FROM cat.{t}")
+            conn.execute("DETACH DATABASE cat")
+        finally:
+            conn.close()
+
+    fan_out(sync, paths(smap))
+
+
+# ---------------------------------------------------------------------
+# TOOLS
+# ---------------------------------------------------------------------
+
+def _new_db(path, slot):
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    conn = sqlite3.connect(path)
+    db_init.create_schema(conn)
+    db_init.ensure_schema(conn)
+    # AUTOINCREMENT continues above max(seq, largest id): this shard numbers its rows from slot * ID_SPAN
+    conn.executemany("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                     [(t, slot * ID_SPAN) for t in ID_TABLES])
+    conn.commit()
+    return conn
+
+
+def init(source, n, out_dir, map_path, buckets=BUCKETS):
+    """Split a single database into a catalog plus n shards. Customers keep their ids and go to
+    bucket id % buckets; the catalog's customer_directory records every id and msisdn."""
+    src = sqlite3.connect(source)
+    top = max([src.execute(f"SELECT MAX(id) FROM {t}").fetchone()[0] or 0 for t in ID_TABLES])
+    src.close()
+    if top >= ID_SPAN:
+        raise ValueError(f"source ids reach {top}, above the per-shard id range {ID_SPAN}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    catalog = os.path.join(out_dir, "catalog.db")
+    db_init.make_snapshot(source, catalog)
+    conn = sqlite3.connect(catalog)
+    db_init.ensure_schema(conn)
+    for table, _ in CUSTOMER_TABLES:
+        conn.execute(f"DELETE FROM {table}")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+
+    step = -(-buckets // n)
+    smap = {"buckets": buckets, "catalog": catalog, "shards": []}
+    for i in range(n):
+        lo, hi = i * step, min(buckets, (i + 1) * step)
+        path = os.path.join(out_dir, f"s{i}.db")
+        # slot 0 is left to the ids copied from the source
+        conn = _new_db(path, i + 1)
+        conn.execute("ATTACH DATABASE ? AS src", (os.path.abspath(source),))
+        with conn:
+            for table, key in CUSTOMER_TABLES:
+                cols = [c for c in _columns(conn, table) if c in set(_columns(conn, table, "src"))]
+                if not cols:
+                    continue  # table added after the source was created
+                conn.execute(
+                    f"INSERT INTO main.{table} ({','.join(cols)}) SELECT {','.join(cols)} FROM src.{table} "
+                    f"WHERE {key} % ? >= ? AND {key} % ? < ?", (buckets, lo, buckets, hi)
+                )
+        conn.execute("DETACH DATABASE src")
+        db_init.ensure_schema(conn)  # fills usage_aggregates when the source had none
+        conn.close()
+        smap["shards"].append({"path": path, "lo": lo, "hi": hi, "slot": i + 1})
+
+    save_map(smap, map_path)
+    smap = load_map(map_path)
+    sync_globals(smap)
+    src = sqlite3.connect(source)
+    row = src.execute("SELECT seq FROM sqlite_sequence WHERE name = 'customers'").fetchone()
+    src.close()
+    # never hand out the ids of customers deleted before the split
+    ensure_directory(smap, row[0] if row else 0)
+    return smap
+
+
+def ensure_directory(smap, min_seq=0):
+    """Create the catalog's customer_directory from the shards' customers when it is missing
+    (maps made before it existed); new ids continue above every stored id and min_seq."""
+    conn = sqlite3.connect(smap["catalog"], timeout=30)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'customer_directory'").fetchone():
+            return
+        # filled under another name and renamed last, so an interrupted backfill starts over
+        conn.execute("DROP TABLE IF EXISTS customer_directory_build")
+        conn.execute(DIRECTORY_SQL.replace("customer_directory", "customer_directory_build"))
+        for path in paths(smap):
+            conn.execute("ATTACH DATABASE ? AS s", (os.path.abspath(path),))
+            conn.execute("INSERT INTO customer_directory_build (id, msisdn) SELECT id, msisdn FROM s.customers")
+            conn.commit()
+            conn.execute("DETACH DATABASE s")
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'customer_directory_build'")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'customer_directory_build', "
+                     "MAX(COALESCE(MAX(id), 0), ?) FROM customer_directory_build", (min_seq,))
+        conn.execute("ALTER TABLE customer_directory_build RENAME TO customer_directory")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def split(map_path, index, new_path=None):
+    """Move the upper half of one shard's bucket range into a new shard file."""
+    smap = load_map(map_path)
+    shard = smap["shards"][index]
+    lo, hi = shard["lo"], shard["hi"]
+    if hi - lo < 2:
+        raise ValueError("shard holds a single bucket and cannot be split")
+    mid = (lo + hi) // 2
+    buckets = smap["buckets"]
+    new_path = new_path or os.path.join(os.path.dirname(shard["path"]), f"s{len(smap['shards'])}.db")
+
+    slot = 1 + max(s.get("slot", i + 1) for i, s in enumerate(smap["shards"]))
+    conn = _new_db(new_path, slot)
+    conn.execute("ATTACH DATABASE ? AS src", (os.path.abspath(shard["path"]),))
+    with conn:
+        for table, key in CUSTOMER_TABLES:
+            cols = ",".join(_columns(conn, table))
+            conn.execute(f"INSERT INTO main.{table} ({cols}) SELECT {cols} FROM src.{table} "
+                         f"WHERE {key} % ? >= ? AND {key} % ? < ?", (buckets, mid, buckets, hi))
+    conn.execute("DETACH DATABASE src")
+    conn.close()
+
+    # route the upper half to the new file, then drop it from the old one
+    shard["hi"] = mid
+    smap["shards"].append({"path": new_path, "lo": mid, "hi": hi, "slot": slot})
+    save_map(smap, map_path)
+    old = sqlite3.connect(shard["path"])
+    with old:
+        for table, key in CUSTOMER_TABLES:
+            old.execute(f"DELETE FROM {table} WHERE {key} % ? >= ? AND {key} % ? < ?", (buckets, mid, buckets, hi))
+    old.close()
+    smap = load_map(map_path)
+    sync_globals(smap)
+    return smap
+
+
+def info(smap):
+    def count(s):
+        conn = sqlite3.connect(s["path"])
+        try:
+            return dict(s, customers=conn.execute("SELECT COUNT(*) FROM customers").fetchone()[0],
+                        size_mb=round(os.path.getsize(s["path"]) / 1e6, 1))
+        finally:
+            conn.close()
+
+    return fan_out(count, smap["shards"])
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Shard maintenance")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    pi = sub.add_parser("init", help="split a single database into shards")
+    pi.add_argument("--from", dest="source", default="csp.db")
+    pi.add_argument("--shards", type=int, default=4)
+    pi.add_argument("--dir", default="shards")
+    pi.add_argument("--map", default="shards.json")
+    ps = sub.add_parser("split", help="split one shard's bucket range in two")
+    ps.add_argument("--map", default="shards.json")
+    ps.add_argument("--shard", type=int, required=True)
+    ps.add_argument("--path", default=None)
+    for name in ("info", "sync"):
+        sub.add_parser(name).add_argument("--map", default="shards.json")
+    args = p.parse_args(argv)
+
+    if args.cmd == "init":
+        smap = init(args.source, args.shards, args.dir, args.map)
+    elif args.cmd == "split":
+        smap = split(args.map, args.shard, args.path)
+    else:
+        smap = load_map(args.map)
+        if args.cmd == "sync":
+            sync_globals(smap)
+    for s in info(smap):
+        print(json.dumps(s))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,268 @@
+# shared_features.py
+# Read-mostly analytics structures (customer table, feature matrices, compiled
+# offer catalogue) published once per node into multiprocessing.shared_memory,
+# so pre-forked server workers attach to one copy instead of building their own.
+#
+# A segment is named after the database and the structure's data version, and
+# starts with a version header:
+#
+#   magic "CSPSHM1\0" | ready u32 | reserved u32 | meta_len u64 | meta JSON | arrays (64-byte aligned)
+#
+# meta JSON holds the full version key, the array directory and the caller's
+# own metadata. The writer sets `ready` last, so readers never see a half-built
+# segment. When the data version moves, the next get() maps the new segment and
+# unlinks the old name; processes still reading the old one keep their mapping.
+#
+# Enable with CSP_SHARED_FEATURES=1 (server.py --workers N turns it on).
+# List / remove segments: python shared_features.py --db csp.db [--clear]
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import sqlite3
+import argparse
+import threading
+from array import array
+from multiprocessing import shared_memory, resource_tracker
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ENABLED = os.environ.get("CSP_SHARED_FEATURES", "") == "1"
+ATTACH_WAIT_S = 10.0  # how long to wait for another process that is still writing a segment
+
+MAGIC = b"CSPSHM1\0"
+HEADER = struct.Struct("<8sIIQ")
+ALIGN = 64
+TYPECODES = "qQiIhHbBfd"
+SHM_DIR = "/dev/shm"  # where POSIX segments are visible on Linux (listing / cleanup only)
+
+_lock = threading.Lock()
+_bundles = {}  # (db tag, kind) -> Bundle
+
+
+def enabled():
+    return ENABLED
+
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+
+def db_tag(conn):
+    path = conn.execute("PRAGMA database_list").fetchone()[2] or ":memory:"
+    return "%08x" % zlib.crc32(os.path.abspath(path).encode("utf-8"))
+
+
+def segment_name(tag, kind, key):
+    # short enough for macOS (31 chars); prefix per database so cleanup can find them
+    return "csp%s%08x" % (tag, zlib.crc32(f"{kind}\0{key}".encode("utf-8")))
+
+
+def _align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def _typecode(a):
+    if isinstance(a, array):
+        return a.typecode
+    for tc in TYPECODES:
+        if np.dtype(tc) == a.dtype:
+            return tc
+    raise TypeError(f"unsupported array dtype: {a.dtype}")
+
+
+def _raw(a):
+    if isinstance(a, array):
+        return memoryview(a).cast("B")
+    return memoryview(np.ascontiguousarray(a)).cast("B")
+
+
+def _map(name, create=False, size=0):
+    """Memoryview over a named segment, owned by nobody but its views: the mapping goes away with the
+    last array that points into it, so dropping an old version never has to chase every reader."""
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    # the stdlib tracker would unlink the segment when the first process that touched it exits;
+    # lifetime is managed here instead (old versions unlinked on re-map, cleanup() at shutdown)
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    buf = shm.buf
+    shm._buf = shm._mmap = None  # detach so close() only releases the file descriptor
+    shm.close()
+    return buf
+
+
+def _unlink(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except (FileNotFoundError, ValueError):
+        return
+    try:
+        shm.unlink()  # also drops the tracker registration made by the open above
+    except FileNotFoundError:
+        pass
+    shm.close()
+
+
+class Bundle:
+    """Named arrays (zero-copy views) plus JSON metadata for one data version."""
+
+    def __init__(self, name, buf, key, arrays, meta):
+        self.name = name
+        self.nbytes = len(buf) if buf is not None else 0
+        self.key = key
+        self.arrays = arrays
+        self.meta = meta
+
+    def close(self):
+        self.arrays = {}
+
+
+def _views(buf, base, directory):
+    out = {}
+    for name, (tc, offset, count) in directory.items():
+        offset += base
+        if np is not None:
+            out[name] = np.frombuffer(buf, dtype=tc, count=count, offset=offset)
+        else:
+            out[name] = buf[offset:offset + count * array(tc).itemsize].cast(tc)
+    return out
+
+
+def publish(name, key, arrays, meta=None):
+    """Create segment `name` holding arrays ({name: array.array or ndarray}) and meta. FileExistsError if taken."""
+    directory, raws, offset = {}, [], 0
+    for aname, a in arrays.items():
+        tc, raw = _typecode(a), _raw(a)
+        directory[aname] = (tc, offset, len(raw) // array(tc).itemsize)
+        raws.append((offset, raw))
+        offset = _align(offset + len(raw))
+    meta = meta or {}
+    head = json.dumps({"key": key, "arrays": directory, "meta": meta}).encode("utf-8")
+    base = _align(HEADER.size + len(head))  # array offsets are relative to the end of the header
+
+    buf = _map(name, create=True, size=base + offset)
+    try:
+        buf[HEADER.size:HEADER.size + len(head)] = head
+        for off, raw in raws:
+            buf[base + off:base + off + len(raw)] = raw
+        HEADER.pack_into(buf, 0, MAGIC, 1, 0, len(head))  # ready goes in last: readers may map it now
+    except BaseException:
+        _unlink(name)
+        raise
+    return Bundle(name, buf, key, _views(buf, base, directory), meta)
+
+
+def attach(name, key=None, wait=ATTACH_WAIT_S):
+    """Map an existing segment; None when it is missing, foreign, for another key or never became ready."""
+    deadline = time.monotonic() + wait
+    buf = None
+    while True:
+        if buf is None:
+            try:
+                buf = _map(name)
+            except FileNotFoundError:
+                return None
+            except ValueError:
+                pass  # created but not sized yet
+        if buf is not None and len(buf) >= HEADER.size:
+            magic, ready, _, meta_len = HEADER.unpack_from(buf, 0)
+            if ready and magic == MAGIC:
+                break
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.01)
+    head = json.loads(bytes(buf[HEADER.size:HEADER.size + meta_len]).decode("utf-8"))
+    if key is not None and head["key"] != key:
+        return None
+    base = _align(HEADER.size + meta_len)
+    return Bundle(name, buf, head["key"], _views(buf, base, head["arrays"]), head["meta"])
+
+
+def get(conn, kind, key, build):
+    """Bundle of `kind` for conn's database at data version `key`.
+
+    Reuses this process's mapping while the key holds, else maps what another process published,
+    else runs build() -> (arrays, meta) and publishes it. The previous version's segment is unlinked.
+    """
+    tag = db_tag(conn)
+    with _lock:
+        current = _bundles.get((tag, kind))
+        if current is not None and current.key == key:
+            return current
+    name = segment_name(tag, kind, key)
+    bundle = attach(name, key)
+    if bundle is None:
+        arrays, meta = build()
+        try:
+            bundle = publish(name, key, arrays, meta)
+        except FileExistsError:
+            # another worker got there first (or left a stale segment behind)
+            bundle = attach(name, key)
+            if bundle is None:
+                _unlink(name)  # abandoned by a writer that died; the next call publishes afresh
+                return Bundle(None, None, key, arrays, meta)
+    with _lock:
+        old = _bundles.get((tag, kind))
+        _bundles[(tag, kind)] = bundle
+    if old is not None and old.name != bundle.name:
+        if old.name:
+            _unlink(old.name)
+        old.close()
+    return bundle
+
+
+def info():
+    with _lock:
+        return [
+            {"kind": kind, "db_tag": tag, "name": b.name, "key": b.key, "bytes": b.nbytes, "shared": b.name is not None}
+            for (tag, kind), b in sorted(_bundles.items())
+        ]
+
+
+def segments(tag):
+    """Segment names of one database visible in SHM_DIR (Linux only; [] elsewhere)."""
+    if not os.path.isdir(SHM_DIR):
+        return []
+    return sorted(n for n in os.listdir(SHM_DIR) if n.startswith("csp" + tag))
+
+
+def cleanup(conn):
+    """Unlink every segment published for conn's database, by this or any other process."""
+    tag = db_tag(conn)
+    with _lock:
+        mine = [k for k in _bundles if k[0] == tag]
+        names = {_bundles[k].name for k in mine if _bundles[k].name}
+        for k in mine:
+            _bundles.pop(k).close()
+    for name in names | set(segments(tag)):
+        _unlink(name)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="List or remove shared-memory segments of a database")
+    p.add_argument("--db", default="csp.db")
+    p.add_argument("--clear", action="store_true")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    tag = db_tag(conn)
+    for name in segments(tag):
+        b = attach(name, wait=0)
+        print(name, b.nbytes if b else "?", b.key if b else "(not ready)")
+        if b:
+            b.close()
+    if args.clear:
+        cleanup(conn)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -63,3 +63,44 @@ def kmeans(points, k=3, max_iter=100, seed=None):
             break
 
     return labels, centroids
+
+
+def kmeans_numpy(points, k=3, max_iter=100, seed=None):
+    """
+    Vectorized variant of kmeans() for large inputs. Requires NumPy.
+    points: array-like (n, dim)
+    returns: (labels ndarray[int], centroids ndarray[float32])
+    """
+    import numpy as np
+
+    X = np.asarray(points, dtype=np.float32)
+    n = X.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+    if k > n:
+        k = n
+
+    rnd = np.random.default_rng(seed)
+    centroids = X[rnd.choice(n, size=k, replace=False)].copy()
+    sq = (X * X).sum(axis=1)
+    labels = np.full(n, -1, dtype=np.int64)
+
+    for _ in range(max_iter):
+        # assign step: ||x||^2 - 2 x.c + ||c||^2, computed as one matrix product
+        d = sq[:, None] - 2.0 * (X @ centroids.T) + (centroids * centroids).sum(axis=1)[None, :]
+        new_labels = d.argmin(axis=1)
+        changed = bool((new_labels != labels).any())
+        labels = new_labels
+
+        # update step
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=X[:, j], minlength=k) for j in range(X.shape[1])], axis=1)
+        empty = counts == 0
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        if empty.any():
+            # reinitialize empty clusters to random points
+            centroids[empty] = X[rnd.integers(0, n, size=int(empty.sum()))]
+        if not changed:
+            break
+
+    return labels, centroids
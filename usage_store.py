@@ -0,0 +1,336 @@
+# usage_store.py
+# Optional columnar store for usage_history, partitioned by month.
+#
+#   <root>/<YYYY-MM>/meta.json        row/customer counts, format, source data version
+#   <root>/<YYYY-MM>/customers.bin    int64  sorted customer ids present in the month
+#   <root>/<YYYY-MM>/offsets.bin      int64  rows of customers[i] are [offsets[i], offsets[i+1])
+#   <root>/<YYYY-MM>/<column>.bin     one file per column, rows sorted by (customer_id, date)
+#                                     (or part.parquet holding the columns when pyarrow is used)
+#
+# Column files are memory-mapped (NumPy memmap, or mmap + memoryview without NumPy).
+# Aggregates are windowed reductions over whole partitions, and dropping a month
+# is a directory rename. Enable for feature/offer aggregates with
+# CSP_USAGE_BACKEND=columnar after exporting:
+#   python usage_store.py export --db csp.db [--format parquet]
+#   python usage_store.py drop 2024-01
+
+import os
+import sys
+import json
+import zlib
+import mmap
+import shutil
+import bisect
+import sqlite3
+import argparse
+from array import array
+
+import db_init
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ROOT = os.environ.get("CSP_USAGE_STORE", "usage_store")
+BACKEND = os.environ.get("CSP_USAGE_BACKEND", "sqlite")
+
+# (column, array typecode, numpy dtype)
+COLUMNS = [
+    ("day", "b", "int8"),
+    ("data_mb", "f", "float32"),
+    ("call_minutes", "f", "float32"),
+    ("sms_count", "i", "int32"),
+    ("app_usage_score", "f", "float32"),
+]
+VALUE_COLUMNS = ["data_mb", "call_minutes", "sms_count", "app_usage_score"]
+
+
+def enabled(root=ROOT):
+    """True when aggregates should come from the columnar store instead of SQLite."""
+    return BACKEND == "columnar" and os.path.isdir(root) and bool(partitions(root))
+
+
+def partitions(root=ROOT):
+    """Month keys (YYYY-MM) present in the store, oldest first."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(d for d in os.listdir(root) if len(d) == 7 and os.path.exists(os.path.join(root, d, "meta.json")))
+
+
+def signature(root=ROOT):
+    """Short tag that changes whenever a partition is written or dropped (for feature cache keys)."""
+    parts = []
+    for month in partitions(root):
+        parts.append(f"{month}:{os.stat(os.path.join(root, month, 'meta.json')).st_mtime_ns}")
+    return f"{zlib.crc32(','.join(parts).encode()):08x}"
+
+
+# ---------------------------------------------------------------------
+# WRITE
+# ---------------------------------------------------------------------
+
+def _next_month(month):
+    y, m = int(month[:4]), int(month[5:7])
+    return f"{y + (m == 12):04d}-{m % 12 + 1:02d}"
+
+
+def write_partition(root, month, rows, fmt="raw", source_version=None):
+    """Write one month from rows of (customer_id, date, data_mb, call_minutes, sms_count, app_usage_score)
+    already sorted by (customer_id, date).
+
+    An existing partition is swapped out by two renames (old aside, new in) and deleted afterwards.
+    Readers see the old or the new files, never a half-written month; only a reader
+    opening the month between the two renames finds it missing.
+    """
+    tmp = os.path.join(root, f".{month}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    cols = {name: array(code) for name, code, _ in COLUMNS}
+    customers, offsets = array("q"), array("q")
+    last = None
+    n = 0
+    for cid, day, data_mb, call_minutes, sms_count, app_usage_score in rows:
+        if cid != last:
+            customers.append(cid)
+            offsets.append(n)
+            last = cid
+        cols["day"].append(int(str(day)[8:10]))
+        cols["data_mb"].append(float(data_mb or 0))
+        cols["call_minutes"].append(float(call_minutes or 0))
+        cols["sms_count"].append(int(sms_count or 0))
+        cols["app_usage_score"].append(float(app_usage_score or 0))
+        n += 1
+    offsets.append(n)
+
+    for name, a in (("customers", customers), ("offsets", offsets)):
+        with open(os.path.join(tmp, f"{name}.bin"), "wb") as f:
+            a.tofile(f)
+    if fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("parquet format requires pyarrow")
+        pq.write_table(pa.table({name: list(a) for name, a in cols.items()}), os.path.join(tmp, "part.parquet"))
+    else:
+        for name, a in cols.items():
+            with open(os.path.join(tmp, f"{name}.bin"), "wb") as f:
+                a.tofile(f)
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"month": month, "rows": n, "customers": len(customers), "format": fmt,
+                   "source_version": source_version}, f)
+
+    final = os.path.join(root, month)
+    old = os.path.join(root, f".{month}.old")
+    shutil.rmtree(old, ignore_errors=True)
+    replacing = os.path.exists(final)
+    if replacing:
+        os.rename(final, old)
+    os.rename(tmp, final)
+    if replacing:
+        shutil.rmtree(old, ignore_errors=True)  # mapped files stay readable until their readers let go
+    return n
+
+
+def export_from_sqlite(conn, root=ROOT, months=None, fmt="raw"):
+    """(Re)build month partitions from usage_history. Returns {month: rows}."""
+    os.makedirs(root, exist_ok=True)
+    version = db_init.get_version(conn, "usage_history")
+    if months is None:
+        months = [r[0] for r in conn.execute(
+            "SELECT DISTINCT substr(date, 1, 7) FROM usage_history WHERE date IS NOT NULL ORDER BY 1")]
+    out = {}
+    for month in months:
+        cur = conn.execute(
+            "SELECT customer_id, date, data_mb, call_minutes, sms_count, app_usage_score FROM usage_history "
+            "WHERE date >= ? AND date < ? ORDER BY customer_id, date",
+            (f"{month}-01", f"{_next_month(month)}-01"),
+        )
+        out[month] = write_partition(root, month, cur, fmt=fmt, source_version=version)
+    return out
+
+
+def drop_partition(month, root=ROOT):
+    """Remove a month: one rename takes it out of every reader's view, then the files are deleted."""
+    path = os.path.join(root, month)
+    if not os.path.exists(path):
+        return False
+    trash = os.path.join(root, f".{month}.drop")
+    shutil.rmtree(trash, ignore_errors=True)
+    os.rename(path, trash)
+    shutil.rmtree(trash, ignore_errors=True)
+    return True
+
+
+# ---------------------------------------------------------------------
+# READ
+# ---------------------------------------------------------------------
+
+def _map(path, code, dtype, count):
+    if count == 0:
+        return np.zeros(0, dtype=dtype) if np is not None else array(code)
+    if np is not None:
+        return np.memmap(path, dtype=dtype, mode="r")
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm).cast(code)
+
+
+def open_partition(month, root=ROOT):
+    """{"customers", "offsets", <column>: sequence, "rows"} for one month, memory-mapped."""
+    d = os.path.join(root, month)
+    with open(os.path.join(d, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    part = {
+        "month": month,
+        "rows": meta["rows"],
+        "customers": _map(os.path.join(d, "customers.bin"), "q", "int64", meta["customers"]),
+        "offsets": _map(os.path.join(d, "offsets.bin"), "q", "int64", meta["customers"] + 1),
+    }
+    if meta.get("format") == "parquet":
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(os.path.join(d, "part.parquet"))
+        for name, _, dtype in COLUMNS:
+            part[name] = table.column(name).to_numpy().astype(dtype, copy=False)
+    else:
+        for name, code, dtype in COLUMNS:
+            part[name] = _map(os.path.join(d, f"{name}.bin"), code, dtype, meta["rows"])
+    return part
+
+
+def _window(months, since=None, until=None):
+    """Partitions overlapping [since, until] (ISO dates) plus the day bounds to apply to the edge months."""
+    out = []
+    for m in months:
+        if since and m < since[:7]:
+            continue
+        if until and m > until[:7]:
+            continue
+        lo = int(since[8:10]) if since and m == since[:7] else 1
+        hi = int(until[8:10]) if until and m == until[:7] else 31
+        out.append((m, lo, hi))
+    return out
+
+
+def _reduce_numpy(part, lo, hi, customer_ids):
+    offs = np.asarray(part["offsets"])
+    custs = np.asarray(part["customers"])
+    if customer_ids is not None:
+        want = np.asarray(sorted(set(customer_ids)), dtype=np.int64)
+        pos = np.searchsorted(custs, want)
+        ok = pos < len(custs)
+        ok[ok] = custs[pos[ok]] == want[ok]
+        pos = pos[ok]
+        if len(pos) == 0:
+            return custs[:0], np.zeros((0, len(VALUE_COLUMNS))), np.zeros(0)
+        rows = np.concatenate([np.arange(offs[p], offs[p + 1]) for p in pos])
+        seg = np.repeat(np.arange(len(pos)), offs[pos + 1] - offs[pos])
+        ids = custs[pos]
+    else:
+        rows = None
+        seg = np.repeat(np.arange(len(custs)), np.diff(offs))
+        ids = custs
+    day = np.asarray(part["day"]) if rows is None else np.asarray(part["day"])[rows]
+    w = ((day >= lo) & (day <= hi)).astype(np.float64)
+    counts = np.bincount(seg, weights=w, minlength=len(ids))
+    sums = np.stack([
+        np.bincount(seg, weights=(np.asarray(part[c]) if rows is None else np.asarray(part[c])[rows]) * w,
+                    minlength=len(ids))
+        for c in VALUE_COLUMNS
+    ], axis=1)
+    return np.asarray(ids), sums, counts
+
+
+def _reduce_python(part, lo, hi, customer_ids):
+    custs, offs = part["customers"], part["offsets"]
+    if customer_ids is not None:
+        idxs = []
+        for cid in sorted(set(customer_ids)):
+            p = bisect.bisect_left(custs, cid)
+            if p < len(custs) and custs[p] == cid:
+                idxs.append(p)
+    else:
+        idxs = range(len(custs))
+    ids, sums, counts = [], [], []
+    cols = [part[c] for c in VALUE_COLUMNS]
+    day = part["day"]
+    for p in idxs:
+        acc = [0.0] * len(cols)
+        n = 0
+        for r in range(offs[p], offs[p + 1]):
+            if lo <= day[r] <= hi:
+                n += 1
+                for j, col in enumerate(cols):
+                    acc[j] += col[r]
+        ids.append(custs[p])
+        sums.append(acc)
+        counts.append(n)
+    return ids, sums, counts
+
+
+def aggregate(root=ROOT, since=None, until=None, customer_ids=None):
+    """Per-customer averages of VALUE_COLUMNS over [since, until] (ISO dates, inclusive).
+
+    Returns (ids, rows) sorted by customer id, like features.load_usage(); customers
+    with no rows in the window are omitted.
+    """
+    totals = {}
+    parts = _window(partitions(root), since, until)
+    if np is not None:
+        all_ids, all_sums, all_counts = [], [], []
+        for month, lo, hi in parts:
+            ids, sums, counts = _reduce_numpy(open_partition(month, root), lo, hi, customer_ids)
+            all_ids.append(ids)
+            all_sums.append(sums)
+            all_counts.append(counts)
+        if not all_ids:
+            return [], []
+        ids = np.concatenate(all_ids)
+        uniq, inv = np.unique(ids, return_inverse=True)
+        counts = np.bincount(inv, weights=np.concatenate(all_counts), minlength=len(uniq))
+        sums = np.stack([np.bincount(inv, weights=np.concatenate([s[:, j] for s in all_sums]), minlength=len(uniq))
+                         for j in range(len(VALUE_COLUMNS))], axis=1)
+        keep = counts > 0
+        return uniq[keep].tolist(), (sums[keep] / counts[keep][:, None]).tolist()
+
+    for month, lo, hi in parts:
+        for cid, acc, n in zip(*_reduce_python(open_partition(month, root), lo, hi, customer_ids)):
+            t = totals.setdefault(cid, [[0.0] * len(VALUE_COLUMNS), 0])
+            for j, v in enumerate(acc):
+                t[0][j] += v
+            t[1] += n
+    ids = [cid for cid in sorted(totals) if totals[cid][1]]
+    return ids, [[v / totals[cid][1] for v in totals[cid][0]] for cid in ids]
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Columnar usage-history store")
+    p.add_argument("--root", default=ROOT)
+    sub = p.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export", help="rebuild partitions from usage_history")
+    ex.add_argument("--db", default="csp.db")
+    ex.add_argument("--months", help="comma-separated YYYY-MM (default: all)")
+    ex.add_argument("--format", choices=["raw", "parquet"], default="raw")
+    dr = sub.add_parser("drop", help="drop one month partition")
+    dr.add_argument("month")
+    sub.add_parser("info", help="list partitions")
+    args = p.parse_args(argv)
+
+    if args.cmd == "export":
+        conn = sqlite3.connect(args.db)
+        months = args.months.split(",") if args.months else None
+        for month, n in export_from_sqlite(conn, args.root, months, fmt=args.format).items():
+            print(f"{month}: {n} rows")
+        conn.close()
+    elif args.cmd == "drop":
+        print("dropped" if drop_partition(args.month, args.root) else "not found", args.month)
+    else:
+        for month in partitions(args.root):
+            with open(os.path.join(args.root, month, "meta.json"), encoding="utf-8") as f:
+                print(json.dumps(json.load(f)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])